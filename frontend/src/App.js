@@ -19,6 +19,7 @@ function App() {
   const [data, setData] = useState();
   const [query, setQuery] = useState("");
   const [tableName, setTableName] = useState("");
+  const [sessionId, setSessionId] = useState();
 
   const handleRestart = () => {
     setCurrentStep(1);
@@ -42,6 +43,8 @@ function App() {
             setIsFileSelected={setIsFileSelected}
             hasHeader={hasHeader}
             setHasHeader={setHasHeader}
+            sessionId={sessionId}
+            setSessionId={setSessionId}
             setData={setData}
             setCurrentStep={setCurrentStep}
           />
@@ -54,6 +57,7 @@ function App() {
             filename={selectedFile.name}
             tableName={tableName}
             setTableName={setTableName}
+            sessionId={sessionId}
             setCurrentStep={setCurrentStep}
           />
         );
@@ -65,6 +69,7 @@ function App() {
             query={query}
             setQuery={setQuery}
             tableName={tableName}
+            sessionId={sessionId}
           />
         );
     }
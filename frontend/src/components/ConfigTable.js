@@ -1,8 +1,9 @@
 // ConfigTable.js
 
 // Table containing a row for every column in the data object
-// Each row contains a checkbox to delete the column
-// and a dropdown to choose the column's data type
+// Each row contains a checkbox to delete the column,
+// a dropdown to choose the column's data type
+// and a checkbox to index the column
 
 import React, { memo } from "react";
 import { Input, Table } from "reactstrap";
@@ -17,6 +18,15 @@ function ConfigTable(props) {
     }));
   };
 
+  // Handle an index checkbox click
+  // Update the value of columnsToIndex in state
+  const handleIndexChange = (column, checked) => {
+    props.setColumnsToIndex((prevCols) => ({
+      ...prevCols,
+      [column]: checked,
+    }));
+  };
+
   // Handle a dropdown selection
   // Update the value of columnDataTypes in state
   const handleDropdownChange = (e) => {
@@ -26,6 +36,19 @@ function ConfigTable(props) {
     }));
   };
 
+  // Describe the server's type suggestion for a column
+  const typeStatsText = (column) => {
+    const stats = props.data.columnTypeStats && props.data.columnTypeStats[column];
+    if (!stats) {
+      return "Select Data Type";
+    }
+    return (
+      `Suggested: ${props.data.columnTypes[column]} ` +
+      `(${Math.round(stats.confidence * 100)}% confidence, ` +
+      `${Math.round(stats.nullRatio * 100)}% empty)`
+    );
+  };
+
   const ConfigRow = ({ column, key }) => {
     return (
       <tr key={key}>
@@ -36,6 +59,9 @@ function ConfigTable(props) {
         <td key={column + "3"}>
           <ColumnDataTypeDropdown column={column} key={column + "3"} />
         </td>
+        <td key={column + "4"}>
+          <IndexColumnCheckbox column={column} key={column + "4"} />
+        </td>
       </tr>
     );
   };
@@ -54,6 +80,20 @@ function ConfigTable(props) {
     );
   };
 
+  const IndexColumnCheckbox = ({ column, key }) => {
+    return (
+      <div className="col-checkbox">
+        <Input
+          type="checkbox"
+          key={key}
+          title="Index this column to speed up queries that filter or sort by it"
+          onChange={(e) => handleIndexChange(column, e.target.checked)}
+          checked={props.columnsToIndex[column]}
+        />
+      </div>
+    );
+  };
+
   const ColumnDataTypeDropdown = ({ column, key }) => {
     return (
       <div className="col-dropdown">
@@ -61,14 +101,18 @@ function ConfigTable(props) {
           type="select"
           name="select-dtype"
           onChange={handleDropdownChange}
-          title="Select Data Type"
+          title={typeStatsText(column)}
           value={props.columnDataTypes[column]}
           id={column}
           key={key}
         >
           <option id="text">text</option>
           <option id="int">int</option>
+          <option id="bigint">bigint</option>
           <option id="float">float</option>
+          <option id="bool">bool</option>
+          <option id="date">date</option>
+          <option id="timestamp">timestamp</option>
         </Input>
       </div>
     );
@@ -82,6 +126,7 @@ function ConfigTable(props) {
             <td className="column-head-text">Column Name</td>
             <td className="column-head-text">Delete</td>
             <td className="column-head-text">Select Data Type</td>
+            <td className="column-head-text">Index</td>
           </tr>
         </thead>
         <tbody>
@@ -3,8 +3,10 @@
 // Second view. Contains a table showing the uploaded CSV data,
 // an input for the table name, and a config table. The config
 // table contains a row for every column. Each row also has
-// a checkbox to delete the column and a dropdown to choose
-// the column's data type.
+// a checkbox to delete the column, a dropdown to choose
+// the column's data type and a checkbox to index the column.
+// The data can also be appended or upserted (by a key column)
+// into an existing table of the same name.
 
 import React, { useState } from "react";
 import { Card, CardBody, CardHeader, Input, Label, Button } from "reactstrap";
@@ -16,6 +18,9 @@ import {
   createColumnLookup,
   compileColsToDelete,
   validateTableName,
+  postJSON,
+  waitForJob,
+  describeJobProgress,
 } from "../data";
 import "../styles/ConfigureData.css";
 import "../styles/App.css";
@@ -26,11 +31,26 @@ function ConfigureData(props) {
     createColumnLookup(false, props.data)
   );
 
-  // For storing the column data types
-  const [columnDataTypes, setColumnDataTypes] = useState(
-    createColumnLookup("text", props.data)
+  // For storing the columns to index once the table is loaded
+  const [columnsToIndex, setColumnsToIndex] = useState(
+    createColumnLookup(false, props.data)
   );
 
+  // For storing the column data types (defaults to the types inferred by the server)
+  const [columnDataTypes, setColumnDataTypes] = useState({
+    ...createColumnLookup("text", props.data),
+    ...props.data.columnTypes,
+  });
+
+  // For storing the status of the background job loading the table
+  const [loadJob, setLoadJob] = useState();
+
+  // For storing how the data is loaded: "replace", "append" or "upsert"
+  const [loadMode, setLoadMode] = useState("replace");
+
+  // For storing the column that identifies rows when upserting
+  const [keyColumn, setKeyColumn] = useState(props.data.columns[0]);
+
   // Handle updating the table name input
   const handleTableNameUpdate = (e) => {
     props.setTableName(e.target.value);
@@ -38,27 +58,44 @@ function ConfigureData(props) {
 
   // Handle clicking the continue button
   // Make sure a valid table name has been given,
-  // then send a request to create the table in the DB
+  // then start a job on the server to create the table in the DB,
+  // and wait for it to finish
   async function handleConfigureComplete() {
     if (!validateTableName(props.tableName)) {
       return;
     }
 
+    // The server reads the data from the uploaded file, so only the upload ID is sent
     let reqBody = {
-      data: props.data,
+      async: true,
+      sessionId: props.sessionId,
+      uploadId: props.data.uploadId,
       tableName: props.tableName,
       columnsToDelete: compileColsToDelete(columnsToDelete, props.data),
       columnDataTypes: columnDataTypes,
+      indexColumns: props.data.columns.filter(
+        (column) => columnsToIndex[column] && !columnsToDelete[column]
+      ),
+      loadMode: loadMode,
+      keyColumn: loadMode === "upsert" ? keyColumn : null,
     };
 
-    const response = await fetch("http://127.0.0.1:8080/initializeTable", {
-      method: "POST",
-      body: JSON.stringify(reqBody),
-      mode: "cors",
-      headers: { "Content-Type": "application/json" },
-    });
+    let resBody = await (await postJSON("initializeTable", reqBody)).json();
+    if (resBody["status"] === 200) {
+      setLoadJob(resBody["data"]);
+      const response = await waitForJob(
+        props.sessionId,
+        resBody["data"]["jobId"],
+        setLoadJob
+      );
+      setLoadJob();
+      if (!response) {
+        alert("Lost track of the table load. Please try again.");
+        return;
+      }
+      resBody = await response.json();
+    }
 
-    let resBody = await response.json();
     if (resBody["status"] === 200) {
       props.setData(prepData(resBody["data"]));
       props.setCurrentStep(3);
@@ -67,6 +104,14 @@ function ConfigureData(props) {
     }
   }
 
+  // Handle clicking the cancel button shown while the table is loading
+  async function handleCancelLoad() {
+    await postJSON("cancelJob", {
+      sessionId: props.sessionId,
+      jobId: loadJob.jobId,
+    });
+  }
+
   return (
     <div>
       <span>
@@ -89,6 +134,40 @@ function ConfigureData(props) {
                     onChange={handleTableNameUpdate}
                   />
                 </div>
+                <div>
+                  <Label className="table-name-label">
+                    If the table exists
+                  </Label>
+                  <Input
+                    type="select"
+                    bsSize="sm"
+                    value={loadMode}
+                    onChange={(e) => setLoadMode(e.target.value)}
+                  >
+                    <option value="replace">Replace it</option>
+                    <option value="append">Append rows</option>
+                    <option value="upsert">Upsert rows by key</option>
+                  </Input>
+                </div>
+                {loadMode === "upsert" && (
+                  <div>
+                    <Label className="table-name-label">Key column</Label>
+                    <Input
+                      type="select"
+                      bsSize="sm"
+                      value={keyColumn}
+                      onChange={(e) => setKeyColumn(e.target.value)}
+                    >
+                      {props.data.columns
+                        .filter((column) => !columnsToDelete[column])
+                        .map((column) => (
+                          <option key={column} value={column}>
+                            {column}
+                          </option>
+                        ))}
+                    </Input>
+                  </div>
+                )}
               </div>
               <div>
                 <ConfigTable
@@ -97,6 +176,8 @@ function ConfigureData(props) {
                   setColumnDataTypes={setColumnDataTypes}
                   columnsToDelete={columnsToDelete}
                   setColumnsToDelete={setColumnsToDelete}
+                  columnsToIndex={columnsToIndex}
+                  setColumnsToIndex={setColumnsToIndex}
                 />
               </div>
             </div>
@@ -105,12 +186,19 @@ function ConfigureData(props) {
       </span>
       <CardBody>
         <Button
+          disabled={!!loadJob}
           onClick={() =>
             handleConfigureComplete(columnsToDelete, columnDataTypes)
           }
         >
           Continue
         </Button>
+        {loadJob && (
+          <span>
+            {" "}Loading {describeJobProgress(loadJob)}{" "}
+            <Button onClick={handleCancelLoad}>Cancel</Button>
+          </span>
+        )}
         <HelpModal step={2} />
       </CardBody>
     </div>
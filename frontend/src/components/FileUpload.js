@@ -5,7 +5,7 @@
 import React from "react";
 import { Card, CardBody, CardHeader, Button } from "reactstrap";
 import HelpModal from "./HelpModal";
-import { prepData } from "../data";
+import { prepData, COLUMNS_JSON } from "../data";
 import "../styles/App.css";
 
 function FileUpload(props) {
@@ -33,15 +33,21 @@ function FileUpload(props) {
     const formData = new FormData();
     formData.append("File", props.selectedFile);
     formData.append("HasHeader", props.hasHeader);
+    // Keep using the same session (and DB schema) after a restart
+    if (props.sessionId) {
+      formData.append("SessionId", props.sessionId);
+    }
 
     const response = await fetch("http://127.0.0.1:8080/loadcsv", {
       method: "POST",
       body: formData,
       mode: "cors",
+      headers: { Accept: COLUMNS_JSON },
     });
 
     var body = await response.json();
     if (body["status"] === 200) {
+      props.setSessionId(body["data"]["sessionId"]);
       props.setData(prepData(body["data"]));
       props.setCurrentStep(2);
     } else {
@@ -3,7 +3,7 @@
 // The third and final view. Contains a data table, a PostgreSQL query editor,
 // an "Execute Query" button, and a "Download CSV" button
 
-import React from "react";
+import React, { useState } from "react";
 import {
   Card,
   CardBody,
@@ -14,10 +14,25 @@ import {
 } from "reactstrap";
 import DataTable from "./DataTable";
 import HelpModal from "./HelpModal";
-import { prepData, downloadCSV } from "../data";
+import {
+  prepData,
+  downloadCSV,
+  postJSON,
+  waitForJob,
+  describeJobProgress,
+} from "../data";
 import "../styles/App.css";
 
+// Number of rows per page of query results (matches server's PAGE_SIZE)
+const PAGE_SIZE = 500;
+
 function Transform(props) {
+  // For storing the status of the background job exporting the CSV
+  const [exportJob, setExportJob] = useState();
+
+  // For storing the ID of the query being executed, so it can be cancelled
+  const [runningQueryId, setRunningQueryId] = useState();
+
   // Handle updates to the query editor
   const handleQueryUpdate = (e) => {
     e.preventDefault();
@@ -39,11 +54,40 @@ function Transform(props) {
   // Send a request with the query to the server, wait for
   // the results, and update state
   async function handleExecuteQuery(query) {
-    const response = await fetch("http://127.0.0.1:8080/executeQuery", {
-      method: "POST",
-      body: JSON.stringify({ query: query }),
-      mode: "cors",
-      headers: { "Content-Type": "application/json" },
+    const queryId =
+      Date.now().toString(36) + Math.random().toString(36).substring(2);
+    setRunningQueryId(queryId);
+    const response = await postJSON("executeQuery", {
+      sessionId: props.sessionId,
+      query: query,
+      queryId: queryId,
+    });
+    setRunningQueryId();
+
+    let body = await response.json();
+    if (body["status"] === 200) {
+      props.setData(prepData(body["data"]));
+    } else {
+      alert(body["error"]);
+    }
+  }
+
+  // Handle click to the cancel button shown while a query is executing
+  // The query's request then fails with the cancellation error
+  async function handleCancelQuery() {
+    await postJSON("cancelQuery", {
+      sessionId: props.sessionId,
+      queryId: runningQueryId,
+    });
+  }
+
+  // Handle click to a page button
+  // Request the page of results starting at offset and update state
+  async function handlePageChange(offset) {
+    const response = await postJSON("queryPage", {
+      sessionId: props.sessionId,
+      resultId: props.data.resultId,
+      offset: offset,
     });
 
     let body = await response.json();
@@ -55,17 +99,79 @@ function Transform(props) {
   }
 
   // Handle click to "Download" button
+  // Start a job on the server to export the CSV, wait for it
+  // to finish, then download the exported file
   async function handleDownloadClick() {
-    const response = await fetch("http://127.0.0.1:8080/downloadcsv", {
-      method: "POST",
-      body: JSON.stringify({ query: props.query, tableName: props.tableName }),
-      mode: "cors",
-      headers: { "Content-Type": "application/json" },
-    });
+    const body = await (
+      await postJSON("downloadcsv", {
+        async: true,
+        sessionId: props.sessionId,
+        resultId: props.data.resultId,
+        query: props.query,
+        tableName: props.tableName,
+      })
+    ).json();
+    if (body["status"] !== 200) {
+      alert(body["error"]);
+      return;
+    }
+
+    setExportJob(body["data"]);
+    const response = await waitForJob(
+      props.sessionId,
+      body["data"]["jobId"],
+      setExportJob
+    );
+    setExportJob();
+
+    if (!response) {
+      alert("Lost track of the download. Please try again.");
+    } else if (response.headers.get("Content-Type").startsWith("text/csv")) {
+      downloadCSV(await response.blob(), props.tableName);
+    } else {
+      alert((await response.json())["error"]);
+    }
+  }
 
-    downloadCSV(await response.blob(), props.tableName);
+  // Handle click to the cancel button shown while the CSV is exporting
+  async function handleCancelDownload() {
+    await postJSON("cancelJob", {
+      sessionId: props.sessionId,
+      jobId: exportJob.jobId,
+    });
   }
 
+  // Previous/next page buttons and the range of rows currently displayed
+  const PageControls = () => {
+    const offset = props.data.offset || 0;
+    const pageSize = props.data.rows.length;
+    const totalRows = props.data.totalRows || pageSize;
+
+    if (!props.data.resultId || totalRows <= pageSize) {
+      return null;
+    }
+
+    return (
+      <div>
+        <Button
+          disabled={offset === 0}
+          onClick={() => handlePageChange(Math.max(offset - PAGE_SIZE, 0))}
+        >
+          Previous
+        </Button>
+        <span>
+          {" "}Rows {offset + 1}-{offset + pageSize} of {totalRows}{" "}
+        </span>
+        <Button
+          disabled={offset + pageSize >= totalRows}
+          onClick={() => handlePageChange(offset + PAGE_SIZE)}
+        >
+          Next
+        </Button>
+      </div>
+    );
+  };
+
   return (
     <div>
       <span>
@@ -74,6 +180,7 @@ function Transform(props) {
           <CardBody>
             <label>Table name: {props.tableName}</label>
             <DataTable data={props.data} />
+            <PageControls />
           </CardBody>
         </Card>
         <Card>
@@ -91,10 +198,24 @@ function Transform(props) {
               />
             </InputGroup>
             <CardBody>
-              <Button onClick={() => handleExecuteQuery(props.query)}>
+              <Button
+                disabled={!!runningQueryId}
+                onClick={() => handleExecuteQuery(props.query)}
+              >
                 Execute Query
               </Button>
-              <Button onClick={handleDownloadClick}>Download CSV</Button>
+              {runningQueryId && (
+                <Button onClick={handleCancelQuery}>Cancel Query</Button>
+              )}
+              <Button disabled={!!exportJob} onClick={handleDownloadClick}>
+                Download CSV
+              </Button>
+              {exportJob && (
+                <span>
+                  {" "}Exporting {describeJobProgress(exportJob)}{" "}
+                  <Button onClick={handleCancelDownload}>Cancel</Button>
+                </span>
+              )}
             </CardBody>
             <HelpModal step={3} />
           </CardBody>
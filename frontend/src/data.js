@@ -1,23 +1,48 @@
 // data.js
 // Helper functions for manipulating data
 
+// Media type of the column-oriented JSON the server sends table data in
+// (one list of values per column instead of one object per row)
+export const COLUMNS_JSON = "application/vnd.csvt.columns+json";
+
 // Format data to form expected by the <RenderData /> component
 export function prepData(data) {
   // Create an array of row objects containing a unique ID
   // and a list of row values in the same order as the column names list
   let prepared_rows = [];
-  for (let row_idx = 0; row_idx < data.rowData.length; row_idx++) {
-    let raw_row = data.rowData[row_idx];
-    let prepared_row = [];
+  if (data.columnData) {
+    const columnData = data.columnData;
+    for (let row_idx = 0; row_idx < columnData.id.length; row_idx++) {
+      prepared_rows.push({
+        id: columnData.id[row_idx],
+        items: data.columns.map((col_name) => columnData[col_name][row_idx]),
+      });
+    }
+  } else {
+    for (let row_idx = 0; row_idx < data.rowData.length; row_idx++) {
+      let raw_row = data.rowData[row_idx];
+      let prepared_row = [];
 
-    for (let col_name of data.columns) {
-      prepared_row.push(raw_row[col_name]);
+      for (let col_name of data.columns) {
+        prepared_row.push(raw_row[col_name]);
+      }
+      prepared_rows.push({ id: raw_row.id, items: prepared_row });
     }
-    prepared_rows.push({ id: raw_row.id, items: prepared_row });
   }
 
-  // Return data in the form expected by the <RenderData /> component
-  return { columns: data.columns, rows: prepared_rows };
+  // Return data in the form expected by the <RenderData /> component,
+  // along with the upload ID and inferred column types of a loaded CSV
+  // and the paging info for query results
+  return {
+    columns: data.columns,
+    rows: prepared_rows,
+    uploadId: data.uploadId,
+    columnTypes: data.columnTypes,
+    columnTypeStats: data.columnTypeStats,
+    resultId: data.resultId,
+    totalRows: data.totalRows,
+    offset: data.offset,
+  };
 }
 
 // Create a dictionary of Column Name -> Default Value
@@ -62,6 +87,52 @@ export function downloadCSV(blob, name) {
   a.click();
 }
 
+// Milliseconds between polls of a background job's status
+const JOB_POLL_INTERVAL = 1000;
+
+// Post a request to the server as JSON and return the response
+export function postJSON(endpoint, reqBody) {
+  return fetch("http://127.0.0.1:8080/" + endpoint, {
+    method: "POST",
+    body: JSON.stringify(reqBody),
+    mode: "cors",
+    headers: { "Content-Type": "application/json", Accept: COLUMNS_JSON },
+  });
+}
+
+// Poll a background job started on the server until it stops,
+// calling onProgress with the job status after every poll,
+// then return the response holding the job's result
+export async function waitForJob(sessionId, jobId, onProgress) {
+  const reqBody = { sessionId: sessionId, jobId: jobId };
+
+  while (true) {
+    const body = await (await postJSON("jobStatus", reqBody)).json();
+    if (body["status"] !== 200) {
+      return null;
+    }
+    if (onProgress) {
+      onProgress(body["data"]);
+    }
+    if (!["queued", "running"].includes(body["data"]["status"])) {
+      return postJSON("jobResult", reqBody);
+    }
+    await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL));
+  }
+}
+
+// Describe the progress of a background job for display
+export function describeJobProgress(job) {
+  let text = `${job.rowsProcessed} rows`;
+  if (job.totalRows) {
+    text += ` of ${job.totalRows}`;
+  }
+  if (job.etaSeconds !== null && job.etaSeconds !== undefined) {
+    text += ` (about ${Math.ceil(job.etaSeconds)}s left)`;
+  }
+  return text;
+}
+
 // Verify that a tableName is valid
 export function validateTableName(tableName) {
   if (tableName.length === 0) {
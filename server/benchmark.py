@@ -0,0 +1,1223 @@
+"""
+benchmark.py:
+End-to-end benchmark of the CSV Transformer endpoints. Generates a
+synthetic CSV file, then drives /loadcsv, /initializeTable, /executeQuery
+and /downloadcsv through the Flask test client (against the database at
+CSVT_DATABASE_URL) at each concurrency level, recording the latency
+percentiles, throughput and peak RSS of every endpoint. Optionally also
+measures how table loads scale with the number of parallel load workers
+(see the parallel module).
+
+--query-validation instead fuzzes the query validator (see the sql module)
+with mutations of a corpus of queries, checking that it never crashes and
+that unsafe queries are rejected, and times cold and cached checks. It
+doesn't need a database.
+
+--mixed-load instead serves the app over HTTP with the production server
+(see the serving module), or sends requests to a running server at --url,
+and for --duration seconds has --ingest-clients sessions upload and load
+the CSV file over and over while --query-clients sessions run queries,
+printing the requests per second and tail latencies of every endpoint.
+
+--preview-memory instead compares the memory taken by the UI formatted
+data of a whole CSV file (the generated one, or --csv) kept as lists of
+Python objects and kept in a preview.CompactTable, each built in a fresh
+process so their peak RSS can be compared. It doesn't need a database.
+
+--compare instead runs before/after comparisons of changes to the hot
+paths on generated CSV files of each of --compare-rows rows, printing the
+seconds each path took, its rows per second and its speedup over the
+first path:
+
+- 'ui-format': the row by row conversion of query results and previews
+  that format_data_for_ui replaced, against format_data_for_ui
+- 'load' (needs the database): loading a table with DataFrame.to_sql,
+  against postgres.init_table's COPY FROM STDIN
+- 'infer': infer.TypeInferrer scanning every row, against sampling
+  --sample-rows rows
+- 'validate': checking an upload in a subprocess and polling for its
+  result file (as the external CSV Checker was run), against
+  validate.find_csv_error in-process
+- 'formats': encoding a file's UI data as per-row JSON, against
+  column-oriented JSON and an Arrow IPC stream (if pyarrow is installed),
+  also printing the size of each encoding
+- 'serialize': encoding a file's UI data as per-row JSON with Flask's
+  jsonify, against the json module and orjson (if installed) backends of
+  response_data.iter_json, and gzip at zlib levels 1 and 6, also printing
+  the bytes sent
+
+Results can be saved as a baseline and later runs compared against it;
+the run fails if an endpoint got slower than the baseline by more than
+the tolerance.
+
+Run from the server directory, e.g.:
+
+    python benchmark.py --rows 100000 --columns 20 --concurrency 1,4 --save-baseline baseline.json
+    python benchmark.py --rows 100000 --columns 20 --concurrency 1,4 --baseline baseline.json
+    python benchmark.py --rows 5000000 --load-workers 1,2,4,8 --stages initializeTable
+    python benchmark.py --query-validation --fuzz-cases 100000
+    python benchmark.py --mixed-load --rows 200000 --ingest-clients 2 --query-clients 8 --server-threads 16
+    python benchmark.py --preview-memory --csv /path/to/1gb.csv
+    python benchmark.py --compare ui-format --compare-rows 10000,100000,1000000 --columns 3
+    python benchmark.py --compare load --compare-rows 100000,1000000
+"""
+
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from json import dump, dumps, load, loads
+from multiprocessing import get_context
+from os import remove, sysconf
+from os.path import exists, getsize, join
+from random import Random
+from resource import RUSAGE_SELF, getrusage
+from shutil import rmtree
+from subprocess import run
+from sys import executable, exit
+from tempfile import mkdtemp
+from threading import Event, Thread
+from time import perf_counter, sleep
+from typing import Callable
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+from uuid import uuid4
+from numpy import bool_, float64, int64, percentile
+from pandas import DataFrame, concat, read_csv
+from flask import jsonify
+import cache
+import compression
+import parallel
+import response_data
+import uploads
+from data import format_data_for_ui, read_csv_chunks
+from postgres import init_table, pg_connect, pg_engine, quote_identifier
+from formats import pyarrow, rows_from_columns, to_arrow_stream, to_rows_json
+from infer import TypeInferrer
+from preview import CompactTable, object_memory
+from response_data import ResponseData, iter_json, orjson
+from serving import SERVER_THREADS, PooledWSGIServer
+from sessions import SCHEMA_PREFIX
+from sql import check_query, find_schema_error
+from validate import find_csv_error
+from server import app
+
+# Endpoints benchmarked, in the order they are called
+STAGES: list = ['loadcsv', 'initializeTable', 'executeQuery', 'downloadcsv']
+
+# Stages that are run (unmeasured) if a later stage is measured without them
+PREREQUISITE_STAGES: list = ['loadcsv', 'initializeTable']
+
+# Data type of generated columns -> function creating a value from a Random
+value_generators: dict = {
+    'int': lambda rng: str(rng.randint(-1000000, 1000000)),
+    'bigint': lambda rng: str(rng.randint(-2 ** 62, 2 ** 62)),
+    'float': lambda rng: f'{rng.uniform(-1e6, 1e6):.4f}',
+    'bool': lambda rng: rng.choice(('true', 'false')),
+    'date': lambda rng: (date(2000, 1, 1) + timedelta(days=rng.randint(0, 10000))).isoformat(),
+    'timestamp': lambda rng: (datetime(2000, 1, 1) + timedelta(seconds=rng.randint(0, 10 ** 9))).isoformat(' '),
+    'text': lambda rng: rng.choice(('alpha', 'beta gamma', '"delta, epsilon"', '"say ""hi"""', '"two\nlines"'))
+}
+
+# Queries the validator must accept
+valid_queries: list = [
+    'SELECT * FROM benchmark',
+    'select a, b from t where s = \'DROP TABLE x; from\'',
+    'SELECT "From", "select" FROM t -- a comment; DROP TABLE t',
+    'SELECT $$a;b$$, $tag$ \' $tag$ FROM t;',
+    '/* outer /* nested */ comment */ SELECT count(*) FROM t',
+    '(SELECT a FROM t) UNION (SELECT a FROM u)',
+    'SELECT a::text, E\'it\\\'s\', x.y FROM t x WHERE b IN (SELECT a, a FROM u)',
+    'WITH top AS (SELECT a FROM t ORDER BY a DESC LIMIT 10) SELECT a FROM top',
+    'SELECT length(comment), upper(name) FROM reviews',
+    'VALUES (1), (2)',
+    'SELECT 1'
+]
+
+# Queries the validator must reject
+unsafe_queries: list = [
+    'DELETE FROM t',
+    'update t set a = 1',
+    'SELECT 1; DROP TABLE t',
+    'WITH x AS (DELETE FROM t RETURNING *) SELECT * FROM x',
+    'WITH x AS MATERIALIZED (UPDATE t SET a = 1 RETURNING a) SELECT a FROM x',
+    'SELECT * INTO t2 FROM t',
+    'SELECT * FROM t FOR UPDATE',
+    'SELECT * FROM t FOR NO KEY UPDATE',
+    "SELECT pg_read_file('/etc/passwd')",
+    'SELECT "pg_read_file"(\'/etc/passwd\')',
+    'SELECT pg_catalog."PG_READ_FILE"(\'/etc/passwd\')',
+    'SELECT U&"\\0070g_read_file"(\'/etc/passwd\')',
+    'SELECT lo_get(1)',
+    'SELECT loread(lo_open(1, 262144), 100)',
+    'SELECT nspname FROM pg_namespace',
+    'SELECT * FROM information_schema.tables',
+    'SELECT g::oid::regnamespace FROM generate_series(1, 100000) g',
+    "SELECT table_to_xml('t', true, true, '')",
+    "SELECT query_to_xml('DELETE FROM t', true, true, '')",
+    'SELECT a, a FROM t',
+    'EXPLAIN ANALYZE DELETE FROM t',
+    "SELECT 'unterminated"
+]
+
+# Session schema the schema checks run in, and queries that it may and may not run
+VALIDATION_SCHEMA: str = 'csvt_' + '0' * 32
+own_schema_queries: list = [f'SELECT t.a FROM {VALIDATION_SCHEMA}.t', f'SELECT * FROM "{VALIDATION_SCHEMA}"."t"']
+other_schema_queries: list = [
+    'SELECT * FROM csvt_' + 'f' * 32 + '.t',
+    'SELECT * FROM "csvt_' + 'f' * 32 + '".t',
+    'SELECT * FROM csvt_meta.sessions',
+    'SELECT * FROM public.t'
+]
+
+# Characters inserted by the fuzzer, chosen for their meaning to the tokenizer
+FUZZ_CHARACTERS: str = '\'"$;()/*-\\ \nEe0'
+
+# Numpy type -> Python type, as the row by row conversion cast values (see legacy_ui_rows)
+numpy_to_type_lookup: dict = {int64: int, float64: float, bool_: bool}
+
+# Stand-in for the external CSV Checker that uploads were validated with: a script that checks
+# that every row of a CSV file has as many fields, and writes the result to a CSV file
+SUBPROCESS_CHECKER: str = '''
+import csv, sys
+with open(sys.argv[1], newline='', encoding='utf-8') as csv_file:
+    widths = {len(row) for row in csv.reader(csv_file) if row}
+with open(sys.argv[2], 'w') as result_file:
+    result_file.write('boolean\\n' + str(len(widths) == 1) + '\\n')
+'''
+
+# Seconds between RSS samples while a stage runs
+RSS_SAMPLE_SECONDS: float = 0.01
+
+
+class RSSSampler:
+    """
+    Samples the resident set size of this process in a background thread,
+    to find the peak RSS while a stage runs. Falls back to the lifetime peak
+    (getrusage) where /proc isn't available. Processes of the parallel load's
+    parse pool are not included.
+    """
+
+    def __init__(self):
+        self.peak: int = 0
+        self.stop_requested = Event()
+        self.thread = Thread(target=self.sample, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop_requested.set()
+        self.thread.join()
+
+    def sample(self):
+        """
+        Records the RSS every RSS_SAMPLE_SECONDS until stopped.
+        """
+
+        while True:
+            self.peak = max(self.peak, current_rss())
+            if self.stop_requested.wait(RSS_SAMPLE_SECONDS):
+                break
+
+
+def current_rss() -> int:
+    """
+    Returns the resident set size of this process.
+
+    Returns:
+        int: RSS in bytes
+    """
+
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return getrusage(RUSAGE_SELF).ru_maxrss * 1024
+
+
+def parse_type_mix(type_mix: str) -> list:
+    """
+    Parses a type mix such as 'int=2,float=1,text=1' into the data types
+    of generated columns, in proportion to their weights.
+
+    Args:
+        type_mix (str): comma separated type=weight pairs
+
+    Returns:
+        list: data types to cycle through when generating columns
+    """
+
+    types: list = []
+    for item in type_mix.split(','):
+        data_type, _, weight = item.partition('=')
+        if data_type not in value_generators:
+            raise ValueError(f'Unknown column type "{data_type}"')
+        types += [data_type] * int(weight or 1)
+    return types
+
+
+def generate_csv(filepath: str, rows: int, columns: int, types: list, null_ratio: float, seed: int):
+    """
+    Writes a synthetic CSV file with a header row.
+
+    Args:
+        filepath (str): path of the file to write
+        rows (int): number of data rows
+        columns (int): number of columns
+        types (list): data types to cycle through for the columns (see parse_type_mix)
+        null_ratio (float): fraction of values left empty
+        seed (int): random seed, so the same arguments always give the same file
+    """
+
+    rng = Random(seed)
+    column_types: list = [types[col_idx % len(types)] for col_idx in range(columns)]
+    generators: list = [value_generators[data_type] for data_type in column_types]
+
+    with open(filepath, 'w', encoding='utf-8', newline='') as csv_file:
+        csv_file.write(','.join(f'{data_type}_{col_idx}' for col_idx, data_type in enumerate(column_types)) + '\n')
+        for _ in range(rows):
+            csv_file.write(','.join('' if rng.random() < null_ratio else generate(rng) for generate in generators) + '\n')
+
+
+def run_stage(stage: str, sessions: list, args: Namespace) -> dict:
+    """
+    Calls an endpoint for every session at once (each from its own thread
+    and test client), args.repeat times per session.
+
+    Args:
+        stage (str): endpoint to call (one of STAGES)
+        sessions (list): state of each session (see call_endpoint)
+        args (Namespace): command line arguments
+
+    Returns:
+        dict: latency percentiles, throughput and peak RSS of the stage
+    """
+
+    def run_session(session: dict) -> list:
+        client = app.test_client()
+        return [call_endpoint(client, stage, session, args) for _ in range(args.repeat)]
+
+    start: float = perf_counter()
+    with RSSSampler() as rss, ThreadPoolExecutor(max_workers=len(sessions)) as pool:
+        latencies: list = [latency for session_latencies in pool.map(run_session, sessions)
+                           for latency in session_latencies]
+    seconds: float = perf_counter() - start
+
+    calls: int = len(latencies)
+    return {
+        'calls': calls,
+        'p50': float(percentile(latencies, 50)),
+        'p90': float(percentile(latencies, 90)),
+        'p99': float(percentile(latencies, 99)),
+        'mean': sum(latencies) / calls,
+        'rowsPerSec': args.rows * calls / seconds,
+        'mbPerSec': args.file_bytes * calls / seconds / 1e6,
+        'peakRssMb': rss.peak / 1e6
+    }
+
+
+def call_endpoint(client, stage: str, session: dict, args: Namespace) -> float:
+    """
+    Calls an endpoint once for a session and checks that it succeeded.
+    /loadcsv stores the session and upload IDs in the session state,
+    for the later endpoints to use.
+
+    Args:
+        client: Flask test client
+        stage (str): endpoint to call (one of STAGES)
+        session (dict): state of the session
+        args (Namespace): command line arguments
+
+    Returns:
+        float: latency of the call in seconds (including reading the whole response)
+    """
+
+    start: float = perf_counter()
+
+    if stage == 'loadcsv':
+        with open(args.csv_path, 'rb') as csv_file:
+            response = client.post('/loadcsv', content_type='multipart/form-data', data={
+                'HasHeader': 'true',
+                'SessionId': session.get('sessionId', ''),
+                'File': (csv_file, 'benchmark.csv')
+            })
+    elif stage == 'initializeTable':
+        response = client.post('/initializeTable', json={
+            'sessionId': session['sessionId'],
+            'uploadId': session['uploadId'],
+            'tableName': args.table,
+            'columnsToDelete': [],
+            'columnDataTypes': session['columnTypes']
+        })
+    elif stage == 'executeQuery':
+        response = client.post('/executeQuery', json={
+            'sessionId': session['sessionId'],
+            'query': args.query.format(table=args.table)
+        })
+    else:
+        response = client.post('/downloadcsv', json={
+            'sessionId': session['sessionId'],
+            'query': args.query.format(table=args.table),
+            'tableName': args.table
+        })
+
+    body: bytes = response.get_data()
+    latency: float = perf_counter() - start
+
+    if response.status_code != 200:
+        raise RuntimeError(f'/{stage} failed with status {response.status_code}: {body[:500]!r}')
+
+    if stage == 'loadcsv':
+        data: dict = response.get_json()['data']
+        args.upload_schemas.add(SCHEMA_PREFIX + data['sessionId'])
+        session.update(sessionId=data['sessionId'], uploadId=data['uploadId'], columnTypes=data['columnTypes'])
+
+    return latency
+
+
+def run_benchmark(args: Namespace) -> dict:
+    """
+    Runs every stage at each concurrency level, and the load scaling
+    benchmark if load worker counts were given.
+
+    Args:
+        args (Namespace): command line arguments
+
+    Returns:
+        dict: results by concurrency level ('c<level>') and stage,
+              and by number of load workers ('workers<count>')
+    """
+
+    results: dict = {}
+    sessions: list = []
+
+    try:
+        for concurrency in args.concurrency:
+            sessions = [{} for _ in range(concurrency)]
+            level_results: dict = {}
+            results[f'c{concurrency}'] = level_results
+
+            for stage_idx, stage in enumerate(STAGES):
+                if stage in args.stages:
+                    level_results[stage] = run_stage(stage, sessions, args)
+                    print_stage(f'c{concurrency}', stage, level_results[stage])
+                elif stage in PREREQUISITE_STAGES and set(args.stages) & set(STAGES[stage_idx + 1:]):
+                    # Later stages need an upload and a table, even if they aren't measured
+                    run_stage(stage, sessions, Namespace(**{**vars(args), 'repeat': 1}))
+
+        for workers in args.load_workers:
+            # A single session, so only the load workers run in parallel
+            parallel.PARALLEL_LOAD_WORKERS = workers
+            parallel.PARALLEL_LOAD_MIN_BYTES = 0
+            parallel.shutdown_parse_pool()
+
+            sessions = [{}]
+            run_stage('loadcsv', sessions, Namespace(**{**vars(args), 'repeat': 1}))
+            results[f'workers{workers}'] = {'initializeTable': run_stage('initializeTable', sessions, args)}
+            print_stage(f'workers{workers}', 'initializeTable', results[f'workers{workers}']['initializeTable'])
+    finally:
+        parallel.shutdown_parse_pool()
+
+    return results
+
+
+def print_stage(run: str, stage: str, stage_results: dict):
+    """
+    Prints the results of a stage.
+
+    Args:
+        run (str): concurrency level or number of load workers
+        stage (str): endpoint
+        stage_results (dict): results of the stage (see run_stage)
+    """
+
+    print(f'{run:>10} {stage:<16} p50 {stage_results["p50"] * 1000:9.1f} ms  p90 {stage_results["p90"] * 1000:9.1f} ms  '
+          f'p99 {stage_results["p99"] * 1000:9.1f} ms  {stage_results["rowsPerSec"]:12.0f} rows/s  '
+          f'{stage_results["mbPerSec"]:8.2f} MB/s  peak RSS {stage_results["peakRssMb"]:8.1f} MB')
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Compares results with a baseline. A stage has regressed if its p50 or
+    p90 latency grew, or its throughput shrank, by more than the tolerance.
+    Stages missing from either run are skipped.
+
+    Args:
+        results (dict): results of this run (see run_benchmark)
+        baseline (dict): results of the baseline run
+        tolerance (float): allowed relative change, e.g. 0.1 for 10%
+
+    Returns:
+        list: a description of every regression
+    """
+
+    regressions: list = []
+
+    for run, stages in results.items():
+        for stage, stage_results in stages.items():
+            base: dict = baseline.get(run, {}).get(stage)
+            if base is None:
+                continue
+
+            for metric in ('p50', 'p90'):
+                if stage_results[metric] > base[metric] * (1 + tolerance):
+                    regressions.append(f'{run} {stage}: {metric} {base[metric] * 1000:.1f} ms -> '
+                                       f'{stage_results[metric] * 1000:.1f} ms')
+            if stage_results['rowsPerSec'] < base['rowsPerSec'] * (1 - tolerance):
+                regressions.append(f'{run} {stage}: throughput {base["rowsPerSec"]:.0f} -> '
+                                   f'{stage_results["rowsPerSec"]:.0f} rows/s')
+
+    return regressions
+
+
+def benchmark_query_validation(args: Namespace) -> dict:
+    """
+    Fuzzes and times the query validator. Every corpus query must get the
+    expected verdict, and args.fuzz_cases mutations of them (characters
+    inserted, deleted or duplicated) must be checked without check_query
+    raising, and the normalized text of those that are accepted must be
+    accepted and normalize the same.
+
+    Args:
+        args (Namespace): command line arguments
+
+    Returns:
+        dict: microseconds per cold (uncached) and cached check
+    """
+
+    for query in valid_queries:
+        if check_query(query).error:
+            raise AssertionError(f'Valid query rejected: {query!r} ({check_query(query).error})')
+    for query in unsafe_queries:
+        if not check_query(query).error:
+            raise AssertionError(f'Unsafe query accepted: {query!r}')
+    for query in own_schema_queries:
+        if check_query(query).error or find_schema_error(check_query(query), VALIDATION_SCHEMA):
+            raise AssertionError(f'Query of the session\'s schema rejected: {query!r}')
+    for query in other_schema_queries:
+        if not find_schema_error(check_query(query), VALIDATION_SCHEMA):
+            raise AssertionError(f'Query of another schema accepted: {query!r}')
+
+    rng = Random(args.seed)
+    corpus: list = valid_queries + unsafe_queries
+    cases: set = set()
+    while len(cases) < args.fuzz_cases:
+        query: str = rng.choice(corpus)
+        for _ in range(rng.randint(1, 3)):
+            pos: int = rng.randint(0, len(query))
+            mutation: int = rng.randint(0, 2)
+            if mutation == 0:
+                query = query[:pos] + rng.choice(FUZZ_CHARACTERS) + query[pos:]
+            elif mutation == 1:
+                query = query[:pos] + query[pos + 1:]
+            else:
+                query = query[:pos] + query[pos:pos + rng.randint(1, 8)] + query[pos:]
+        cases.add(query)
+
+    cases = cases - set(corpus)
+    start: float = perf_counter()
+    checked: list = [check_query(query) for query in cases]
+    cold: float = (perf_counter() - start) / len(cases)
+
+    # Normalizing an accepted query must give a query that is accepted and normalizes the same
+    for query, checked_query in zip(cases, checked):
+        if not checked_query.error:
+            renormalized = check_query(checked_query.normalized)
+            if renormalized.error or renormalized.normalized != checked_query.normalized:
+                raise AssertionError(f'Normalizing changed the meaning of {query!r}')
+
+    sample: list = list(cases)[:1000]
+    for query in sample:
+        check_query(query)
+    start = perf_counter()
+    for _ in range(10):
+        for query in sample:
+            check_query(query)
+    cached: float = (perf_counter() - start) / (10 * len(sample))
+
+    accepted: int = sum(1 for checked_query in checked if not checked_query.error)
+    print(f'Checked {len(cases)} fuzzed queries ({accepted} accepted): '
+          f'{cold * 1e6:.1f} us per check, {cached * 1e6:.2f} us per cached check')
+    return {'coldMicroseconds': cold * 1e6, 'cachedMicroseconds': cached * 1e6}
+
+
+def post_http(url: str, body: bytes, content_type: str) -> tuple:
+    """
+    Sends a POST request over HTTP and reads the whole response.
+
+    Args:
+        url (str): URL to post to
+        body (bytes): request body
+        content_type (str): media type of the body
+
+    Returns:
+        tuple: status code, response body and latency in seconds
+    """
+
+    start: float = perf_counter()
+    try:
+        with urlopen(Request(url, data=body, headers={'Content-Type': content_type})) as response:
+            status, response_body = response.status, response.read()
+    except HTTPError as http_err:
+        status, response_body = http_err.code, http_err.read()
+    return status, response_body, perf_counter() - start
+
+
+def call_http_endpoint(base_url: str, stage: str, session: dict, args: Namespace) -> tuple:
+    """
+    Calls an endpoint over HTTP for a session, like call_endpoint does
+    through the test client.
+
+    Args:
+        base_url (str): URL of the server
+        stage (str): 'loadcsv', 'initializeTable' or 'executeQuery'
+        session (dict): state of the session (see call_endpoint)
+        args (Namespace): command line arguments
+
+    Returns:
+        tuple: whether the call succeeded and its latency in seconds
+    """
+
+    if stage == 'loadcsv':
+        boundary: str = uuid4().hex
+        with open(args.csv_path, 'rb') as csv_file:
+            body: bytes = b''.join([
+                f'--{boundary}\r\nContent-Disposition: form-data; name="HasHeader"\r\n\r\ntrue\r\n'.encode(),
+                f'--{boundary}\r\nContent-Disposition: form-data; name="SessionId"\r\n\r\n'
+                f'{session.get("sessionId", "")}\r\n'.encode(),
+                f'--{boundary}\r\nContent-Disposition: form-data; name="File"; filename="benchmark.csv"\r\n'
+                f'Content-Type: text/csv\r\n\r\n'.encode(),
+                csv_file.read(),
+                f'\r\n--{boundary}--\r\n'.encode()])
+        status, response_body, latency = post_http(f'{base_url}/loadcsv', body,
+                                                   f'multipart/form-data; boundary={boundary}')
+    elif stage == 'initializeTable':
+        status, response_body, latency = post_http(f'{base_url}/initializeTable', dumps({
+            'sessionId': session['sessionId'],
+            'uploadId': session['uploadId'],
+            'tableName': session['table'],
+            'columnsToDelete': [],
+            'columnDataTypes': session['columnTypes']
+        }).encode(), 'application/json')
+    else:
+        status, response_body, latency = post_http(f'{base_url}/executeQuery', dumps({
+            'sessionId': session['sessionId'],
+            'query': args.query.format(table=session['table'])
+        }).encode(), 'application/json')
+
+    if status != 200:
+        print(f'/{stage} failed with status {status}: {response_body[:200]!r}')
+        return False, latency
+
+    if stage == 'loadcsv':
+        data: dict = loads(response_body)['data']
+        session.update(sessionId=data['sessionId'], uploadId=data['uploadId'], columnTypes=data['columnTypes'])
+        if not args.url:
+            args.upload_schemas.add(SCHEMA_PREFIX + data['sessionId'])
+
+    return True, latency
+
+
+def run_mixed_load(args: Namespace) -> dict:
+    """
+    Runs ingest and query traffic at the same time over HTTP for
+    args.duration seconds. Every session first uploads the CSV file and
+    loads it into its own table; then ingest sessions keep uploading and
+    reloading the file (/loadcsv and /initializeTable) while query sessions
+    keep running args.query on their table (/executeQuery). Unless
+    args.url is given, the app is served in this process by a
+    PooledWSGIServer with args.server_threads threads.
+
+    Args:
+        args (Namespace): command line arguments
+
+    Returns:
+        dict: requests, failures, requests per second and latency percentiles of every endpoint
+    """
+
+    server: PooledWSGIServer = None
+    base_url: str = args.url.rstrip('/') if args.url else ''
+    if not base_url:
+        server = PooledWSGIServer('127.0.0.1', 0, app, args.server_threads)
+        Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.port}'
+
+    sessions: list = [{'kind': 'ingest', 'table': f'{args.table}_ingest'} for _ in range(args.ingest_clients)] + \
+                     [{'kind': 'query', 'table': args.table} for _ in range(args.query_clients)]
+    # Endpoint -> (succeeded, latency) of every call
+    calls: dict = {'loadcsv': [], 'initializeTable': [], 'executeQuery': []}
+
+    def run_session(session: dict, deadline: float):
+        stages: list = ['loadcsv', 'initializeTable'] if session['kind'] == 'ingest' else ['executeQuery']
+        while perf_counter() < deadline:
+            for stage in stages:
+                calls[stage].append(call_http_endpoint(base_url, stage, session, args))
+
+    try:
+        # Every session needs an upload and a table before the traffic starts
+        for session in sessions:
+            for stage in ('loadcsv', 'initializeTable'):
+                if not call_http_endpoint(base_url, stage, session, args)[0]:
+                    raise RuntimeError(f'Failed to set up a session with /{stage}')
+
+        start: float = perf_counter()
+        with RSSSampler() as rss, ThreadPoolExecutor(max_workers=len(sessions)) as pool:
+            list(pool.map(run_session, sessions, [start + args.duration] * len(sessions)))
+        seconds: float = perf_counter() - start
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    results: dict = {}
+    for stage, stage_calls in calls.items():
+        if not stage_calls:
+            continue
+        stage_latencies: list = [latency for _, latency in stage_calls]
+        results[stage] = {
+            'requests': len(stage_latencies),
+            'failures': sum(1 for succeeded, _ in stage_calls if not succeeded),
+            'reqPerSec': len(stage_latencies) / seconds,
+            'p50': float(percentile(stage_latencies, 50)),
+            'p95': float(percentile(stage_latencies, 95)),
+            'p99': float(percentile(stage_latencies, 99)),
+            'max': max(stage_latencies)
+        }
+        print(f'{stage:<16} {len(stage_latencies):6d} requests ({results[stage]["failures"]} failed)  '
+              f'{results[stage]["reqPerSec"]:8.2f} req/s  p50 {results[stage]["p50"] * 1000:9.1f} ms  '
+              f'p95 {results[stage]["p95"] * 1000:9.1f} ms  p99 {results[stage]["p99"] * 1000:9.1f} ms  '
+              f'max {results[stage]["max"] * 1000:9.1f} ms')
+
+    total: int = sum(len(stage_calls) for stage_calls in calls.values())
+    print(f'{total} requests in {seconds:.1f} s ({total / seconds:.2f} req/s), '
+          f'peak RSS of this process {rss.peak / 1e6:.1f} MB')
+    return results
+
+
+def measure_preview_memory(representation: str, csv_path: str) -> dict:
+    """
+    Reads a CSV file chunk by chunk into UI formatted data (see
+    data.format_data_for_ui), kept either as lists of Python objects
+    ('objects', as UI data is sent) or in a CompactTable ('compact').
+    Run in a fresh process, so its peak RSS is that of one representation.
+
+    Args:
+        representation (str): 'objects' or 'compact'
+        csv_path (str): path to the CSV file (with a header row)
+
+    Returns:
+        dict: RSS before reading, peak RSS, seconds taken, and bytes per column
+    """
+
+    base_rss: int = current_rss()
+    res_data = ResponseData()
+    start: float = perf_counter()
+
+    with RSSSampler() as sampler:
+        if representation == 'objects':
+            column_data: dict = {}
+            for df in read_csv_chunks(csv_path, True, res_data):
+                for name, values in format_data_for_ui(df, True)['columnData'].items():
+                    column_data.setdefault(name, []).extend(values)
+            column_memory: dict = {name: object_memory(values) for name, values in column_data.items()}
+        else:
+            table = CompactTable()
+            for df in read_csv_chunks(csv_path, True, res_data):
+                table.append(format_data_for_ui(df, True)['columnData'])
+            column_memory = table.column_memory()
+
+    if not res_data.success:
+        raise RuntimeError(f'Failed to read {csv_path}')
+
+    return {
+        'baseRss': base_rss,
+        'peakRss': max(sampler.peak, getrusage(RUSAGE_SELF).ru_maxrss * 1024),
+        'seconds': perf_counter() - start,
+        'columnMemory': column_memory
+    }
+
+
+def benchmark_preview_memory(csv_path: str) -> dict:
+    """
+    Measures the memory of both preview representations of a CSV file
+    (see measure_preview_memory), each in its own spawned process.
+
+    Args:
+        csv_path (str): path to the CSV file (with a header row)
+
+    Returns:
+        dict: representation -> results of measure_preview_memory
+    """
+
+    results: dict = {}
+    for representation in ('objects', 'compact'):
+        with get_context('spawn').Pool(1) as pool:
+            results[representation] = pool.apply(measure_preview_memory, (representation, csv_path))
+
+        measured: dict = results[representation]
+        print(f'{representation:>8}: peak RSS {measured["peakRss"] / 1e6:.1f} MB '
+              f'(base {measured["baseRss"] / 1e6:.1f} MB), {sum(measured["columnMemory"].values()) / 1e6:.1f} MB '
+              f'of columns, {measured["seconds"]:.2f} s')
+
+    print(f'{"column":>24} {"objects MB":>12} {"compact MB":>12}')
+    for name, size in results['objects']['columnMemory'].items():
+        print(f'{name[:24]:>24} {size / 1e6:12.2f} {results["compact"]["columnMemory"][name] / 1e6:12.2f}')
+    return results
+
+
+def time_call(function: Callable, *args) -> dict:
+    """
+    Times a call.
+
+    Args:
+        function (Callable): function to call
+        *args: arguments to call it with
+
+    Returns:
+        dict: 'seconds' the call took, and the 'bytes' it returned if it returned bytes
+    """
+
+    start: float = perf_counter()
+    result = function(*args)
+    measured: dict = {'seconds': perf_counter() - start}
+    if isinstance(result, bytes):
+        measured['bytes'] = len(result)
+    return measured
+
+
+def read_whole_csv(csv_path: str) -> DataFrame:
+    """
+    Reads a CSV file (with a header row) into one DataFrame, the way
+    uploads are read (see data.read_csv_chunks).
+
+    Args:
+        csv_path (str): path to the CSV file
+
+    Returns:
+        DataFrame: the file's rows
+    """
+
+    res_data = ResponseData()
+    df: DataFrame = concat(read_csv_chunks(csv_path, True, res_data), ignore_index=True)
+    if not res_data.success:
+        raise RuntimeError(f'Failed to read {csv_path}')
+    return df
+
+
+def legacy_ui_rows(df: DataFrame) -> list:
+    """
+    The row by row conversion that format_data_for_ui replaced: walks every
+    row with DataFrame.iterrows() and casts every value to the type of its
+    column's first value. The type is taken from the first non-missing
+    value here, since the original failed on columns starting with a
+    missing value.
+
+    Args:
+        df (DataFrame): data to convert
+
+    Returns:
+        list: one dictionary per row, with an 'id'
+    """
+
+    column_types: list = []
+    for _, column in df.items():
+        first = column.dropna().iloc[0] if column.notna().any() else ''
+        column_types.append(numpy_to_type_lookup.get(type(first), type(first)))
+
+    ui_rows: list = []
+    for row_idx, df_row in df.iterrows():
+        ui_row: dict = {'id': int(row_idx)}
+        for col_idx, col_name in enumerate(df.columns):
+            ui_row[col_name] = column_types[col_idx](df_row[col_name])
+        ui_rows.append(ui_row)
+    return ui_rows
+
+
+def compare_ui_format(csv_path: str, args: Namespace) -> dict:
+    """
+    Compares building the rows of UI formatted data row by row (see
+    legacy_ui_rows) with format_data_for_ui's whole column conversion
+    (zipped into rows, as application/json sends them). Doesn't need a
+    database.
+
+    Args:
+        csv_path (str): path to the CSV file
+        args (Namespace): command line arguments
+
+    Returns:
+        dict: measurements of each path (see time_call)
+    """
+
+    df: DataFrame = read_whole_csv(csv_path)
+    return {
+        'rowLoop': time_call(legacy_ui_rows, df),
+        'columns': time_call(lambda: rows_from_columns(format_data_for_ui(df.copy(), True)['columnData']))
+    }
+
+
+def compare_load(csv_path: str, args: Namespace) -> dict:
+    """
+    Compares loading a CSV file into a table with DataFrame.to_sql (row by
+    row INSERTs, as tables were loaded before COPY) with postgres.init_table
+    (COPY FROM STDIN). Both load into a new schema of their own, which is
+    dropped afterwards. Needs the database.
+
+    Args:
+        csv_path (str): path to the CSV file (the generated columns are named after their type)
+        args (Namespace): command line arguments
+
+    Returns:
+        dict: measurements of each path (see time_call)
+    """
+
+    schema: str = f'csvt_{uuid4().hex}'
+    df: DataFrame = read_whole_csv(csv_path)
+    column_types: dict = {name: name.rpartition('_')[0] for name in df.columns}
+
+    def copy_load():
+        res_data = ResponseData()
+        init_table(read_csv_chunks(csv_path, True, res_data, as_text=True), 'compare_copy', column_types,
+                   schema, res_data)
+        if not res_data.success:
+            raise RuntimeError(f'Failed to load {csv_path}: {res_data.error}')
+
+    try:
+        # init_table creates the schema, so it goes first
+        copy_timing: dict = time_call(copy_load)
+        to_sql_timing: dict = time_call(
+            lambda: df.to_sql('compare_to_sql', pg_engine(), schema=schema, if_exists='replace', index=False))
+    finally:
+        with pg_connect() as conn:
+            with conn.begin():
+                conn.execute(f'DROP SCHEMA IF EXISTS {quote_identifier(schema)} CASCADE')
+
+    return {'toSql': to_sql_timing, 'copy': copy_timing}
+
+
+def compare_infer(csv_path: str, args: Namespace) -> dict:
+    """
+    Compares inferring the column types of a CSV file with a TypeInferrer
+    scanning every row and one sampling args.sample_rows rows. The file is
+    read as text, as /loadcsv reads it for inference, before timing, so
+    only the inference is timed. Doesn't need a database.
+
+    Args:
+        csv_path (str): path to the CSV file
+        args (Namespace): command line arguments
+
+    Returns:
+        dict: measurements of each path (see time_call)
+    """
+
+    res_data = ResponseData()
+    chunks: list = list(read_csv_chunks(csv_path, True, res_data, as_text=True))
+    if not res_data.success:
+        raise RuntimeError(f'Failed to read {csv_path}')
+
+    def infer(sample_rows: int):
+        type_inferrer = TypeInferrer(sample_rows)
+        for chunk in chunks:
+            type_inferrer.update(chunk)
+        type_inferrer.column_types()
+
+    return {
+        'fullScan': time_call(infer, 0),
+        'sample': time_call(infer, args.sample_rows)
+    }
+
+
+def legacy_validate_csv(csv_path: str) -> bool:
+    """
+    Validates a CSV file the way uploads were validated before
+    validate.find_csv_error: runs a checker script (SUBPROCESS_CHECKER) in
+    a subprocess, polls every millisecond (for up to 2 seconds) for the
+    result file, then reads the result from it with pandas.
+
+    Args:
+        csv_path (str): path to the CSV file
+
+    Returns:
+        bool: True if the CSV file is valid, else False
+    """
+
+    result_path: str = f'{csv_path[:-4]}OutputResult.csv'
+    run([executable, '-c', SUBPROCESS_CHECKER, csv_path, result_path])
+
+    start: float = perf_counter()
+    while not exists(result_path) and perf_counter() - start < 2:
+        sleep(0.001)
+
+    result: DataFrame = read_csv(result_path)
+    remove(result_path)
+    return bool(result['boolean'].loc[0])
+
+
+def compare_validate(csv_path: str, args: Namespace) -> dict:
+    """
+    Compares validating a CSV file in a subprocess (see legacy_validate_csv)
+    with validate.find_csv_error. Doesn't need a database.
+
+    Args:
+        csv_path (str): path to the CSV file
+        args (Namespace): command line arguments
+
+    Returns:
+        dict: measurements of each path (see time_call)
+    """
+
+    return {
+        'subprocess': time_call(legacy_validate_csv, csv_path),
+        'inProcess': time_call(find_csv_error, csv_path)
+    }
+
+
+def compare_formats(csv_path: str, args: Namespace) -> dict:
+    """
+    Compares encoding the UI formatted data of a CSV file (in a response
+    dictionary) in each wire format of the formats module: per-row JSON,
+    column-oriented JSON and, if pyarrow is installed, an Arrow IPC stream.
+    Doesn't need a database.
+
+    Args:
+        csv_path (str): path to the CSV file
+        args (Namespace): command line arguments
+
+    Returns:
+        dict: measurements of each path (see time_call)
+    """
+
+    res_data = ResponseData()
+    res_data.set_data(format_data_for_ui(read_whole_csv(csv_path), True))
+    res: dict = res_data.get_response_dict()
+
+    measured: dict = {
+        'rowsJson': time_call(lambda: b''.join(iter_json(to_rows_json(res)))),
+        'columnsJson': time_call(lambda: b''.join(iter_json(res)))
+    }
+    if pyarrow is not None:
+        measured['arrow'] = time_call(to_arrow_stream, res)
+    return measured
+
+
+def compare_serialize(csv_path: str, args: Namespace) -> dict:
+    """
+    Compares serializing the UI formatted data of a CSV file as per-row
+    JSON (the default format) with Flask's jsonify (as responses were sent
+    before) and with response_data.iter_json using the json module and
+    orjson backends, then compressing the fastest backend's output with
+    gzip (see compression.compress_chunks) at zlib levels 1 and 6.
+    Doesn't need a database.
+
+    Args:
+        csv_path (str): path to the CSV file
+        args (Namespace): command line arguments
+
+    Returns:
+        dict: measurements of each path (see time_call)
+    """
+
+    res_data = ResponseData()
+    res_data.set_data(format_data_for_ui(read_whole_csv(csv_path), True))
+    res: dict = to_rows_json(res_data.get_response_dict())
+
+    def jsonify_response() -> bytes:
+        with app.app_context():
+            return jsonify(res).get_data()
+
+    backends: list = ['json'] + (['orjson'] if orjson is not None else [])
+    json_backend: str = response_data.JSON_BACKEND
+    compression_level: int = compression.COMPRESSION_LEVEL
+    measured: dict = {'jsonify': time_call(jsonify_response)}
+    try:
+        for backend in backends:
+            response_data.JSON_BACKEND = backend
+            measured[backend] = time_call(lambda: b''.join(iter_json(res)))
+        for level in (1, 6):
+            compression.COMPRESSION_LEVEL = level
+            measured[f'{backends[-1]}+gzip{level}'] = time_call(
+                lambda: b''.join(compression.compress_chunks(iter_json(res), 'gzip')))
+    finally:
+        response_data.JSON_BACKEND = json_backend
+        compression.COMPRESSION_LEVEL = compression_level
+
+    return measured
+
+
+# Comparison name -> function measuring the paths it compares on a CSV file (see run_comparisons)
+COMPARISONS: dict = {
+    'ui-format': compare_ui_format,
+    'load': compare_load,
+    'infer': compare_infer,
+    'validate': compare_validate,
+    'formats': compare_formats,
+    'serialize': compare_serialize
+}
+
+
+def run_comparisons(args: Namespace) -> dict:
+    """
+    Runs the before/after comparisons in args.compare on a generated CSV
+    file of each of args.compare_rows rows.
+
+    Args:
+        args (Namespace): command line arguments
+
+    Returns:
+        dict: comparison -> rows -> path -> measurements (see time_call)
+    """
+
+    for name in args.compare:
+        if name not in COMPARISONS:
+            raise ValueError(f'Unknown comparison "{name}"')
+
+    results: dict = {}
+    temp_dir: str = mkdtemp(prefix='csvt_benchmark_')
+    try:
+        for rows in args.compare_rows:
+            csv_path: str = join(temp_dir, f'compare_{rows}.csv')
+            generate_csv(csv_path, rows, args.columns, parse_type_mix(args.types), args.null_ratio, args.seed)
+            for name in args.compare:
+                measured: dict = COMPARISONS[name](csv_path, args)
+                results.setdefault(name, {})[rows] = measured
+
+                first: float = next(iter(measured.values()))['seconds']
+                for path, path_measured in measured.items():
+                    seconds: float = path_measured['seconds']
+                    size: str = f'  {path_measured["bytes"] / 1e6:10.2f} MB' if 'bytes' in path_measured else ''
+                    print(f'{name:<12} {rows:>9} rows  {path:<14} {seconds:9.3f} s  {rows / seconds:12.0f} rows/s  '
+                          f'{first / seconds:7.2f}x{size}')
+            remove(csv_path)
+    finally:
+        rmtree(temp_dir, ignore_errors=True)
+
+    return results
+
+
+def parse_args() -> Namespace:
+    """
+    Parses the command line arguments.
+
+    Returns:
+        Namespace: command line arguments
+    """
+
+    def int_list(value: str) -> list:
+        return [int(item) for item in value.split(',') if item]
+
+    parser = ArgumentParser(description='Benchmark the CSV Transformer endpoints')
+    parser.add_argument('--rows', type=int, default=100000, help='rows in the generated CSV file')
+    parser.add_argument('--columns', type=int, default=20, help='columns in the generated CSV file')
+    parser.add_argument('--types', default='int=2,float=1,bool=1,date=1,timestamp=1,text=2',
+                        help='mix of column types, as type=weight pairs (types: ' + ', '.join(value_generators) + ')')
+    parser.add_argument('--null-ratio', type=float, default=0.05, help='fraction of empty values')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the generated data')
+    parser.add_argument('--concurrency', type=int_list, default=[1], help='comma separated concurrency levels')
+    parser.add_argument('--repeat', type=int, default=5, help='calls per session of each stage')
+    parser.add_argument('--stages', type=lambda value: value.split(','), default=STAGES,
+                        help='comma separated endpoints to measure (default: all)')
+    parser.add_argument('--query', default='SELECT * FROM {table}', help='query for /executeQuery and /downloadcsv')
+    parser.add_argument('--table', default='benchmark', help='name of the table loaded')
+    parser.add_argument('--load-workers', type=int_list, default=[],
+                        help='comma separated parallel load worker counts to measure /initializeTable with')
+    parser.add_argument('--warm', action='store_true',
+                        help='keep the upload parse cache and query result cache on (off by default, so '
+                             'repeated calls do the same work)')
+    parser.add_argument('--baseline', help='baseline results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown relative to the baseline')
+    parser.add_argument('--save-baseline', help='file to save the results to, as a baseline for later runs')
+    parser.add_argument('--query-validation', action='store_true',
+                        help='fuzz and time the query validator instead of the endpoints')
+    parser.add_argument('--fuzz-cases', type=int, default=20000, help='number of fuzzed queries to check')
+    parser.add_argument('--mixed-load', action='store_true',
+                        help='run ingest and query traffic at once over HTTP instead of timing endpoints one by one')
+    parser.add_argument('--url', help='server to send --mixed-load traffic to (default: serve the app in this process)')
+    parser.add_argument('--server-threads', type=int, default=SERVER_THREADS,
+                        help='request threads of the server started for --mixed-load')
+    parser.add_argument('--ingest-clients', type=int, default=1, help='sessions uploading and loading in --mixed-load')
+    parser.add_argument('--query-clients', type=int, default=4, help='sessions running queries in --mixed-load')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds of --mixed-load traffic')
+    parser.add_argument('--preview-memory', action='store_true',
+                        help='compare the memory of the preview representations instead of timing the endpoints')
+    parser.add_argument('--csv', help='CSV file (with a header row) for --preview-memory instead of a generated one')
+    parser.add_argument('--compare', type=lambda value: value.split(','), default=[],
+                        help='comma separated before/after comparisons to run instead of timing the endpoints ('
+                             + ', '.join(COMPARISONS) + ')')
+    parser.add_argument('--compare-rows', type=int_list, default=[10000, 100000, 1000000],
+                        help='comma separated row counts of the CSV files --compare runs on')
+    parser.add_argument('--sample-rows', type=int, default=10000, help='rows sampled by --compare infer')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Runs the benchmark from the command line.
+    """
+
+    args: Namespace = parse_args()
+    if args.query_validation:
+        benchmark_query_validation(args)
+        return
+    if args.preview_memory and args.csv:
+        benchmark_preview_memory(args.csv)
+        return
+    if args.compare:
+        run_comparisons(args)
+        return
+
+    for stage in args.stages:
+        if stage not in STAGES:
+            raise ValueError(f'Unknown stage "{stage}"')
+
+    if not args.warm:
+        uploads.UPLOAD_CACHE_ENTRIES = 0
+        cache.CACHE_MAX_ENTRY_BYTES = -1
+
+    args.upload_schemas = set()
+    temp_dir: str = mkdtemp(prefix='csvt_benchmark_')
+    args.csv_path = join(temp_dir, 'benchmark.csv')
+    generate_csv(args.csv_path, args.rows, args.columns, parse_type_mix(args.types), args.null_ratio, args.seed)
+    args.file_bytes = getsize(args.csv_path)
+    print(f'Generated {args.rows} rows x {args.columns} columns ({args.file_bytes / 1e6:.1f} MB)')
+    if args.preview_memory:
+        try:
+            benchmark_preview_memory(args.csv_path)
+        finally:
+            rmtree(temp_dir, ignore_errors=True)
+        return
+
+    config: dict = {key: value for key, value in vars(args).items()
+                    if key not in ('baseline', 'save_baseline', 'csv_path', 'upload_schemas', 'tolerance')}
+    try:
+        if args.mixed_load:
+            run_mixed_load(args)
+            return
+        results: dict = run_benchmark(args)
+    finally:
+        rmtree(temp_dir, ignore_errors=True)
+
+        # Delete the files uploaded by the benchmark's sessions
+        for schema in args.upload_schemas:
+            uploads.forget_uploads(schema)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            dump({'config': config, 'results': results}, baseline_file, indent=2)
+        print(f'Saved baseline to {args.save_baseline}')
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline: dict = load(baseline_file)
+        if baseline['config'] != config:
+            print('Warning: the baseline was run with different settings')
+
+        regressions: list = find_regressions(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            exit(1)
+        print(f'No regressions beyond {args.tolerance:.0%} of the baseline')
+
+
+if __name__ == '__main__':
+    main()
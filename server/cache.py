@@ -0,0 +1,181 @@
+"""
+cache.py:
+LRU cache of query results. Results are keyed by the session schema,
+the normalized query text (see sql.CheckedQuery) and the schema's table generation, a counter
+that is bumped every time a table is loaded into the schema, so a cached
+result is never served after its table has changed. Entries expire after
+CACHE_TTL_SECONDS, and the least recently used entries are evicted once
+the cached results take up more than CACHE_MAX_BYTES.
+"""
+
+from collections import OrderedDict
+from os import environ
+from threading import Lock
+from time import monotonic
+from pandas import DataFrame
+from sql import check_query
+
+# Total size of cached results, in bytes
+CACHE_MAX_BYTES: int = int(environ.get('CSVT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+# Results larger than this (in bytes) aren't cached
+CACHE_MAX_ENTRY_BYTES: int = int(environ.get('CSVT_CACHE_MAX_ENTRY_BYTES', 32 * 1024 * 1024))
+
+# Seconds a cached result may be served for
+CACHE_TTL_SECONDS: float = float(environ.get('CSVT_CACHE_TTL_SECONDS', 300))
+
+# Schema -> table generation; bumped on every table load into the schema
+_generations: dict = {}
+
+# (Schema, Normalized Query, Generation) -> (Result, Size in Bytes, Expiry Time)
+_entries: OrderedDict = OrderedDict()
+_cache_bytes: int = 0
+_cache_lock = Lock()
+
+# Cache metrics (see get_cache_metrics)
+cache_metrics: dict = {
+    'hits': 0,
+    'misses': 0,
+    'evictions': 0,
+    'expirations': 0
+}
+
+
+def bump_generation(schema: str):
+    """
+    Marks every cached result of a session schema as stale.
+    Called whenever a table is loaded into the schema.
+
+    Args:
+        schema (str): session schema
+    """
+
+    global _cache_bytes
+
+    with _cache_lock:
+        _generations[schema] = _generations.get(schema, 0) + 1
+
+        # Entries of older generations can never be hit again
+        for key in [key for key in _entries if key[0] == schema]:
+            _cache_bytes -= _entries.pop(key)[1]
+
+
+def cache_key(query: str, schema: str, generation: int = None) -> tuple:
+    """
+    Creates the cache key of a query. Must be called with _cache_lock held.
+
+    Args:
+        query (str): query
+        schema (str): session schema the query is executed in
+        generation (int): table generation the query read (default: the current one)
+
+    Returns:
+        tuple: cache key
+    """
+
+    return schema, check_query(query).normalized, _generations.get(schema, 0) if generation is None else generation
+
+
+def table_generation(schema: str) -> int:
+    """
+    Returns a session schema's table generation (see bump_generation).
+
+    Args:
+        schema (str): session schema
+
+    Returns:
+        int: table generation
+    """
+
+    with _cache_lock:
+        return _generations.get(schema, 0)
+
+
+def get_cached_result(query: str, schema: str) -> DataFrame:
+    """
+    Looks up the cached result of a query.
+
+    Args:
+        query (str): query to look up
+        schema (str): session schema the query is executed in
+
+    Returns:
+        DataFrame: the cached result, or None if it isn't cached
+    """
+
+    global _cache_bytes
+
+    with _cache_lock:
+        key: tuple = cache_key(query, schema)
+        entry: tuple = _entries.get(key)
+
+        if entry is not None and entry[2] < monotonic():
+            # Expired; drop it
+            del _entries[key]
+            _cache_bytes -= entry[1]
+            cache_metrics['expirations'] += 1
+            entry = None
+
+        if entry is None:
+            cache_metrics['misses'] += 1
+            return None
+
+        _entries.move_to_end(key)
+        cache_metrics['hits'] += 1
+        return entry[0]
+
+
+def cache_result(query: str, schema: str, result: DataFrame, generation: int):
+    """
+    Caches the result of a query, evicting the least recently used
+    results if needed to stay within CACHE_MAX_BYTES. Results larger
+    than CACHE_MAX_ENTRY_BYTES are not cached, and neither are results
+    of a generation that a table load has since made stale.
+
+    Args:
+        query (str): query that produced the result
+        schema (str): session schema the query was executed in
+        result (DataFrame): full query result
+        generation (int): table generation read before the query started (see table_generation),
+                          so a result read from a table that was loaded meanwhile isn't cached as fresh
+    """
+
+    global _cache_bytes
+
+    size: int = int(result.memory_usage(index=True, deep=True).sum())
+    if size > CACHE_MAX_ENTRY_BYTES:
+        return
+
+    with _cache_lock:
+        if generation != _generations.get(schema, 0):
+            return
+
+        key: tuple = cache_key(query, schema, generation)
+        old_entry: tuple = _entries.pop(key, None)
+        if old_entry is not None:
+            _cache_bytes -= old_entry[1]
+
+        _entries[key] = (result, size, monotonic() + CACHE_TTL_SECONDS)
+        _cache_bytes += size
+
+        while _cache_bytes > CACHE_MAX_BYTES:
+            _, (_, evicted_size, _) = _entries.popitem(last=False)
+            _cache_bytes -= evicted_size
+            cache_metrics['evictions'] += 1
+
+
+def get_cache_metrics() -> dict:
+    """
+    Returns the cache settings and metrics.
+
+    Returns:
+        dict: cache metrics
+    """
+
+    with _cache_lock:
+        return {
+            **cache_metrics,
+            'entries': len(_entries),
+            'bytes': _cache_bytes,
+            'maxBytes': CACHE_MAX_BYTES
+        }
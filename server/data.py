@@ -1,28 +1,61 @@
 """data.py: Data manipulation functions"""
 
-from csv import reader
-from pandas import DataFrame, read_csv
-from postgres import execute_query, init_table, write_query_to_csv
-from response_data import ResponseData
-from numpy import int64, float64
-
-# UI type text -> Python type
-text_to_type_lookup: dict = {
-    'int': int,
-    'float': float,
-    'text': str
+from os import environ, remove
+from os.path import exists
+from time import perf_counter
+from typing import Callable, Iterable, Iterator
+from pandas import DataFrame, RangeIndex, Series, read_csv, to_numeric
+from pandas.errors import EmptyDataError, ParserError
+from psycopg2 import Error as PGError
+from sqlalchemy.exc import SQLAlchemyError
+from postgres import (LOAD_MODES, QUERY_MAX_ROWS, QUERY_TIMEOUT_SECONDS, count_query_rows, execute_query_page,
+                      extract_sql_err, find_loaded_file, get_table_column_types, init_table, limit_query,
+                      merge_into_table, query_error_status, stream_query_rows, stream_query_to_csv)
+from response_data import STREAM_BATCH_ROWS, ResponseData, dumps_json
+from results import lookup_result, register_result
+from cache import bump_generation, cache_result, get_cached_result, table_generation
+from uploads import lookup_upload
+from parallel import load_csv_in_parallel, use_parallel_load
+from sql import CheckedQuery, check_query, find_schema_error
+from profiling import record_span, span, timed_chunks
+from infer import DATE, NON_NULL, TIMESTAMP, TypeInferrer, conversion_error_message, find_conversion_errors, type_flags
+
+# Text values accepted for bool columns (lower case) -> bool
+text_to_bool: dict = {
+    'true': True, 't': True, 'yes': True, 'y': True,
+    'false': False, 'f': False, 'no': False, 'n': False
 }
 
-# Numpy type -> Python type
-numpy_to_type_lookup: dict = {
-    int64: int,
-    float64: float
-}
+# Number of rows sent to the UI per page of query results
+PAGE_SIZE: int = 500
+
+# Largest page the UI may request
+MAX_PAGE_SIZE: int = 10000
+
+# Query results with at most this many rows are fetched in full and cached
+CACHE_MAX_ROWS: int = int(environ.get('CSVT_CACHE_MAX_ROWS', 10000))
+
+# Number of rows converted to CSV at a time when downloading a cached result
+DOWNLOAD_CHUNK_ROWS: int = 10000
+
+# Number of bytes read at a time when downloading an exported CSV file
+FILE_CHUNK_BYTES: int = 64 * 1024
+
+# Number of rows read from a CSV file at a time
+CSV_CHUNK_ROWS: int = 100000
+
+# Number of rows of an uploaded CSV file sent to the UI for preview
+PREVIEW_ROWS: int = PAGE_SIZE
+
+# Kinds of the dtypes whose Series.tolist() values are JSON types (bool, int, float) and can't be missing
+NATIVE_DTYPE_KINDS: str = 'biu'
 
 
 def format_data_for_ui(df: DataFrame, has_header: bool) -> dict:
     """
     Takes a DataFrame and transforms it into a format that can be used by the UI.
+    The data is kept column by column; the formats module turns it into the
+    layout the client asked for when the response is sent.
 
     Args:
         csv_data (DataFrame): DataFrame containing data read from CSV
@@ -39,74 +72,59 @@ def format_data_for_ui(df: DataFrame, has_header: bool) -> dict:
     # Replace the DataFrame column names with the validated column names
     df.columns = col_names
 
-    # Create a list of UI formatted row data
-    ui_rows: list[dict] = create_ui_rows(df, col_names)
+    # Create the UI formatted column data (including an 'id' column of row IDs)
+    with span('format_ui_data', rows=len(df)):
+        ui_columns: dict = create_ui_columns(df, col_names)
 
-    # Return column names and row data in the form expected by UI
-    return {'columns': col_names, 'rowData': ui_rows}
+    # Return column names and column data in the form expected by the formats module
+    return {'columns': col_names, 'columnData': ui_columns}
 
 
-def create_ui_rows(df: DataFrame, column_names: list) -> list[dict]:
+def create_ui_columns(df: DataFrame, column_names: list) -> dict:
     """
-    Create a list of rows formatted for the CSV Transformer UI.
-    Each row is represented by a dictionary of Column Name -> Cell Value.
-    Each row is also given a unique row ID. Each value is cast to
-    its determined data type.
+    Create a dictionary of Column Name -> list of cell values, with an
+    'id' column holding the row IDs. Each column is converted in one
+    pass (see convert_column).
 
     Args:
-        df (DataFrame): DataFrame to convert to UI formatted data
+        df (DataFrame): DataFrame to convert
         column_names (list): list of column names
 
     Returns:
-        list[dict]: list of rows formatted for UI
+        dict: column values keyed by column name, starting with 'id'
     """
 
-    column_types: list = determine_column_types(df)
-    ui_rows: list = []
-
-    # Walk through every row in the DataFrame
-    for row_idx, df_row in df.iterrows():
-        ui_row: dict = {'id': int(row_idx)}
+    ui_columns: dict = {'id': [int(row_idx) for row_idx in df.index.tolist()]}
 
-        # Walk through every column
-        for col_idx, col_name in enumerate(column_names):
-            # Cast the cell value to the determined data type and save it to the UI row
-            ui_row[col_name] = column_types[col_idx](df_row[col_name])
+    for col_idx, col_name in enumerate(column_names):
+        ui_columns[col_name] = convert_column(df.iloc[:, col_idx])
 
-        # Add the new UI row to ui_rows
-        ui_rows.append(ui_row)
-    
-    return ui_rows
+    return ui_columns
 
 
-def determine_column_types(df: DataFrame) -> list:
+def convert_column(column: Series) -> list:
     """
-    Creates a list of data types for the columns in the DataFrame.
-    Walks through the values in the first row of the DataFrame, 
-    inferring each value's type and adding it to the list. If the
-    inferred type is a Numpy type, it is converted to a corresponding
-    basic Python data type because Numpy types are not JSON serializable.
+    Converts a DataFrame column to a list of values for the UI, according
+    to the column's dtype. tolist() already yields basic Python values for
+    bool, int and float columns; the values of other columns (e.g. text,
+    which pandas reads as object columns) are kept as they are, and
+    missing values (NaN, None or NaT) of any column become None.
 
     Args:
-        df (DataFrame): DataFrame to determine types for
+        column (Series): column to convert
 
     Returns:
-        list: list of column data types
-    """    
+        list: converted column values
+    """
 
-    column_types: list = []
-
-    # Walk through the values in the first row of the DataFrame
-    for val in df.iloc[0]:
-        # Infer the type. If the inferred type is a Numpy type, convert it to a basic type
-        t = type(val) \
-            if type(val) not in numpy_to_type_lookup \
-            else numpy_to_type_lookup[type(val)]
-        
-        # Add the type to the list
-        column_types.append(t)
-    
-    return column_types
+    if column.dtype.kind in NATIVE_DTYPE_KINDS:
+        return column.tolist()
+
+    missing: Series = column.isna()
+    if not missing.any():
+        return column.tolist()
+
+    return column.astype(object).where(~missing, None).tolist()
 
 
 def determine_column_names(raw_data: DataFrame, has_header: bool) -> list:
@@ -162,21 +180,44 @@ def reconstruct_dataframe(ui_data: dict, do_not_include: list, column_data_types
     # Create dictionary of Index -> Column Name to determine column name based on row index
     column_lookup: dict = {index: column for index, column in enumerate(ui_data['columns'])}
 
-    # Create a dictionary of Row ID -> Column Name -> Cell Value so it can be used to create a DataFrame
-    df_rows: dict = {}
-    for ui_data_row in ui_data['rows']:
-        df_rows[ui_data_row['id']] = {column_lookup[index]: item for index,
-                                      item in enumerate(ui_data_row['items'])}
+    with span('reconstruct_dataframe', rows=len(ui_data['rows'])):
+        # Create a dictionary of Row ID -> Column Name -> Cell Value so it can be used to create a DataFrame
+        df_rows: dict = {}
+        for ui_data_row in ui_data['rows']:
+            df_rows[ui_data_row['id']] = {column_lookup[index]: item for index,
+                                          item in enumerate(ui_data_row['items'])}
+
+        # Create a DataFrame from the rows dictionary
+        df: DataFrame = DataFrame.from_dict(data=df_rows).T
 
-    # Create a DataFrame from the rows dictionary
-    df: DataFrame = DataFrame.from_dict(data=df_rows).T
+    return apply_column_config(df, do_not_include, column_data_types, res_data)
+
+
+def apply_column_config(df: DataFrame, do_not_include: list, column_data_types: dict, res_data: ResponseData) -> DataFrame:
+    """
+    Applies the column configuration chosen in the UI to a DataFrame:
+    deletes the columns marked for removal, then sets the data type
+    of every remaining column.
+
+    Args:
+        df (DataFrame): DataFrame with the UI column names
+        do_not_include (list): list of columns marked for removal in UI
+        column_data_types (dict): column data types specified in UI
+        res_data (ResponseData): object managing response data; only used here in case an error needs to be added
+
+    Returns:
+        DataFrame: configured DataFrame, or an empty DataFrame if a data type was not valid for its column
+    """
+
+    # Delete columns marked for removal in UI (before casting, so they aren't converted for nothing)
+    df = df.drop(columns=[col for col in do_not_include if col in df.columns])
 
     # Set the column data types to the types specified in the UI
     # If the data type is not valid for the column, mark response as failed
     for column in df:
         try:
-            df[column] = df[column].astype(text_to_type_lookup[column_data_types[column]])
-        except ValueError:
+            df[column] = convert_to_type(df[column], column_data_types[column])
+        except (ValueError, TypeError):
             res_data.fail(
                 422, f'"{column_data_types[column]}" is not a valid data type for column "{column}"')
             return DataFrame()
@@ -184,143 +225,815 @@ def reconstruct_dataframe(ui_data: dict, do_not_include: list, column_data_types
     # Make all column names lower case
     df.columns = [col.lower() for col in df.columns]
 
-    # Delete columns marked for removal in UI
-    for col in do_not_include:
-        del df[col]
-
     return df
 
 
-def validate_query(query: str) -> str:
+def convert_to_type(column: Series, data_type: str) -> Series:
+    """
+    Converts a column to a UI data type. Missing values stay missing.
+
+    Args:
+        column (Series): column to convert
+        data_type (str): UI data type text
+
+    Raises:
+        ValueError, TypeError: if a value can't be converted to the data type
+
+    Returns:
+        Series: converted column
     """
-    Performs some error checking on user-provided query.
-    Ensures that query is in the form 'SELECT ... FROM ...',
-    and that there are no duplicate columns selected in query.
 
-    This function is pretty hacky. This is a good place
-    for improvement. This is mainly intended to restrict
-    the kind of queries that the user can run for security
-    reasons and to reduce the amount of error checking that 
-    needs to take place because of that.
+    if data_type in ('int', 'bigint'):
+        # Nullable integers, so missing values don't force a float column
+        return to_numeric(column).astype('Int64')
+    if data_type == 'float':
+        return column.astype(float)
+    if data_type == 'bool':
+        converted: Series = column.astype(str).str.strip().str.lower().map(text_to_bool).astype('boolean')
+        if (converted.isna() & column.notna()).any():
+            raise ValueError(f'Column "{column.name}" has values that are not bool')
+        return converted
+    if data_type in ('date', 'timestamp'):
+        # Checked with the same rules used to infer types; PostgreSQL parses the text itself
+        flag: int = DATE if data_type == 'date' else TIMESTAMP
+        if ((type_flags(column) & (NON_NULL | flag)) == NON_NULL).any():
+            raise ValueError(f'Column "{column.name}" has values that are not a {data_type}')
+        return column.astype(str).str.strip().where(column.notna())
+    if data_type == 'text':
+        return column.astype(str).where(column.notna())
+
+    raise ValueError(f'Unknown data type "{data_type}"')
+
+
+def validate_query(query: str, schema: str) -> str:
+    """
+    Checks that a user-provided query is a single read-only SELECT
+    statement that can be shown in the UI (see sql.find_query_error), and
+    that it only reads the session's own schema (see sql.find_schema_error).
+    Results are cached, so checking a query again is cheap.
 
     Args:
         query (str): user-provided query to validate
+        schema (str): session schema the query runs in
 
     Returns:
         str: an error message if query is invalid, else empty str
     """
 
-    # Find the start of the SELECT clause
-    try:
-        start_idx = query.index('select') + len('select')
-    except ValueError:
-        return 'Missing a SELECT clause'
+    checked: CheckedQuery = check_query(query)
+    return checked.error or find_schema_error(checked, schema)
 
-    # Check that the query is a SELECT statement (starts with SELECT)
-    if start_idx != len('select'):
-        return 'Invalid SELECT clause'
 
-    # Find the FROM clause
-    try:
-        end_idx = query.index('from')
-    except ValueError:
-        return 'Missing FROM clause'
+def format_csv_data_for_ui(filepath: str, has_header: bool, res_data: ResponseData):
+    """
+    Reads a CSV file in chunks, formats the first PREVIEW_ROWS rows for the UI,
+    and adds the formatted data to the response. The data types of every column
+    are tracked over the whole file, and the total number of rows and the type
+    suggested for each column are added to the response as well. Only one chunk
+    of the file is in memory at a time.
+
+    Types are inferred from the values as text, the same text that is checked
+    when the file is loaded (see check_chunks), so a suggested type always
+    loads; e.g. 1.0 is a float, although pandas would read it as a number
+    that is an integer. The preview itself is read with pandas' types.
+
+    Args:
+        filepath (str): path to CSV file to read
+        has_header (bool): whether the CSV file has a head row or not
+        res_data (ResponseData): object to hold data for the response
+    """
 
-    # Between SELECT and FROM are the columns
-    select_str = query[start_idx:end_idx]
+    total_rows: int = 0
+    type_inferrer = TypeInferrer()
+    infer_seconds: float = 0.0
 
-    # Split them apart and strip them of whitespace
-    select_list = select_str.split(',')
-    select_list = [item.strip() for item in select_list]
+    for chunk in read_csv_chunks(filepath, has_header, res_data, as_text=True):
+        total_rows += len(chunk)
+        infer_start: float = perf_counter()
+        type_inferrer.update(chunk)
+        infer_seconds += perf_counter() - infer_start
 
-    # Check that there are no duplicate columns selected
-    if len(select_list) != len(set(select_list)):
-        return 'The same column cannot be selected twice'
+    preview: DataFrame = read_csv_preview(filepath, has_header, res_data) if res_data.success else None
 
-    return ''
+    if res_data.success:
+        # No error opening/reading the file; format the preview for the UI and add it to response
+        ui_data: dict = format_data_for_ui(preview, has_header)
+        ui_data['totalRows'] = total_rows
+        infer_start = perf_counter()
+        add_column_types(ui_data, type_inferrer.column_types())
+        infer_seconds += perf_counter() - infer_start
+        record_span('infer_types', infer_seconds, total_rows)
+        res_data.set_data(ui_data)
 
 
-def format_csv_data_for_ui(filepath: str, has_header: bool, res_data: ResponseData):
+def add_column_types(ui_data: dict, column_types: dict):
     """
-    Opens a CSV file, reads it into a DataFrame, formats the data for the UI,
-    and adds the formatted data to the response.
+    Adds the inferred column types to UI formatted data: the suggested
+    type of every column in 'columnTypes', and the ratio of missing
+    values and the confidence of the suggestion in 'columnTypeStats'.
+
+    Args:
+        ui_data (dict): UI formatted data, updated in place
+        column_types (dict): Column Index -> inferred type (see TypeInferrer.column_types)
+    """
+
+    ui_data['columnTypes'] = {}
+    ui_data['columnTypeStats'] = {}
+
+    for col_idx, col in enumerate(ui_data['columns']):
+        column_type: dict = column_types.get(col_idx, {'type': 'text', 'confidence': 0.0, 'nullRatio': 0.0})
+        ui_data['columnTypes'][col] = column_type['type']
+        ui_data['columnTypeStats'][col] = {
+            'nullRatio': column_type['nullRatio'],
+            'confidence': column_type['confidence']
+        }
+
+
+def read_csv_chunks(filepath: str, has_header: bool, res_data: ResponseData, columns: list = None,
+                    as_text: bool = False) -> Iterator[DataFrame]:
+    """
+    Opens a CSV file and reads it into DataFrames of at most CSV_CHUNK_ROWS rows.
+    Rows are numbered across chunks, so row indexes are unique within the file.
+    If the file cannot be read or parsed, an error is added to the response
+    and no more chunks are produced.
 
     Args:
         filepath (str): path to CSV file to read
         has_header (bool): whether the CSV file has a head row or not
         res_data (ResponseData): object to hold data for the response
+        columns (list): positions of the columns to read (default: all); the
+                        other columns are skipped by the parser
+        as_text (bool): whether to keep every value as text instead of letting
+                        pandas infer column types (missing values are still missing)
+
+    Yields:
+        DataFrame: the next chunk of CSV data
     """
 
     try:
-        # Try opening the file and reading it into a CSV
-        with open(filepath, 'r', encoding='utf-8') as csv_file:
-            csv_data = read_csv(csv_file) if has_header else read_csv(
-                csv_file, header=None)
-    except OSError as os_err:
-        # If there was an error opening the file, add error to response
-        print(f'Error in format_csv_data_for_ui: {os_err}')
+        # Read the file in chunks; the parser reads it through a memory map and decodes it itself
+        yield from timed_chunks('read_csv', read_csv(
+            filepath, encoding='utf-8', memory_map=True, header=0 if has_header else None,
+            usecols=columns, dtype=str if as_text else None, chunksize=CSV_CHUNK_ROWS))
+    except (OSError, UnicodeDecodeError, EmptyDataError, ParserError) as read_err:
+        # If there was an error opening or parsing the file, add error to response
+        print(f'Error in read_csv_chunks: {read_err}')
         res_data.fail(500, 'Failed to parse CSV')
-    else:
-        # No error opening/reading the file; format the data for the UI and add it to response
-        res_data.data = format_data_for_ui(csv_data, has_header)
 
 
-def get_query_data(query: str, res_data: ResponseData):
+def read_csv_preview(filepath: str, has_header: bool, res_data: ResponseData) -> DataFrame:
     """
-    Executes a query, formats it for UI consumption, and puts it in the response.
+    Reads the first PREVIEW_ROWS rows of a CSV file, letting pandas infer
+    column types.
+
+    Args:
+        filepath (str): path to CSV file to read
+        has_header (bool): whether the CSV file has a head row or not
+        res_data (ResponseData): object to hold data for the response
+
+    Returns:
+        DataFrame: the first rows of the file, or None if the file could not be read
+    """
+
+    try:
+        with span('read_csv') as read_span:
+            preview: DataFrame = read_csv(filepath, encoding='utf-8', memory_map=True,
+                                          header=0 if has_header else None, nrows=PREVIEW_ROWS)
+            read_span.rows = len(preview)
+    except (OSError, UnicodeDecodeError, EmptyDataError, ParserError) as read_err:
+        print(f'Error in read_csv_preview: {read_err}')
+        res_data.fail(500, 'Failed to parse CSV')
+        return None
+
+    return preview
+
+
+def check_query_limits(timeout_seconds, max_rows, res_data: ResponseData) -> tuple:
+    """
+    Checks the statement timeout and row limit requested for a query. A
+    request may lower the server's QUERY_TIMEOUT_SECONDS and QUERY_MAX_ROWS
+    but not raise them.
+
+    Args:
+        timeout_seconds: requested timeout in seconds, or None for QUERY_TIMEOUT_SECONDS
+        max_rows: requested row limit, or None for QUERY_MAX_ROWS
+        res_data (ResponseData): object to hold data for the response
+
+    Returns:
+        tuple: timeout in seconds and row limit to run the query with (0 for none),
+               or (None, None) if a requested limit is invalid
+    """
+
+    try:
+        requested_timeout: float = None if timeout_seconds is None else float(timeout_seconds)
+        requested_rows: int = None if max_rows is None else int(max_rows)
+    except (TypeError, ValueError):
+        res_data.fail(422, 'Query timeout and row limit must be numbers')
+        return None, None
+
+    if (requested_timeout is not None and not requested_timeout > 0) or (requested_rows is not None
+                                                                         and requested_rows <= 0):
+        res_data.fail(422, 'Query timeout and row limit must be greater than 0')
+        return None, None
+
+    limits: list = []
+    for requested, server_limit in ((requested_timeout, QUERY_TIMEOUT_SECONDS), (requested_rows, QUERY_MAX_ROWS)):
+        if requested is None:
+            limits.append(server_limit)
+        else:
+            limits.append(min(requested, server_limit) if server_limit > 0 else requested)
+    return tuple(limits)
+
+
+def get_query_data(query: str, schema: str, res_data: ResponseData, timeout_seconds: float = None,
+                   max_rows: int = None, query_id: str = None):
+    """
+    Executes a query, formats the first page of results for UI consumption,
+    and puts it in the response along with the total number of result rows
+    and a result ID that can be used to fetch other pages (see get_query_page).
+
+    Results of up to CACHE_MAX_ROWS rows are fetched in full and cached,
+    so other pages and downloads of the same result don't run the query again.
 
     Args:
         query (str): query to execute
+        schema (str): session schema to execute the query in
         res_data (ResponseData): object to hold data for the response
+        timeout_seconds (float): statement timeout (see postgres.schema_connection)
+        max_rows (int): most rows of the result kept (0 or None for no limit); later pages
+                        and downloads of the result are limited the same way
+        query_id (str): ID the query can be cancelled by while it runs (see postgres.cancel_query)
     """
 
-    # Execute the query and read results into a DataFrame
-    raw_data: DataFrame = execute_query(query, res_data)
+    query = limit_query(query, max_rows)
+    result: DataFrame = get_small_result(query, schema, res_data, timeout_seconds, query_id)
+    if not res_data.success:
+        return
 
-    if not raw_data.empty:
-        # Format the query results for the UI and put it in the response
-        res_data.set_data(format_data_for_ui(raw_data, True))
+    # Count the rows in the full result (known already if the result is small enough to cache)
+    total_rows: int = len(result) if result is not None else count_query_rows(
+        query, schema, res_data, timeout_seconds, query_id)
+    if not res_data.success:
+        return
+
+    # Register the result so other pages can be requested later, then send the first page
+    result_id: str = register_result(query, schema, total_rows)
+    send_query_page(query, schema, result_id, total_rows, 0, PAGE_SIZE, res_data, timeout_seconds, query_id)
+    if res_data.success and max_rows:
+        res_data.data.update({'rowLimit': max_rows, 'rowLimitReached': total_rows >= max_rows})
 
 
-def initialize_table(data: DataFrame, table_name: str, res_data: ResponseData):
+def get_small_result(query: str, schema: str, res_data: ResponseData, timeout_seconds: float = None,
+                     query_id: str = None) -> DataFrame:
+    """
+    Returns the full result of a query from the cache, or executes the
+    query and caches its result if it has at most CACHE_MAX_ROWS rows.
+
+    Args:
+        query (str): query to execute
+        schema (str): session schema to execute the query in
+        res_data (ResponseData): object to hold data for the response
+        timeout_seconds (float): statement timeout (see postgres.schema_connection)
+        query_id (str): ID the query can be cancelled by (see postgres.cancel_query)
+
+    Returns:
+        DataFrame: the full query result, or None if it has more than
+                   CACHE_MAX_ROWS rows or the query failed
+    """
+
+    # Read before the query starts: a table loaded while it runs makes its result stale
+    generation: int = table_generation(schema)
+    result: DataFrame = get_cached_result(query, schema)
+    if result is not None:
+        return result
+
+    # Fetch one row more than the limit to find out whether the result is small enough
+    result = execute_query_page(query, 0, CACHE_MAX_ROWS + 1, schema, res_data, timeout_seconds, query_id)
+    if not res_data.success or len(result) > CACHE_MAX_ROWS:
+        return None
+
+    cache_result(query, schema, result, generation)
+    return result
+
+
+def stream_query_data(query: str, schema: str, res_data: ResponseData, first_rows=PAGE_SIZE,
+                      timeout_seconds: float = None, max_rows: int = None, query_id: str = None) -> Iterator[bytes]:
+    """
+    Executes a query through a server-side cursor (see postgres.stream_query_rows)
+    and streams its results as newline-delimited JSON, sending the first rows
+    as soon as they arrive rather than once the whole result is ready. The
+    lines are:
+
+    - the response dictionary, with the result 'columns' and 'firstRowSeconds'
+      (the time until the first rows arrived) as its data
+    - {'rows': [...]} for every batch of rows: first_rows rows, then STREAM_BATCH_ROWS at a time
+    - {'done': true, 'totalRows', 'rowLimitReached', 'firstRowSeconds', 'totalSeconds'}, or
+      {'done': true, 'success': false, 'status', 'error'} if the query fails part way
+
+    Args:
+        query (str): query to execute
+        schema (str): session schema to execute the query in
+        res_data (ResponseData): object to hold data for the response
+        first_rows: number of rows in the first batch (at most MAX_PAGE_SIZE)
+        timeout_seconds (float): statement timeout (see postgres.schema_connection)
+        max_rows (int): most rows sent (0 or None for no limit)
+        query_id (str): ID the query can be cancelled by while it runs (see postgres.cancel_query)
+
+    Returns:
+        Iterator[bytes]: lines of JSON if the query started successfully, else None
+    """
+
+    try:
+        first_rows = int(first_rows)
+    except (TypeError, ValueError):
+        first_rows = 0
+    if not 0 < first_rows <= MAX_PAGE_SIZE:
+        res_data.fail(422, f'The number of first rows must be between 1 and {MAX_PAGE_SIZE}')
+        return None
+
+    start: float = perf_counter()
+    batches: Iterator = stream_query_rows(
+        limit_query(query, max_rows), schema, first_rows, STREAM_BATCH_ROWS, timeout_seconds, query_id)
+
+    # Wait for the first rows so a failing query can still be reported as an error
+    try:
+        columns: list = next(batches)
+    except (SQLAlchemyError, PGError) as sql_err:
+        print(f'Error in stream_query_data: {sql_err}')
+        res_data.fail(query_error_status(sql_err), f'Failed to execute query:\n\n{extract_sql_err(sql_err)}')
+        return None
+    first_row_seconds: float = perf_counter() - start
+
+    def generate_lines() -> Iterator[bytes]:
+        res_data.set_data({'columns': columns, 'firstRowSeconds': first_row_seconds})
+        yield dumps_json(res_data.get_response_dict()) + b'\n'
+
+        rows: int = 0
+        try:
+            for batch in batches:
+                rows += len(batch)
+                yield dumps_json({'rows': batch}) + b'\n'
+        except (SQLAlchemyError, PGError) as sql_err:
+            # The response has already started, so the error goes in the last line
+            print(f'Error in stream_query_data: {sql_err}')
+            yield dumps_json({'done': True, 'success': False, 'status': query_error_status(sql_err),
+                              'error': f'Failed to execute query:\n\n{extract_sql_err(sql_err)}'}) + b'\n'
+            return
+        finally:
+            batches.close()
+
+        yield dumps_json({'done': True, 'totalRows': rows, 'rowLimitReached': bool(max_rows) and rows >= max_rows,
+                          'firstRowSeconds': first_row_seconds, 'totalSeconds': perf_counter() - start}) + b'\n'
+
+    return generate_lines()
+
+
+def get_query_page(result_id: str, offset, limit, schema: str, res_data: ResponseData):
+    """
+    Fetches a page (window) of a previously executed query's results,
+    formats it for UI consumption, and puts it in the response.
+
+    Args:
+        result_id (str): result ID returned with the first page of results
+        offset: index of the first row to fetch
+        limit: maximum number of rows to fetch
+        schema (str): session schema the result belongs to
+        res_data (ResponseData): object to hold data for the response
+    """
+
+    result: dict = lookup_result(result_id, schema)
+    if result is None:
+        res_data.fail(404, 'Query results have expired. Please execute the query again.')
+        return
+
+    try:
+        offset = int(offset)
+        limit = int(limit)
+    except (TypeError, ValueError):
+        res_data.fail(422, 'Page offset and limit must be integers')
+        return
+
+    if offset < 0 or not 0 < limit <= MAX_PAGE_SIZE:
+        res_data.fail(422, f'Page offset must be at least 0 and limit must be between 1 and {MAX_PAGE_SIZE}')
+        return
+
+    send_query_page(result['query'], schema, result_id, result['totalRows'], offset, limit, res_data)
+
+
+def send_query_page(query: str, schema: str, result_id: str, total_rows: int, offset: int, limit: int,
+                    res_data: ResponseData, timeout_seconds: float = None, query_id: str = None):
+    """
+    Executes one page of a query (or takes it from the cached result),
+    formats it for the UI, and puts it in the response.
+
+    Args:
+        query (str): query to execute
+        schema (str): session schema to execute the query in
+        result_id (str): result ID of the query
+        total_rows (int): number of rows in the full query result
+        offset (int): index of the first row of the page
+        limit (int): maximum number of rows in the page
+        res_data (ResponseData): object to hold data for the response
+        timeout_seconds (float): statement timeout (see postgres.schema_connection)
+        query_id (str): ID the query can be cancelled by (see postgres.cancel_query)
+    """
+
+    # Take the page from the cached result if there is one, else execute the query for just the page
+    result: DataFrame = get_small_result(
+        query, schema, res_data, timeout_seconds, query_id) if total_rows <= CACHE_MAX_ROWS else None
+    if result is not None:
+        raw_data: DataFrame = result.iloc[offset:offset + limit].copy()
+    else:
+        raw_data = execute_query_page(query, offset, limit, schema, res_data, timeout_seconds, query_id)
+    if not res_data.success:
+        return
+
+    # Number the rows by their position in the full result so row IDs are unique across pages
+    raw_data.index = RangeIndex(offset, offset + len(raw_data))
+
+    # Format the query results for the UI and put it in the response
+    ui_data: dict = format_data_for_ui(raw_data, True)
+    ui_data.update({'resultId': result_id, 'totalRows': total_rows, 'offset': offset})
+    res_data.set_data(ui_data)
+
+
+def initialize_table(data: Iterable[DataFrame], table_name: str, column_data_types: dict, schema: str,
+                     res_data: ResponseData, on_progress: Callable = None, content_hash: str = None):
     """
     Creates a new table with contents of data, then selects all data 
-    from the table and puts it in the response.
+    from the table and puts it in the response, along with statistics
+    about how fast the data was loaded.
 
     Args:
-        data (DataFrame): data to insert into table
+        data (Iterable[DataFrame]): data to insert into table, in one or more chunks
         table_name (str): name for new table
+        column_data_types (dict): column data types specified in UI
+        schema (str): session schema to create the table in
         res_data (ResponseData): object to hold data for the response
+        on_progress (Callable): called with the rows and bytes loaded so far (see init_table)
+        content_hash (str): content hash of the uploaded file the data is read from, if any
+    """
+
+    if not check_table_name(table_name, res_data):
+        return
+
+    # Create a new table in the DB with the data in the DataFrame
+    load_stats: dict = init_table(
+        data, table_name, get_column_types(column_data_types), schema, res_data, on_progress, content_hash)
+    if load_stats is not None:
+        send_loaded_table(table_name, schema, load_stats, res_data)
+
+
+def check_table_name(table_name: str, res_data: ResponseData) -> bool:
+    """
+    Checks that a table name chosen in the UI can be used.
+
+    Args:
+        table_name (str): name for new table
+        res_data (ResponseData): object to hold data for the response
+
+    Returns:
+        bool: whether the name can be used
     """
 
     # Don't allow PostgreSQL reserved words as table name
     if table_name.lower() in ['table', 'select', 'from']:
         res_data.fail(422, f'"{table_name}" is not a valid table name')
+        return False
+    return True
+
+
+def get_column_types(column_data_types: dict) -> dict:
+    """
+    Keys the column data types specified in UI the way the postgres module looks them up.
+
+    Args:
+        column_data_types (dict): column data types specified in UI
+
+    Returns:
+        dict: UI data type of each column (see postgres.init_table)
+    """
+
+    return {col.lower(): data_type for col, data_type in column_data_types.items()}
+
+
+def send_loaded_table(table_name: str, schema: str, load_stats: dict, res_data: ResponseData):
+    """
+    Puts a newly loaded table in the response, along with its load statistics
+    and how many rows were inserted, updated and skipped (a replaced table
+    has all of its rows inserted).
+
+    Args:
+        table_name (str): name of the loaded table
+        schema (str): session schema the table was loaded into
+        load_stats (dict): load statistics (see postgres.load_stats and postgres.merge_into_table)
+        res_data (ResponseData): object to hold data for the response
+    """
+
+    record_span('init_table', load_stats['seconds'], load_stats['rows'], load_stats['bytes'])
+
+    # Cached results may be from the replaced table
+    bump_generation(schema)
+
+    # Select all data from the table and add it to the response
+    select_all_data_query: str = f'SELECT * FROM {table_name}'
+    get_query_data(select_all_data_query, schema, res_data)
+    if res_data.success:
+        res_data.data['loadStats'] = {
+            'mode': 'replace', 'inserted': load_stats['rows'], 'updated': 0, 'skipped': 0, **load_stats}
+
+
+def initialize_table_from_upload(upload_id: str, table_name: str, do_not_include: list, column_data_types: dict,
+                                 schema: str, res_data: ResponseData, on_progress: Callable = None,
+                                 load_mode: str = 'replace', key_column: str = None):
+    """
+    Creates a new table from a CSV file uploaded through /loadcsv, applying
+    the column configuration chosen in the UI, then selects all data from
+    the table and puts it in the response. The data is read from the saved
+    file, so the UI only needs to send the upload ID.
+
+    In 'append' and 'upsert' mode, the file is instead added to an existing
+    table with the same columns (see load_into_existing_table); if there is
+    no such table yet, it is created as in 'replace' mode.
+
+    Args:
+        upload_id (str): upload ID returned by /loadcsv
+        table_name (str): name for new table
+        do_not_include (list): list of columns marked for removal in UI
+        column_data_types (dict): column data types specified in UI
+        schema (str): session schema to create the table in
+        res_data (ResponseData): object to hold data for the response
+        on_progress (Callable): called with the rows and bytes loaded so far (see init_table)
+        load_mode (str): 'replace', 'append' or 'upsert' (see postgres.LOAD_MODES)
+        key_column (str): column that identifies rows when upserting
+    """
+
+    if load_mode not in LOAD_MODES:
+        res_data.fail(422, f'Unknown load mode "{load_mode}"')
         return
 
-    # Create a new table in the DB with the data in the DataFrame
-    if init_table(data, table_name, res_data):
-        # If that succeeded, select all data from the table and add it to the response
-        select_all_data_query: str = f'SELECT * FROM {table_name}'
-        get_query_data(select_all_data_query, res_data)
+    upload: dict = lookup_upload(upload_id, schema)
+    if upload is None:
+        res_data.fail(404, 'Uploaded file not found. Please upload the CSV file again.')
+        return
+
+    # Name the columns the same way as in the UI, and skip the ones marked for removal
+    column_names: list = read_column_names(upload['path'], upload['hasHeader'], res_data)
+    if not res_data.success:
+        return
+    kept_columns: list = [col_idx for col_idx, col in enumerate(column_names) if col not in do_not_include]
+    if not kept_columns:
+        res_data.fail(422, 'Cannot create table with no columns')
+        return
+
+    kept_names: list = [column_names[col_idx] for col_idx in kept_columns]
+
+    if load_mode != 'replace':
+        if load_mode == 'upsert' and key_column not in kept_names:
+            res_data.fail(422, 'Choose a key column to upsert by')
+            return
+        if not check_table_name(table_name, res_data):
+            return
+        table_types: dict = get_table_column_types(table_name, schema, res_data)
+        if table_types is None:
+            return
+        if table_types:
+            load_into_existing_table(upload, kept_columns, kept_names, table_name, table_types, load_mode,
+                                     key_column, schema, res_data, on_progress)
+            return
+
+    # Large files are split into ranges that are parsed and loaded in parallel
+    if use_parallel_load(upload['path']):
+        if not check_table_name(table_name, res_data):
+            return
+        load_stats: dict = load_csv_in_parallel(
+            upload['path'], upload['hasHeader'], kept_columns, kept_names, table_name,
+            get_column_types(column_data_types), column_data_types, schema, res_data, on_progress, upload.get('hash'))
+        if load_stats is not None:
+            send_loaded_table(table_name, schema, load_stats, res_data)
+        return
+
+    # Read only the kept columns of the saved file, as text, in chunks, and check that
+    # the values can be converted to the data types chosen in the UI; the database
+    # converts them while loading the table
+    df_chunks: Iterator[DataFrame] = check_chunks(
+        read_csv_chunks(upload['path'], upload['hasHeader'], res_data, kept_columns, as_text=True),
+        kept_names, column_data_types, res_data)
+
+    initialize_table(df_chunks, table_name, column_data_types, schema, res_data, on_progress, upload.get('hash'))
+
+
+def load_into_existing_table(upload: dict, columns: list, column_names: list, table_name: str, table_types: dict,
+                             load_mode: str, key_column: str, schema: str, res_data: ResponseData,
+                             on_progress: Callable = None):
+    """
+    Appends or upserts an uploaded CSV file into an existing table (see
+    postgres.merge_into_table), then selects all data from the table and
+    puts it in the response. The values are checked against the table's
+    column types rather than the ones chosen in the UI. A file that was
+    already loaded into the table (by content hash) is skipped.
+
+    Args:
+        upload (dict): the registered upload (see uploads.register_upload)
+        columns (list): positions of the columns to load
+        column_names (list): UI names of the columns to load
+        table_name (str): name of the existing table
+        table_types (dict): UI data type of each of the table's columns (see postgres.get_table_column_types)
+        load_mode (str): 'append' or 'upsert'
+        key_column (str): column that identifies rows when upserting
+        schema (str): session schema of the table
+        res_data (ResponseData): object to hold data for the response
+        on_progress (Callable): called with the rows and bytes loaded so far (see init_table)
+    """
+
+    if set(column_names) != set(table_types):
+        res_data.fail(422, f'The columns of the file do not match the columns of table "{table_name}" '
+                           f'({", ".join(table_types)})')
+        return
+
+    # The table already has this file's rows
+    if upload.get('hash') and find_loaded_file(table_name, upload['hash'], schema):
+        get_query_data(f'SELECT * FROM {table_name}', schema, res_data)
+        if res_data.success:
+            res_data.data['loadStats'] = {
+                'mode': load_mode, 'rows': 0, 'bytes': 0, 'seconds': 0.0, 'rowsPerSec': 0, 'bytesPerSec': 0,
+                'inserted': 0, 'updated': 0, 'skipped': upload['totalRows'], 'unchanged': True}
+        return
+
+    column_types: dict = {col: table_types[col] for col in column_names}
+    df_chunks: Iterator[DataFrame] = check_chunks(
+        read_csv_chunks(upload['path'], upload['hasHeader'], res_data, columns, as_text=True),
+        column_names, column_types, res_data)
+
+    load_stats: dict = merge_into_table(df_chunks, table_name, column_types, load_mode, key_column,
+                                        upload.get('hash'), schema, res_data, on_progress)
+    if load_stats is not None:
+        load_stats['mode'] = load_mode
+        send_loaded_table(table_name, schema, load_stats, res_data)
 
 
-def create_download_csv(query: str, table_name: str, path_to_file: str, res_data: ResponseData):
+def read_column_names(filepath: str, has_header: bool, res_data: ResponseData) -> list:
     """
-    A wrapper function for the postgres module's write_query_to_csv function, 
-    which creates a downloadable CSV with data from the currently displayed 
+    Reads the header of a CSV file and names its columns the same way
+    format_csv_data_for_ui names the columns sent to the UI.
+
+    Args:
+        filepath (str): path to CSV file to read
+        has_header (bool): whether the CSV file has a head row or not
+        res_data (ResponseData): object to hold data for the response
+
+    Returns:
+        list: column names, or None if the file could not be read
+    """
+
+    try:
+        header: DataFrame = read_csv(filepath, encoding='utf-8', memory_map=True,
+                                     header=0 if has_header else None, nrows=0)
+    except (OSError, UnicodeDecodeError, EmptyDataError, ParserError) as read_err:
+        print(f'Error in read_column_names: {read_err}')
+        res_data.fail(500, 'Failed to parse CSV')
+        return None
+
+    return determine_column_names(header, has_header)
+
+
+def check_chunks(df_chunks: Iterable[DataFrame], column_names: list, column_data_types: dict,
+                 res_data: ResponseData) -> Iterator[DataFrame]:
+    """
+    Names the columns of each chunk of CSV text and checks that every value
+    can be converted to the data type chosen for its column in the UI (the
+    conversion itself is done by the database, see init_table). Stops at
+    the first chunk with values that can't be converted, and adds the
+    offending row numbers of each column (see find_conversion_errors) to
+    the response.
+
+    Args:
+        df_chunks (Iterable[DataFrame]): chunks of CSV text, holding only the columns to load
+        column_names (list): UI names of the columns in the chunks
+        column_data_types (dict): column data types specified in UI
+        res_data (ResponseData): object to hold data for the response
+
+    Yields:
+        DataFrame: the next checked chunk
+    """
+
+    for df in df_chunks:
+        df.columns = column_names
+        errors: dict = find_conversion_errors(df, column_data_types)
+        if errors:
+            res_data.fail(422, conversion_error_message(errors, column_data_types))
+            return
+        yield df
+
+
+def create_download_csv(query: str, table_name: str, schema: str, res_data: ResponseData) -> Iterator[bytes]:
+    """
+    Streams a downloadable CSV with data from the currently displayed 
     query data. If no query has been provided, selects all data from table.
+    The CSV is made from the cached result if there is one, otherwise the
+    postgres module's stream_query_to_csv function is used.
 
     Args:
         query (str): Current UI query (will be empty if no query has been provided)
         table_name (str): Name of table displayed in UI
-        path_to_file (str): Location to save CSV file to
+        schema (str): Session schema to execute the query in
         res_data (ResponseData): Object to hold data for the response
+
+    Returns:
+        Iterator[bytes]: chunks of the CSV file, or None if the query failed
     """
 
     # If no query has been run yet, select all data
     if not query or len(query) == 0:
         query = f'SELECT * FROM {table_name}'
+
+    # The query goes into a COPY statement, so it must be checked like any other
+    err: str = validate_query(query, schema)
+    if len(err) > 0:
+        res_data.fail(422, f'Failed to download CSV: {err}')
+        return None
+
+    result: DataFrame = get_cached_result(query, schema)
+    if result is not None:
+        return iter_download_csv(result)
     
-    # Execute the query and create the CSV
-    write_query_to_csv(query, path_to_file, res_data)
+    # Execute the query and stream the CSV
+    return stream_query_to_csv(query, schema, res_data)
+
+
+def write_download_csv(query: str, table_name: str, schema: str, filepath: str, res_data: ResponseData,
+                       on_progress: Callable = None):
+    """
+    Writes the CSV that create_download_csv streams to a file, for
+    downloading later. The file is deleted if writing it fails.
+
+    Args:
+        query (str): Current UI query (will be empty if no query has been provided)
+        table_name (str): Name of table displayed in UI
+        schema (str): Session schema to execute the query in
+        filepath (str): Path of the file to write
+        res_data (ResponseData): Object to hold data for the response
+        on_progress (Callable): called with the rows and bytes written so far after every chunk;
+                                rows are counted as lines after the header, so values with
+                                line breaks in them count more than once
+    """
+
+    csv_chunks: Iterator[bytes] = create_download_csv(query, table_name, schema, res_data)
+    if not res_data.success:
+        return
+
+    lines: int = 0
+    total_bytes: int = 0
+    written: bool = False
+    try:
+        with open(filepath, 'wb') as csv_file:
+            for chunk in csv_chunks:
+                csv_file.write(chunk)
+                lines += chunk.count(b'\n')
+                total_bytes += len(chunk)
+                if on_progress is not None:
+                    on_progress(max(lines - 1, 0), total_bytes)
+        written = True
+    except OSError as os_err:
+        print(f'Error in write_download_csv: {os_err}')
+        res_data.fail(500, 'Failed to write CSV')
+    finally:
+        # Stop the query if it is still streaming (e.g. on_progress raised)
+        csv_chunks.close()
+
+        # Don't leave a partial file behind
+        if not (written and res_data.success) and exists(filepath):
+            remove(filepath)
+
+
+def iter_file_chunks(filepath: str) -> Iterator[bytes]:
+    """
+    Reads a file in chunks of FILE_CHUNK_BYTES.
+
+    Args:
+        filepath (str): path of the file to read
+
+    Yields:
+        bytes: the next chunk of the file
+    """
+
+    with open(filepath, 'rb') as file:
+        while chunk := file.read(FILE_CHUNK_BYTES):
+            yield chunk
+
+
+def iter_download_csv(df: DataFrame) -> Iterator[bytes]:
+    """
+    Converts a query result to CSV (with a header row, without the index)
+    in chunks of DOWNLOAD_CHUNK_ROWS rows.
+
+    Args:
+        df (DataFrame): query result
+
+    Yields:
+        bytes: UTF-8 encoded CSV for the next chunk of rows
+    """
+
+    for start in range(0, max(len(df), 1), DOWNLOAD_CHUNK_ROWS):
+        yield df.iloc[start:start + DOWNLOAD_CHUNK_ROWS].to_csv(
+            header=start == 0, index=False).encode('utf-8')
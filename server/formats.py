@@ -0,0 +1,118 @@
+"""
+formats.py:
+Wire formats for UI formatted data. The data module keeps table data
+column by column ({'columns': [...], 'columnData': {name: [values]}});
+how it is sent is negotiated with the request's Accept header:
+
+- application/json (default): one dict per row under 'rowData', the
+  format the UI has always used
+- application/vnd.csvt.columns+json: the column lists as they are,
+  without repeating every column name in every row
+- application/vnd.apache.arrow.stream: an Arrow IPC stream holding the
+  table, with the rest of the response as JSON in the schema metadata
+  (under b'csvt'). Only offered if pyarrow is installed.
+
+Error responses are always sent as application/json.
+"""
+
+from werkzeug.datastructures import MIMEAccept
+from response_data import dumps_json
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+ROWS_JSON: str = 'application/json'
+COLUMNS_JSON: str = 'application/vnd.csvt.columns+json'
+ARROW_STREAM: str = 'application/vnd.apache.arrow.stream'
+
+# Streamed query results, one JSON object per line (see data.stream_query_data), whatever the Accept header
+NDJSON: str = 'application/x-ndjson'
+
+# Formats that can be sent, in order of preference when the client accepts several equally
+SUPPORTED_FORMATS: list = [ROWS_JSON, COLUMNS_JSON] + ([ARROW_STREAM] if pyarrow is not None else [])
+
+# Schema metadata key holding the rest of the response in an Arrow stream
+ARROW_METADATA_KEY: bytes = b'csvt'
+
+
+def negotiate_format(accept: MIMEAccept) -> str:
+    """
+    Picks the format to send UI formatted data in.
+
+    Args:
+        accept (MIMEAccept): the request's parsed Accept header
+
+    Returns:
+        str: media type of the format (ROWS_JSON if nothing else is accepted)
+    """
+
+    return accept.best_match(SUPPORTED_FORMATS, default=ROWS_JSON)
+
+
+def rows_from_columns(column_data: dict) -> list[dict]:
+    """
+    Zips column lists back together into one dictionary of
+    Column Name -> Cell Value per row.
+
+    Args:
+        column_data (dict): Column Name -> list of cell values
+
+    Returns:
+        list[dict]: one dictionary per row
+    """
+
+    keys: list = list(column_data.keys())
+    return [dict(zip(keys, row)) for row in zip(*column_data.values())]
+
+
+def to_rows_json(res: dict) -> dict:
+    """
+    Converts a response with column-oriented data to the row-oriented
+    layout sent as application/json.
+
+    Args:
+        res (dict): response dictionary (see ResponseData.get_response_dict)
+
+    Returns:
+        dict: response dictionary with 'rowData' in place of 'columnData'
+    """
+
+    if 'columnData' not in res['data']:
+        return res
+
+    data: dict = dict(res['data'])
+    data['rowData'] = rows_from_columns(data.pop('columnData'))
+    return {**res, 'data': data}
+
+
+def to_arrow_stream(res: dict) -> bytes:
+    """
+    Encodes a response with column-oriented data as an Arrow IPC stream.
+    Columns whose values pyarrow can't store under one type are sent as text.
+
+    Args:
+        res (dict): response dictionary (see ResponseData.get_response_dict)
+
+    Returns:
+        bytes: the Arrow IPC stream
+    """
+
+    data: dict = dict(res['data'])
+    column_data: dict = data.pop('columnData', {})
+
+    arrays: list = []
+    for values in column_data.values():
+        try:
+            arrays.append(pyarrow.array(values))
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, OverflowError):
+            arrays.append(pyarrow.array([None if value is None else str(value) for value in values]))
+
+    metadata: dict = {ARROW_METADATA_KEY: dumps_json({**res, 'data': data})}
+    table = pyarrow.Table.from_arrays(arrays, names=list(column_data.keys()), metadata=metadata)
+
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
@@ -0,0 +1,118 @@
+"""
+indexes.py:
+Indexes on loaded tables. The columns chosen in the UI are indexed by a
+background 'index' job started once the table is loaded (see
+submit_index_job), so the table can be queried while the indexes are
+built.
+
+The columns that each session's queries filter (WHERE) and sort
+(ORDER BY) by are counted (see record_query_columns). Columns of tables
+with at least INDEX_SUGGESTION_MIN_ROWS rows that were used by at least
+INDEX_SUGGESTION_MIN_QUERIES queries and aren't indexed yet are suggested
+for indexing (see suggest_indexes).
+"""
+
+from collections import Counter
+from os import environ
+from threading import Lock
+from jobs import Job, submit_job
+from postgres import create_index, get_column_indexes
+from response_data import ResponseData
+from sql import check_query, find_filter_columns
+
+# Number of queries that must filter or sort by a column before it is suggested for indexing
+INDEX_SUGGESTION_MIN_QUERIES: int = int(environ.get('CSVT_INDEX_SUGGESTION_MIN_QUERIES', 3))
+
+# Tables with fewer (estimated) rows than this are scanned quickly enough without indexes
+INDEX_SUGGESTION_MIN_ROWS: int = int(environ.get('CSVT_INDEX_SUGGESTION_MIN_ROWS', 10000))
+
+# Schema -> Counter of Column Name -> number of queries that filtered or sorted by it
+_query_columns: dict = {}
+_query_columns_lock = Lock()
+
+
+def record_query_columns(query: str, schema: str):
+    """
+    Counts the columns a query executed in a session filters or sorts by.
+
+    Args:
+        query (str): executed query
+        schema (str): session schema the query was executed in
+    """
+
+    columns: set = find_filter_columns(check_query(query).tokens)
+    if not columns:
+        return
+
+    with _query_columns_lock:
+        _query_columns.setdefault(schema, Counter()).update(columns)
+
+
+def forget_query_columns(schema: str):
+    """
+    Forgets the query columns counted for a session (e.g. once its schema is dropped).
+
+    Args:
+        schema (str): session schema
+    """
+
+    with _query_columns_lock:
+        _query_columns.pop(schema, None)
+
+
+def suggest_indexes(schema: str, res_data: ResponseData):
+    """
+    Puts the columns suggested for indexing in the response: columns of
+    the session's tables that aren't the first column of an index, in
+    tables of at least INDEX_SUGGESTION_MIN_ROWS rows, that at least
+    INDEX_SUGGESTION_MIN_QUERIES queries filtered or sorted by. Columns are
+    matched by name, so a column used by a query is suggested for every
+    table that has it. The most used columns come first.
+
+    Args:
+        schema (str): session schema
+        res_data (ResponseData): object to hold data for the response
+    """
+
+    with _query_columns_lock:
+        counts: Counter = Counter(_query_columns.get(schema, {}))
+
+    column_indexes: list = get_column_indexes(schema, res_data)
+    if column_indexes is None:
+        return
+
+    suggestions: list = [
+        {'tableName': table_name, 'column': column, 'queries': counts[column], 'rows': rows}
+        for table_name, column, rows, indexed in column_indexes
+        if not indexed and rows >= INDEX_SUGGESTION_MIN_ROWS and counts[column] >= INDEX_SUGGESTION_MIN_QUERIES]
+    suggestions.sort(key=lambda suggestion: -suggestion['queries'])
+
+    res_data.set_data({'suggestions': suggestions})
+
+
+def submit_index_job(table_name: str, columns: list, schema: str, res_data: ResponseData):
+    """
+    Starts a background job that indexes columns of a table one at a time
+    (see postgres.create_index), and puts its status in the response as
+    'indexJob'. The job's progress counts the columns indexed so far, and
+    it stops at the first index that can't be created.
+
+    Args:
+        table_name (str): name of table
+        columns (list): names of the columns to index
+        schema (str): session schema of the table
+        res_data (ResponseData): object to hold data for the response
+    """
+
+    if not columns:
+        return
+
+    def build(job: Job, job_res_data: ResponseData):
+        for column_idx, column in enumerate(columns):
+            if not create_index(table_name, column, schema, job_res_data):
+                return
+            job.update_progress(column_idx + 1, 0)
+        job_res_data.set_data({'tableName': table_name, 'indexedColumns': columns})
+
+    job: Job = submit_job('index', schema, build, len(columns))
+    res_data.data['indexJob'] = job.get_status_dict()
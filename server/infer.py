@@ -0,0 +1,375 @@
+"""
+infer.py:
+Column type inference for uploaded CSV data. Suggests a UI data type
+(bool, int, bigint, float, date, timestamp or text) for every column,
+along with the ratio of missing values and how confident the suggestion is.
+
+Values are classified a whole column (chunk) at a time. Every value gets a
+set of type flags (one bit per type it could be stored as), and a column's
+type is the narrowest type that every non-null value can be stored as.
+By default every row is classified; for very large files, a fixed-size
+reservoir sample of rows can be classified instead, which bounds the time
+and memory used no matter how many rows the file has.
+"""
+
+from os import environ
+from numpy import arange, ndarray, floor, isfinite, random, uint8, where, zeros
+from pandas import DataFrame, Series, factorize, to_datetime, to_numeric
+
+# Number of rows to classify per file; 0 means classify every row
+INFER_SAMPLE_ROWS: int = int(environ.get('CSVT_INFER_SAMPLE_ROWS', 0))
+
+# Type flags (one bit per type a value can be stored as)
+NON_NULL: int = 1
+BOOL: int = 2
+INT: int = 4
+BIGINT: int = 8
+FLOAT: int = 16
+DATE: int = 32
+TIMESTAMP: int = 64
+
+# Candidate types, narrowest first; a column is text if no other type fits
+type_flag_order: list = [
+    ('bool', BOOL),
+    ('int', INT),
+    ('bigint', BIGINT),
+    ('float', FLOAT),
+    ('date', DATE),
+    ('timestamp', TIMESTAMP)
+]
+
+# UI data type -> flag of values that can be converted to it (any value can be text)
+data_type_flags: dict = dict(type_flag_order)
+
+# Range of values of the PostgreSQL integer and bigint types
+INT_MIN: int = -2 ** 31
+INT_MAX: int = 2 ** 31 - 1
+BIGINT_MIN: int = -2 ** 63
+BIGINT_MAX: int = 2 ** 63 - 1
+
+# Largest number of offending row numbers reported per column when values can't be converted
+MAX_REPORTED_ROWS: int = 10
+
+# Characters that bool values and numbers/dates can start with (i and n for infinity and NaN)
+BOOL_FIRST_CHARS: str = 'tTfFyYnN'
+NUMBER_FIRST_CHARS: str = '0123456789+-.iInN'
+
+# Patterns that text values are matched against
+BOOL_PATTERN: str = r'true|false|t|f|yes|no|y|n'
+INT_PATTERN: str = r'[+-]?\d+'
+# Floats that aren't numbers, as PostgreSQL spells them (matched ignoring case)
+SPECIAL_FLOAT_PATTERN: str = r'[+-]?(inf|infinity)|nan'
+TIMESTAMP_PATTERN: str = r'\d{4}-\d{2}-\d{2}([ T]([01]\d|2[0-3]):[0-5]\d(:[0-5]\d(\.\d{1,6})?)?)?'
+
+
+class TypeInferrer:
+    """
+    Accumulates type statistics for the columns of a CSV file, one
+    chunk at a time, and suggests a data type for every column.
+    Columns are identified by their position in the file.
+    """
+
+    def __init__(self, sample_rows: int = INFER_SAMPLE_ROWS):
+        # Number of rows in the reservoir sample (0 = classify every row)
+        self.sample_rows: int = sample_rows
+        self.rows_seen: int = 0
+        self.null_counts: ndarray = None
+
+        # Full scan: number of values with each type flag, per column
+        self.flag_counts: dict = {}
+
+        # Sampling: type flags of the sampled rows (sample_rows x columns)
+        self.reservoir: ndarray = None
+        self.rng = random.default_rng()
+
+    def update(self, df: DataFrame):
+        """
+        Adds the values in a chunk of data to the statistics.
+
+        Args:
+            df (DataFrame): next chunk of CSV data
+        """
+
+        # Missing values are counted over every row, even when sampling
+        null_counts: ndarray = df.isna().sum().to_numpy()
+        self.null_counts = null_counts if self.null_counts is None else self.null_counts + null_counts
+
+        if self.sample_rows:
+            self.update_reservoir(df)
+        else:
+            for col_idx in range(df.shape[1]):
+                flags: ndarray = type_flags(df.iloc[:, col_idx])
+                counts: list = self.flag_counts.setdefault(col_idx, [0] * 8)
+                for bit in range(8):
+                    counts[bit] += int(((flags >> bit) & 1).sum())
+
+        self.rows_seen += len(df)
+
+    def update_reservoir(self, df: DataFrame):
+        """
+        Updates the reservoir sample with a chunk of data (Algorithm R).
+        Only the rows that enter the sample are classified.
+
+        Args:
+            df (DataFrame): next chunk of CSV data
+        """
+
+        if self.reservoir is None:
+            self.reservoir = zeros((self.sample_rows, df.shape[1]), dtype=uint8)
+
+        # Row number of every row in the chunk, counted over the whole file
+        row_numbers: ndarray = self.rows_seen + arange(len(df))
+
+        # Rows that fill the reservoir keep their slot; later rows replace a random
+        # slot with probability sample_rows / (row_number + 1)
+        slots: ndarray = row_numbers.copy()
+        is_late: ndarray = row_numbers >= self.sample_rows
+        slots[is_late] = self.rng.integers(0, row_numbers[is_late] + 1)
+        selected: ndarray = slots < self.sample_rows
+        if not selected.any():
+            return
+
+        sampled: DataFrame = df.iloc[selected.nonzero()[0]]
+        for col_idx in range(df.shape[1]):
+            # Later rows overwrite earlier rows assigned to the same slot
+            self.reservoir[slots[selected], col_idx] = type_flags(sampled.iloc[:, col_idx])
+
+    def column_types(self) -> dict:
+        """
+        Suggests a data type for every column seen so far.
+
+        Returns:
+            dict: Column Index -> {'type': str, 'nullRatio': float, 'confidence': float}
+        """
+
+        if self.null_counts is None:
+            return {}
+
+        sampled_rows: int = min(self.rows_seen, self.sample_rows) if self.sample_rows else self.rows_seen
+        column_types: dict = {}
+
+        for col_idx, null_count in enumerate(self.null_counts):
+            if self.sample_rows:
+                flags: ndarray = self.reservoir[:sampled_rows, col_idx]
+                counts: list = [int(((flags >> bit) & 1).sum()) for bit in range(8)]
+            else:
+                counts = self.flag_counts.get(col_idx, [0] * 8)
+
+            column_types[col_idx] = {
+                **suggest_type(counts, sampled=bool(self.sample_rows) and self.rows_seen > self.sample_rows),
+                'nullRatio': round(float(null_count) / self.rows_seen, 4) if self.rows_seen else 0.0
+            }
+
+        return column_types
+
+
+def suggest_type(counts: list, sampled: bool) -> dict:
+    """
+    Picks the narrowest type that every classified non-null value can be
+    stored as. The confidence is the share of non-null values that fit the
+    type; for text, it is the share of values that fit no other type, so a
+    low confidence points at a column that is mostly e.g. int with a few
+    bad values. When only a sample of rows was classified, the confidence
+    is lowered by 3/n (n = non-null values in the sample), the "rule of
+    three" bound on the share of unseen values that could differ.
+
+    Args:
+        counts (list): number of values with each type flag bit set
+        sampled (bool): whether the counts come from a sample of the rows
+
+    Returns:
+        dict: {'type': str, 'confidence': float}
+    """
+
+    non_null: int = counts[flag_bit(NON_NULL)]
+    if non_null == 0:
+        # No values to go by
+        return {'type': 'text', 'confidence': 0.0}
+
+    # Narrowest type every value fits, else text
+    suggested_type: str = 'text'
+    for type_text, flag in type_flag_order:
+        if counts[flag_bit(flag)] == non_null:
+            suggested_type = type_text
+            break
+
+    if suggested_type == 'text':
+        best_other: int = max(counts[flag_bit(flag)] for _, flag in type_flag_order)
+        confidence: float = 1 - best_other / non_null
+    else:
+        confidence = 1.0
+
+    if sampled:
+        confidence -= 3 / non_null
+
+    return {'type': suggested_type, 'confidence': round(max(confidence, 0.0), 4)}
+
+
+def flag_bit(flag: int) -> int:
+    """
+    Returns the bit position of a type flag.
+
+    Args:
+        flag (int): type flag
+
+    Returns:
+        int: bit position of the flag
+    """
+
+    return flag.bit_length() - 1
+
+
+def type_flags(column: Series) -> ndarray:
+    """
+    Classifies every value of a column, in a vectorized way.
+
+    Args:
+        column (Series): column to classify
+
+    Returns:
+        ndarray: type flags (uint8) of every value in the column
+    """
+
+    flags: ndarray = zeros(len(column), dtype=uint8)
+    non_null: ndarray = column.notna().to_numpy()
+    if not non_null.any():
+        return flags
+
+    kind: str = column.dtype.kind
+    values = column.to_numpy()[non_null]
+
+    if kind == 'b':
+        value_flags = NON_NULL | BOOL
+    elif kind in 'iu':
+        value_flags = integer_flags(values) | FLOAT
+    elif kind == 'f':
+        integral: ndarray = isfinite(values) & (values == floor(values))
+        value_flags = zeros(len(values), dtype=uint8) | NON_NULL | FLOAT
+        value_flags[integral] |= integer_flags(values[integral])
+    elif kind == 'M':
+        value_flags = NON_NULL | TIMESTAMP
+    else:
+        # Classify each distinct value once, then map the flags back to every value
+        # (selected from the column itself, so text read as str keeps its string storage)
+        codes, uniques = factorize(column[non_null].astype(str).str.strip())
+        value_flags = text_flags(Series(uniques))[codes]
+
+    flags[non_null] = value_flags
+    return flags
+
+
+def integer_flags(values: ndarray) -> ndarray:
+    """
+    Classifies integral numeric values by the integer types they fit in.
+
+    Args:
+        values (ndarray): integral numeric values
+
+    Returns:
+        ndarray: type flags of every value
+    """
+
+    flags: ndarray = zeros(len(values), dtype=uint8) | NON_NULL
+    flags[(values >= BIGINT_MIN) & (values <= BIGINT_MAX)] |= BIGINT
+    flags[(values >= INT_MIN) & (values <= INT_MAX)] |= INT
+    return flags
+
+
+def text_flags(values: Series) -> ndarray:
+    """
+    Classifies text values by the types they can be converted to.
+    Only values whose first character could start a number, date or
+    bool are checked any further, so free text is classified cheaply.
+
+    Args:
+        values (Series): non-null text values, stripped of surrounding whitespace
+
+    Returns:
+        ndarray: type flags of every value
+    """
+
+    flags: ndarray = zeros(len(values), dtype=uint8) | NON_NULL
+    first_chars: Series = values.str[:1]
+
+    is_bool_candidate: ndarray = first_chars.isin(list(BOOL_FIRST_CHARS)).to_numpy()
+    if is_bool_candidate.any():
+        candidates: Series = values[is_bool_candidate]
+        flags[is_bool_candidate] |= where(candidates.str.fullmatch(BOOL_PATTERN, case=False), BOOL, 0).astype(uint8)
+
+    is_number_candidate: ndarray = first_chars.isin(list(NUMBER_FIRST_CHARS)).to_numpy()
+    if not is_number_candidate.any():
+        return flags
+
+    candidates = values[is_number_candidate]
+    candidate_flags: ndarray = zeros(len(candidates), dtype=uint8)
+
+    numbers: Series = to_numeric(candidates, errors='coerce')
+    is_float: Series = numbers.notna() | candidates.str.fullmatch(SPECIAL_FLOAT_PATTERN, case=False)
+    candidate_flags[is_float.to_numpy()] |= FLOAT
+
+    is_int: ndarray = candidates.str.fullmatch(INT_PATTERN).to_numpy()
+    if is_int.any():
+        int_values: ndarray = numbers[is_int].to_numpy(dtype=float)
+        candidate_flags[is_int] |= integer_flags(int_values) & (INT | BIGINT)
+
+    is_timestamp: Series = candidates.str.fullmatch(TIMESTAMP_PATTERN)
+    if is_timestamp.any():
+        # The patterns don't check that the day exists in the month, so parse the date part too
+        valid_date: Series = to_datetime(
+            candidates.str[:10].where(is_timestamp), format='%Y-%m-%d', errors='coerce').notna()
+        is_timestamp = is_timestamp & valid_date
+        candidate_flags[is_timestamp.to_numpy()] |= TIMESTAMP
+        candidate_flags[(is_timestamp & (candidates.str.len() == 10)).to_numpy()] |= DATE
+
+    flags[is_number_candidate] |= candidate_flags
+    return flags
+
+
+def find_conversion_errors(df: DataFrame, column_data_types: dict) -> dict:
+    """
+    Finds the values of a chunk of CSV text that can't be converted to the
+    data types chosen in the UI, using the same rules that are used to
+    infer column types. A row's number is its index in the chunk plus 1,
+    so rows numbered across chunks (see data.read_csv_chunks) are numbered
+    from 1 within the file, not counting the header.
+
+    Args:
+        df (DataFrame): chunk of CSV text, with the UI column names
+        column_data_types (dict): column data types specified in UI
+
+    Returns:
+        dict: Column Name -> numbers of the first MAX_REPORTED_ROWS rows with
+              values that can't be converted (only columns with such values)
+    """
+
+    errors: dict = {}
+
+    for column in df:
+        flag: int = data_type_flags.get(column_data_types.get(column, 'text'))
+        if flag is None:
+            # Any value can be text
+            continue
+
+        is_bad: ndarray = (type_flags(df[column]) & (NON_NULL | flag)) == NON_NULL
+        if is_bad.any():
+            errors[column] = (df.index[is_bad][:MAX_REPORTED_ROWS] + 1).tolist()
+
+    return errors
+
+
+def conversion_error_message(errors: dict, column_data_types: dict) -> str:
+    """
+    Describes the values that can't be converted to their columns' data types.
+
+    Args:
+        errors (dict): Column Name -> row numbers (see find_conversion_errors)
+        column_data_types (dict): column data types specified in UI
+
+    Returns:
+        str: error message for the UI
+    """
+
+    return 'Some values cannot be converted to the chosen data types: ' + '; '.join(
+        f'"{col}" ({column_data_types[col]}) in row{"s" if len(rows) > 1 else ""} '
+        f'{", ".join(str(row) for row in rows)}'
+        for col, rows in errors.items())
@@ -0,0 +1,276 @@
+"""
+jobs.py:
+Background jobs for long-running table loads, CSV exports and index builds. A job runs
+on a thread pool for its job type (at most JOB_WORKERS[type] jobs of a
+type run at once; later ones wait in a queue), so the request that
+starts it can return a job ID straight away. The UI then polls the job
+for its progress and fetches its result once it is done. A job can be
+cancelled while it is queued or running; a running job stops the next
+time it reports progress.
+
+Finished jobs (and their result files) are kept for JOB_TTL_SECONDS; expired
+ones are removed whenever a job is submitted and by the session garbage
+collector (see collect_expired_jobs).
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from os import environ, remove
+from threading import Event, Lock
+from time import monotonic
+from typing import Callable
+from uuid import uuid4
+from response_data import ResponseData
+
+# Maximum number of jobs of each type that run at the same time
+JOB_WORKERS: dict = {
+    'load': int(environ.get('CSVT_LOAD_JOB_WORKERS', 2)),
+    'export': int(environ.get('CSVT_EXPORT_JOB_WORKERS', 2)),
+    'index': int(environ.get('CSVT_INDEX_JOB_WORKERS', 1))
+}
+
+# Seconds a finished job (and its result) is kept for
+JOB_TTL_SECONDS: float = float(environ.get('CSVT_JOB_TTL_SECONDS', 60 * 60))
+
+# Job ID -> Job
+_jobs: dict = {}
+_jobs_lock = Lock()
+
+# Job Type -> ThreadPoolExecutor (see get_executor)
+_executors: dict = {}
+
+
+class JobCancelledError(Exception):
+    """Raised in a running job when it reports progress after being cancelled."""
+
+
+class Job:
+    """
+    A background job: its state, progress and result.
+    """
+
+    def __init__(self, job_type: str, schema: str, total_rows: int = None):
+        self.id: str = uuid4().hex
+        self.type: str = job_type
+        self.schema: str = schema
+
+        # queued -> running -> done, failed or cancelled
+        self.status: str = 'queued'
+        self.rows: int = 0
+        self.bytes: int = 0
+        self.total_rows: int = total_rows
+        self.started: float = None
+        self.finished: float = None
+
+        # The job's response, and the path of the CSV file written by an export job
+        self.result: dict = None
+        self.result_path: str = None
+        self.error: str = ''
+
+        self.cancel_requested = Event()
+        self.future: Future = None
+
+    def update_progress(self, rows: int, total_bytes: int):
+        """
+        Records how much of the job is done. Called by the running job.
+
+        Args:
+            rows (int): number of rows processed so far
+            total_bytes (int): number of bytes processed so far
+
+        Raises:
+            JobCancelledError: if the job has been cancelled
+        """
+
+        self.rows = rows
+        self.bytes = total_bytes
+        if self.cancel_requested.is_set():
+            raise JobCancelledError()
+
+    def get_status_dict(self) -> dict:
+        """
+        Returns the job's state and progress for the UI. The ETA is
+        estimated from the rate so far, if the total number of rows is known.
+
+        Returns:
+            dict: job status
+        """
+
+        elapsed: float = 0.0
+        if self.started is not None:
+            elapsed = (self.finished or monotonic()) - self.started
+
+        eta: float = None
+        if self.status == 'running' and self.total_rows and self.rows:
+            eta = round(elapsed * max(self.total_rows - self.rows, 0) / self.rows, 1)
+
+        return {
+            'jobId': self.id,
+            'type': self.type,
+            'status': self.status,
+            'rowsProcessed': self.rows,
+            'bytesProcessed': self.bytes,
+            'totalRows': self.total_rows,
+            'elapsedSeconds': round(elapsed, 3),
+            'etaSeconds': eta,
+            'error': self.error
+        }
+
+
+def get_executor(job_type: str) -> ThreadPoolExecutor:
+    """
+    Returns the thread pool that runs jobs of a type, creating it if needed.
+    Must be called with _jobs_lock held.
+
+    Args:
+        job_type (str): job type (a key of JOB_WORKERS)
+
+    Returns:
+        ThreadPoolExecutor: thread pool for the job type
+    """
+
+    if job_type not in _executors:
+        _executors[job_type] = ThreadPoolExecutor(
+            max_workers=JOB_WORKERS[job_type], thread_name_prefix=f'csvt-{job_type}')
+    return _executors[job_type]
+
+
+def submit_job(job_type: str, schema: str, work: Callable, total_rows: int = None) -> Job:
+    """
+    Queues a job. work is called on the job type's thread pool with the
+    Job (to report progress on) and a ResponseData object (to report errors
+    and, for load jobs, the result in).
+
+    Args:
+        job_type (str): job type (a key of JOB_WORKERS)
+        schema (str): session schema the job belongs to
+        work (Callable): function doing the work, work(job, res_data)
+        total_rows (int): number of rows the job will process, if known
+
+    Returns:
+        Job: the queued job
+    """
+
+    job = Job(job_type, schema, total_rows)
+
+    with _jobs_lock:
+        remove_expired_jobs()
+        _jobs[job.id] = job
+        job.future = get_executor(job_type).submit(run_job, job, work)
+
+    return job
+
+
+def run_job(job: Job, work: Callable):
+    """
+    Runs a job on a worker thread and records how it ended.
+
+    Args:
+        job (Job): job to run
+        work (Callable): function doing the work, work(job, res_data)
+    """
+
+    res_data = ResponseData()
+
+    if job.cancel_requested.is_set():
+        res_data.fail(409, 'Job was cancelled')
+        finish_job(job, res_data)
+        return
+
+    job.status = 'running'
+    job.started = monotonic()
+
+    try:
+        work(job, res_data)
+    except JobCancelledError:
+        res_data.fail(409, 'Job was cancelled')
+    except Exception as err:
+        # Don't let one job's unexpected error take down the worker thread
+        print(f'Error in run_job: {err}')
+        res_data.fail(500, 'Job failed')
+
+    finish_job(job, res_data)
+
+
+def finish_job(job: Job, res_data: ResponseData):
+    """
+    Records the result of a job that has stopped.
+
+    Args:
+        job (Job): job that stopped
+        res_data (ResponseData): the job's response
+    """
+
+    job.result = res_data.get_response_dict()
+    job.error = res_data.error
+    if res_data.success:
+        job.status = 'done'
+    else:
+        job.status = 'cancelled' if job.cancel_requested.is_set() else 'failed'
+    job.finished = monotonic()
+
+
+def lookup_job(job_id: str, schema: str) -> Job:
+    """
+    Looks up a job of a session.
+
+    Args:
+        job_id (str): job ID
+        schema (str): session schema the job must belong to
+
+    Returns:
+        Job: the job, or None if the ID is unknown, has expired or belongs to another session
+    """
+
+    with _jobs_lock:
+        job: Job = _jobs.get(job_id)
+        if job is None or job.schema != schema:
+            return None
+        return job
+
+
+def cancel_job(job: Job):
+    """
+    Cancels a job. A queued job never starts; a running job stops the
+    next time it reports progress. Finished jobs are left as they are.
+
+    Args:
+        job (Job): job to cancel
+    """
+
+    if job.status in ('queued', 'running'):
+        job.cancel_requested.set()
+        if job.future.cancel():
+            # Removed from the queue before it started
+            res_data = ResponseData()
+            res_data.fail(409, 'Job was cancelled')
+            finish_job(job, res_data)
+
+
+def collect_expired_jobs():
+    """
+    Forgets expired jobs and deletes their result files (see remove_expired_jobs),
+    so they don't pile up on a server where no new jobs are submitted.
+    """
+
+    with _jobs_lock:
+        remove_expired_jobs()
+
+
+def remove_expired_jobs():
+    """
+    Forgets jobs that finished more than JOB_TTL_SECONDS ago and deletes
+    their result files. Must be called with _jobs_lock held.
+    """
+
+    now: float = monotonic()
+    for job_id in [job_id for job_id, job in _jobs.items()
+                   if job.finished is not None and now - job.finished > JOB_TTL_SECONDS]:
+        job: Job = _jobs.pop(job_id)
+        if job.result_path is not None:
+            try:
+                remove(job.result_path)
+            except FileNotFoundError:
+                # Deleted with its session's upload directory already
+                pass
+            except OSError as os_err:
+                print(f'Error in remove_expired_jobs: {os_err}')
@@ -0,0 +1,318 @@
+"""
+parallel.py:
+Parallel loading of large CSV files. The file is split into ranges of
+about RANGE_BYTES at row boundaries (see split_csv), the ranges are parsed
+and checked in a pool of worker processes, and the parsed ranges are
+copied into staging tables over several pooled connections at once. The
+table is then built from the staging tables in range order, so its rows
+(and the row IDs the UI numbers them by) are in the same order as if the
+file had been loaded in one piece.
+
+Only files of at least PARALLEL_LOAD_MIN_BYTES are loaded this way, and
+only if PARALLEL_LOAD_WORKERS is more than 1.
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from multiprocessing import get_context
+from os import cpu_count, environ
+from os.path import getsize
+from threading import Lock
+from time import perf_counter
+from typing import Callable
+from uuid import uuid4
+from pandas import DataFrame, read_csv
+from pandas.errors import EmptyDataError, ParserError
+from infer import conversion_error_message, find_conversion_errors
+from postgres import build_table_from_staging, copy_csv, create_staging_tables, drop_tables, iter_csv_chunks, load_stats
+from response_data import ResponseData
+
+# Number of processes parsing ranges (and of connections copying them) per load; 1 turns parallel loading off
+PARALLEL_LOAD_WORKERS: int = int(environ.get('CSVT_PARALLEL_LOAD_WORKERS', min(4, cpu_count() or 1)))
+
+# Files smaller than this (in bytes) are loaded on one connection
+PARALLEL_LOAD_MIN_BYTES: int = int(environ.get('CSVT_PARALLEL_LOAD_MIN_BYTES', 256 * 1024 * 1024))
+
+# Approximate size of the ranges a file is split into, in bytes
+RANGE_BYTES: int = int(environ.get('CSVT_PARALLEL_RANGE_BYTES', 64 * 1024 * 1024))
+
+# Number of bytes read at a time when looking for row boundaries
+SCAN_BLOCK_BYTES: int = 1024 * 1024
+
+# Prefix of the names of staging tables
+STAGING_PREFIX: str = 'csvt_load_'
+
+_parse_pool: ProcessPoolExecutor = None
+_parse_pool_lock = Lock()
+
+
+def use_parallel_load(filepath: str) -> bool:
+    """
+    Decides whether a CSV file is large enough to be loaded in parallel.
+
+    Args:
+        filepath (str): path to CSV file
+
+    Returns:
+        bool: whether to load the file with load_csv_in_parallel
+    """
+
+    return PARALLEL_LOAD_WORKERS > 1 and getsize(filepath) >= PARALLEL_LOAD_MIN_BYTES
+
+
+def split_csv(filepath: str, has_header: bool, range_bytes: int = RANGE_BYTES) -> list[tuple]:
+    """
+    Splits a CSV file into byte ranges of about range_bytes that each hold
+    whole rows. A range ends after the first line break at or after its
+    target size that isn't inside a quoted value, so values with line
+    breaks in them are never cut. The header row (if any) is in no range.
+
+    Args:
+        filepath (str): path to CSV file
+        has_header (bool): whether the CSV file has a head row or not
+        range_bytes (int): target size of each range
+
+    Returns:
+        list[tuple]: (start, end) byte offsets of each range, in file order
+    """
+
+    size: int = getsize(filepath)
+    ranges: list = []
+
+    with open(filepath, 'rb') as csv_file:
+        start: int = find_row_end(csv_file, 0, False) if has_header else 0
+        while start < size:
+            target: int = min(start + range_bytes, size)
+
+            # A range starts outside quotes, so the quotes before the target tell if it's inside a value
+            csv_file.seek(start)
+            quotes: int = 0
+            remaining: int = target - start
+            while remaining > 0:
+                block: bytes = csv_file.read(min(SCAN_BLOCK_BYTES, remaining))
+                if not block:
+                    break
+                quotes += block.count(b'"')
+                remaining -= len(block)
+
+            end: int = find_row_end(csv_file, target, quotes % 2 == 1)
+            ranges.append((start, end))
+            start = end
+
+    return ranges
+
+
+def find_row_end(csv_file, offset: int, in_quotes: bool) -> int:
+    """
+    Finds the end of the row that a byte offset of a CSV file is in.
+
+    Args:
+        csv_file: CSV file opened in binary mode
+        offset (int): offset to search from
+        in_quotes (bool): whether the offset is inside a quoted value
+
+    Returns:
+        int: offset just after the row's line break (the file size if the row is the last one)
+    """
+
+    csv_file.seek(offset)
+    while True:
+        block: bytes = csv_file.read(SCAN_BLOCK_BYTES)
+        if not block:
+            return offset
+
+        pos: int = 0
+        while True:
+            newline: int = block.find(b'\n', pos)
+            if newline == -1:
+                in_quotes ^= block.count(b'"', pos) % 2 == 1
+                break
+            in_quotes ^= block.count(b'"', pos, newline) % 2 == 1
+            if not in_quotes:
+                return offset + newline + 1
+            pos = newline + 1
+
+        offset += len(block)
+
+
+def parse_range(filepath: str, start: int, end: int, columns: list, column_names: list,
+                column_data_types: dict) -> tuple:
+    """
+    Parses a range of a CSV file (see split_csv) as text and checks that
+    its values can be converted to the data types chosen in the UI.
+    Runs in a worker process.
+
+    Args:
+        filepath (str): path to CSV file
+        start (int): offset of the range's first byte
+        end (int): offset just after the range's last byte
+        columns (list): positions of the columns to load
+        column_names (list): UI names of the columns to load
+        column_data_types (dict): column data types specified in UI
+
+    Returns:
+        tuple: number of rows, the rows as CSV for COPY (see postgres.iter_csv_chunks), and
+               Column Name -> row numbers within the range of values that can't be converted
+    """
+
+    with open(filepath, 'rb') as csv_file:
+        csv_file.seek(start)
+        raw_data: bytes = csv_file.read(end - start)
+
+    try:
+        df: DataFrame = read_csv(BytesIO(raw_data), header=None, usecols=columns, dtype=str, encoding='utf-8')
+    except EmptyDataError:
+        # Only blank lines
+        return 0, b'', {}
+
+    df.columns = column_names
+    return len(df), b''.join(iter_csv_chunks(df)), find_conversion_errors(df, column_data_types)
+
+
+def get_parse_pool() -> ProcessPoolExecutor:
+    """
+    Returns the pool of processes that parse ranges, starting it if needed.
+    The processes are spawned rather than forked, since the server has
+    threads (and DB connections) that must not be copied into them.
+
+    Returns:
+        ProcessPoolExecutor: the parse pool
+    """
+
+    global _parse_pool
+
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            _parse_pool = ProcessPoolExecutor(max_workers=PARALLEL_LOAD_WORKERS, mp_context=get_context('spawn'))
+        return _parse_pool
+
+
+def shutdown_parse_pool():
+    """
+    Stops the parse pool's processes, e.g. so the next load starts a pool
+    with a different number of workers. A new pool is started when needed.
+    """
+
+    global _parse_pool
+
+    with _parse_pool_lock:
+        if _parse_pool is not None:
+            _parse_pool.shutdown()
+            _parse_pool = None
+
+
+def load_csv_in_parallel(filepath: str, has_header: bool, columns: list, column_names: list, table_name: str,
+                         column_types: dict, column_data_types: dict, schema: str, res_data: ResponseData,
+                         on_progress: Callable = None, content_hash: str = None) -> dict:
+    """
+    Creates a new table in a session's schema from a CSV file, parsing and
+    copying ranges of the file in parallel. At most twice as many ranges as
+    there are workers are parsed or waiting to be copied at a time, so only
+    that many ranges are held in memory. Stops at the first range (in file
+    order) with values that can't be converted, and adds the offending row
+    numbers, counted over the whole file, to the response. The staging
+    tables are dropped if the load fails or on_progress raises.
+
+    Args:
+        filepath (str): path to CSV file
+        has_header (bool): whether the CSV file has a head row or not
+        columns (list): positions of the columns to load
+        column_names (list): UI names of the columns to load
+        table_name (str): name of table
+        column_types (dict): UI data type of each column (see postgres.init_table)
+        column_data_types (dict): column data types specified in UI
+        schema (str): session schema to create the table in
+        res_data (ResponseData): object to hold data for response
+        on_progress (Callable): called with the rows and bytes loaded so far after every range
+        content_hash (str): content hash of the file (see postgres.record_loaded_file)
+
+    Returns:
+        dict: load statistics (see postgres.load_stats) if the table was created, else None
+    """
+
+    start: float = perf_counter()
+
+    ranges: list = split_csv(filepath, has_header)
+    if not ranges:
+        res_data.fail(422, 'No data to load')
+        return None
+
+    load_id: str = uuid4().hex[:8]
+    staging_tables: list = [f'{STAGING_PREFIX}{load_id}_{range_idx}' for range_idx in range(len(ranges))]
+    if not create_staging_tables(staging_tables, column_names, schema, res_data):
+        return None
+
+    parse_pool: ProcessPoolExecutor = get_parse_pool()
+    window: int = 2 * PARALLEL_LOAD_WORKERS
+    parses: deque = deque()
+    copies: deque = deque()
+    rows_before: int = 0
+    total_rows: int = 0
+    total_bytes: int = 0
+    built: bool = False
+
+    try:
+        with ThreadPoolExecutor(max_workers=PARALLEL_LOAD_WORKERS, thread_name_prefix='csvt-copy') as copy_pool:
+            try:
+                next_range: int = 0
+                for range_idx in range(len(ranges)):
+                    # Keep the parse pool busy without holding more than the window in memory
+                    while next_range < len(ranges) and next_range - range_idx + len(copies) < window:
+                        parses.append(parse_pool.submit(
+                            parse_range, filepath, *ranges[next_range], columns, column_names, column_data_types))
+                        next_range += 1
+
+                    try:
+                        rows, csv_data, errors = parses.popleft().result()
+                    except (OSError, UnicodeDecodeError, ParserError, BrokenProcessPool) as parse_err:
+                        print(f'Error in load_csv_in_parallel: {parse_err}')
+                        res_data.fail(500, 'Failed to parse CSV')
+                        break
+
+                    if errors:
+                        # Number the rows over the whole file
+                        errors = {col: [rows_before + row for row in col_rows] for col, col_rows in errors.items()}
+                        res_data.fail(422, conversion_error_message(errors, column_data_types))
+                        break
+                    rows_before += rows
+
+                    if rows:
+                        copies.append((copy_pool.submit(
+                            copy_csv, csv_data, staging_tables[range_idx], column_names, schema, res_data),
+                            rows, len(csv_data)))
+
+                    # Wait for the oldest copies once every connection is busy
+                    while len(copies) >= PARALLEL_LOAD_WORKERS or (copies and range_idx == len(ranges) - 1):
+                        copy, rows, copied_bytes = copies.popleft()
+                        copy.result()
+                        total_rows += rows
+                        total_bytes += copied_bytes
+                        if on_progress is not None:
+                            on_progress(total_rows, total_bytes)
+
+                    if not res_data.success:
+                        break
+            finally:
+                for parse in parses:
+                    parse.cancel()
+                for copy, _, _ in copies:
+                    copy.cancel()
+
+        if not res_data.success:
+            return None
+        if not total_rows:
+            res_data.fail(422, 'No data to load')
+            return None
+
+        built = build_table_from_staging(
+            table_name, column_names, column_types, staging_tables, schema, res_data, content_hash)
+    finally:
+        if not built:
+            drop_tables(staging_tables, schema)
+
+    if not built:
+        return None
+
+    return load_stats(total_rows, total_bytes, perf_counter() - start)
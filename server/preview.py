@@ -0,0 +1,442 @@
+"""
+preview.py:
+Compact column store for UI formatted table data kept on the server
+between requests, such as the previews of uploaded files kept for
+re-uploads (see uploads.cache_parse_result). A list of Python objects
+takes a pointer and an object (16 to 50+ bytes) per value; here each
+column is stored according to the type of its values:
+
+- int, float and bool columns as typed arrays (8, 8 and 1 bytes per value)
+- text columns with few distinct values as a dictionary of the distinct
+  values and an array of codes (1, 2 or 4 bytes per value)
+- other text columns as one UTF-8 buffer and an array of value end offsets
+- any other column (e.g. one mixing types, or holding ints that don't fit
+  in 64 bits) as a plain list
+
+Missing values (None, or NaN in text columns, as pandas reads them) are
+marked in a byte per row and come back as None, so a column reads back
+the same as the UI data it was built from. Rows can be read through
+RowView objects without materializing them.
+"""
+
+from array import array
+from math import isnan
+from sys import getsizeof
+from pandas import Series
+from numpy import ascontiguousarray, bool_, float64, int64, uint8
+
+# Text columns are dictionary encoded while they have at most this many distinct values...
+DICTIONARY_MIN_CATEGORIES: int = 256
+
+# ...or at most this fraction of their values are distinct
+DICTIONARY_MAX_RATIO: float = 0.5
+
+# Typecodes of the code arrays of dictionary encoded columns, narrowest first
+CODE_TYPECODES: tuple = ('B', 'H', 'L')
+
+# Value stored in place of a missing value, by column kind
+placeholders: dict = {'int': 0, 'float': 0.0, 'bool': False, 'dictionary': '', 'text': '', 'list': None}
+
+
+class RowView:
+    """
+    A row of a CompactTable, read from its columns when a value is looked up.
+    """
+
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index: int):
+        self.table = table
+        self.index: int = index
+
+    def __getitem__(self, column: str):
+        return self.table.columns[column][self.index]
+
+    def to_dict(self) -> dict:
+        """
+        Returns:
+            dict: Column Name -> Cell Value of the row
+        """
+
+        return {name: column[self.index] for name, column in self.table.columns.items()}
+
+
+class CompactColumn:
+    """
+    The values of one column, encoded according to their type (see the
+    module docstring). More values can be appended; if they don't fit the
+    column's encoding, the column is re-encoded (ints are widened to floats,
+    text dictionaries with too many distinct values become buffers, and
+    anything else, including ints too large for 64 bits, becomes a list).
+    """
+
+    __slots__ = ('kind', 'values', 'offsets', 'categories', 'lookup', 'missing', 'length')
+
+    def __init__(self):
+        # 'int', 'float', 'bool', 'dictionary', 'text' or 'list' ('' while empty)
+        self.kind: str = ''
+
+        # Typed array, byte buffer, code array or list, depending on the kind
+        self.values = None
+
+        # End offset of every value in the buffer of a 'text' column
+        self.offsets: array = None
+
+        # Distinct values of a 'dictionary' column, and Value -> Code
+        self.categories: list = None
+        self.lookup: dict = None
+
+        # 1 for every missing value (None if there are none; 'list' columns hold None themselves)
+        self.missing: bytearray = None
+        self.length: int = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index: int):
+        if self.missing is not None and self.missing[index]:
+            return None
+        if self.kind == 'bool':
+            return bool(self.values[index])
+        if self.kind == 'dictionary':
+            return self.categories[self.values[index]]
+        if self.kind == 'text':
+            start: int = self.offsets[index - 1] if index > 0 else 0
+            return self.values[start:self.offsets[index]].decode('utf-8')
+        return self.values[index]
+
+    def append(self, values):
+        """
+        Appends values to the column.
+
+        Args:
+            values (list or Series): values to append; int64, float64 and bool Series
+                                     are copied into the typed arrays without
+                                     converting every value to a Python object
+        """
+
+        if isinstance(values, Series):
+            kind: str = {int64: 'int', float64: 'float', bool_: 'bool'}.get(values.dtype.type, '')
+            if kind and (self.kind in ('', kind) or {kind, self.kind} == {'int', 'float'}):
+                if self.kind == 'int' and kind == 'float':
+                    self.convert('float')
+                self.append_numeric(kind, values)
+                return
+            values = values.tolist()
+
+        # Values that are all missing are appended to the column as it is
+        kind = find_kind(values) or self.kind
+        if not kind:
+            self.extend_missing(bytes([1]) * len(values))
+            self.length += len(values)
+            return
+
+        if {kind, self.kind} == {'int', 'float'}:
+            # Ints and floats in one column are all stored as floats
+            if self.kind == 'int':
+                self.convert('float')
+            kind = 'float'
+        elif self.kind == 'text' and kind == 'dictionary':
+            kind = 'text'
+        elif self.kind and kind != self.kind:
+            self.convert('list')
+            kind = 'list'
+
+        if not self.kind:
+            self.start(kind)
+
+        if self.kind in ('dictionary', 'text'):
+            self.append_text(values)
+        else:
+            self.append_values(values)
+
+    def start(self, kind: str):
+        """
+        Sets up the storage of a column kind, holding the missing values
+        appended before the column had a kind, if any.
+
+        Args:
+            kind (str): column kind
+        """
+
+        missing_rows: int = self.length
+        self.length = 0
+        self.missing = None
+
+        self.kind = kind
+        if kind == 'int':
+            self.values = array('q')
+        elif kind == 'float':
+            self.values = array('d')
+        elif kind == 'bool':
+            self.values = bytearray()
+        elif kind == 'dictionary':
+            self.values = array(CODE_TYPECODES[0])
+            self.categories = []
+            self.lookup = {}
+        elif kind == 'text':
+            self.values = bytearray()
+            self.offsets = array('q')
+        else:
+            self.values = []
+
+        if missing_rows:
+            if kind in ('dictionary', 'text'):
+                self.append_text([None] * missing_rows)
+            else:
+                self.append_values([None] * missing_rows)
+
+    def extend_missing(self, flags: bytes):
+        """
+        Extends the missing value mask with the flags of values about to be
+        appended (before the column's length is updated). No mask is kept
+        until a value is missing.
+
+        Args:
+            flags (bytes): 1 for every missing value, else 0
+        """
+
+        if self.missing is None:
+            if not any(flags):
+                return
+            self.missing = bytearray(self.length)
+        self.missing += flags
+
+    def append_values(self, values: list):
+        """
+        Appends values (and missing values) to an 'int', 'float', 'bool' or
+        'list' column. If ints don't fit the typed array (beyond 64 bits, or
+        too large for a float), the column becomes a 'list' column.
+
+        Args:
+            values (list): values of the column's type, or None
+        """
+
+        flags: bytes = bytes(value is None for value in values)
+        if self.kind != 'list':
+            placeholder = placeholders[self.kind]
+            filled: list = [placeholder if value is None else value for value in values] if any(flags) else values
+
+            size: int = len(self.values)
+            try:
+                self.values.extend(filled)
+                self.extend_missing(flags)
+            except OverflowError:
+                del self.values[size:]
+                self.convert('list')
+
+        if self.kind == 'list':
+            self.values.extend(values)
+        self.length += len(values)
+
+    def append_numeric(self, kind: str, values: Series):
+        """
+        Appends an int64, float64 or bool Series to a typed array column.
+
+        Args:
+            kind (str): 'int', 'float' or 'bool'
+            values (Series): values to append
+        """
+
+        if not self.kind:
+            self.start(kind)
+
+        # Only float Series can have missing values (NaN)
+        missing: Series = values.isna()
+        if missing.any():
+            self.extend_missing(ascontiguousarray(missing.to_numpy(), dtype=uint8).tobytes())
+            values = values.fillna(0.0)
+        else:
+            self.extend_missing(bytes(len(values)))
+
+        if self.kind == 'bool':
+            self.values += ascontiguousarray(values.to_numpy(), dtype=uint8).tobytes()
+        else:
+            self.values.frombytes(ascontiguousarray(
+                values.to_numpy(), dtype=int64 if self.kind == 'int' else float64).tobytes())
+        self.length += len(values)
+
+    def append_text(self, values: list):
+        """
+        Appends text values (and missing values) to a 'dictionary' or 'text'
+        column, switching from a dictionary to a buffer once the column has
+        too many distinct values.
+
+        Args:
+            values (list): str values, None or NaN
+        """
+
+        self.extend_missing(bytes(not isinstance(value, str) for value in values))
+
+        for value in values:
+            if not isinstance(value, str):
+                value = ''
+
+            if self.kind == 'dictionary':
+                code: int = self.lookup.get(value)
+                if code is None:
+                    code = len(self.categories)
+                    self.categories.append(value)
+                    self.lookup[value] = code
+                    if code >= 2 ** (8 * self.values.itemsize):
+                        self.values = array(CODE_TYPECODES[CODE_TYPECODES.index(self.values.typecode) + 1],
+                                            self.values)
+                self.values.append(code)
+            else:
+                self.values += value.encode('utf-8')
+                self.offsets.append(len(self.values))
+
+        self.length += len(values)
+
+        if self.kind == 'dictionary' and len(self.categories) > max(DICTIONARY_MIN_CATEGORIES,
+                                                                    self.length * DICTIONARY_MAX_RATIO):
+            self.convert('text')
+
+    def convert(self, kind: str):
+        """
+        Re-encodes the column's values as another kind.
+
+        Args:
+            kind (str): 'float', 'text' or 'list'
+        """
+
+        values: list = self.to_list()
+
+        self.missing = self.offsets = self.categories = self.lookup = None
+        self.length = 0
+        self.start(kind)
+
+        if kind == 'text':
+            self.append_text(values)
+        else:
+            self.append_values(values)
+
+    def to_list(self) -> list:
+        """
+        Returns:
+            list: the column's values (None for missing values)
+        """
+
+        if self.kind in ('int', 'float') and self.missing is None:
+            return self.values.tolist()
+        if self.kind == 'list':
+            return list(self.values)
+        return [self[row_idx] for row_idx in range(self.length)]
+
+    def memory_bytes(self) -> int:
+        """
+        Estimates the memory the column takes, including the Python objects
+        of dictionary categories and list values.
+
+        Returns:
+            int: size in bytes
+        """
+
+        size: int = getsizeof(self.values) if self.values is not None else 0
+        if self.kind == 'dictionary':
+            size += getsizeof(self.categories) + getsizeof(self.lookup) + sum(map(getsizeof, self.categories))
+        elif self.kind == 'text':
+            size += getsizeof(self.offsets)
+        elif self.kind == 'list':
+            size += sum(map(getsizeof, self.values))
+        if self.missing is not None:
+            size += getsizeof(self.missing)
+        return size
+
+
+class CompactTable:
+    """
+    Table data held column by column in CompactColumns.
+    """
+
+    __slots__ = ('columns',)
+
+    def __init__(self, column_data: dict = None):
+        # Column Name -> CompactColumn
+        self.columns: dict = {}
+        if column_data:
+            self.append(column_data)
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __iter__(self):
+        for row_idx in range(len(self)):
+            yield RowView(self, row_idx)
+
+    def row(self, index: int) -> RowView:
+        """
+        Args:
+            index (int): position of the row
+
+        Returns:
+            RowView: view of the row
+        """
+
+        return RowView(self, index)
+
+    def append(self, column_data: dict):
+        """
+        Appends rows to the table.
+
+        Args:
+            column_data (dict): Column Name -> list or Series of the rows' values
+        """
+
+        for name, values in column_data.items():
+            self.columns.setdefault(name, CompactColumn()).append(values)
+
+    def to_columns(self) -> dict:
+        """
+        Returns:
+            dict: Column Name -> list of values, as UI formatted data holds them
+        """
+
+        return {name: column.to_list() for name, column in self.columns.items()}
+
+    def column_memory(self) -> dict:
+        """
+        Returns:
+            dict: Column Name -> estimated bytes the column takes (see CompactColumn.memory_bytes)
+        """
+
+        return {name: column.memory_bytes() for name, column in self.columns.items()}
+
+
+def find_kind(values: list) -> str:
+    """
+    Finds the encoding that fits a list of values.
+
+    Args:
+        values (list): column values
+
+    Returns:
+        str: 'int', 'float' or 'bool' if every value that isn't None is of that type,
+             'dictionary' if every value is text or missing, '' if every value is None
+             (or there are none), else 'list'
+    """
+
+    types: set = set(map(type, values)) - {type(None)}
+    if not types:
+        return ''
+    if types == {int} or types == {float} or types == {bool}:
+        return {int: 'int', float: 'float', bool: 'bool'}[types.pop()]
+    if types <= {str, float} and str in types \
+            and all(value is None or isinstance(value, str) or isnan(value) for value in values):
+        return 'dictionary'
+    return 'list'
+
+
+def object_memory(values: list) -> int:
+    """
+    Estimates the memory a list of Python objects takes, for comparison
+    with CompactColumn.memory_bytes.
+
+    Args:
+        values (list): column values
+
+    Returns:
+        int: size in bytes
+    """
+
+    return getsizeof(values) + sum(map(getsizeof, values))
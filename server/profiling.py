@@ -0,0 +1,298 @@
+"""
+profiling.py:
+Timing of the stages of a request (saving an upload, validating and
+reading CSV files, inferring column types, loading tables, running
+queries, serializing responses...). Every timed stage is recorded:
+
+- in histograms per stage, with the rows and bytes it handled, sent by
+  /metrics in the Prometheus text format (see get_prometheus_metrics)
+- in the Server-Timing header of the response to the request it ran in
+  (see start_request and finish_request). Stages of background jobs, or
+  that run while a streamed response is sent, only go to /metrics. Stages
+  run in a worker process for a request are sent back and recorded in the
+  request (see take_spans).
+
+A request can also be profiled with cProfile by sending the PROFILE_HEADER
+header, if PROFILE_DIR is set; the stats are dumped to a .prof file there.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from cProfile import Profile
+from os import environ
+from os.path import join
+from threading import Lock
+from time import perf_counter, time_ns
+from typing import Iterable, Iterator
+from pandas import DataFrame
+
+# Directory that per-request profiles are dumped to (profiling is off if empty)
+PROFILE_DIR: str = environ.get('CSVT_PROFILE_DIR', '')
+
+# Request header that asks for the request to be profiled
+PROFILE_HEADER: str = 'X-CSVT-Profile'
+
+# Upper bounds (in seconds) of the stage and request duration histogram buckets
+HISTOGRAM_BUCKETS: list = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0]
+
+# Stage timings of the current request (None outside of requests)
+_request_spans: ContextVar = ContextVar('request_spans', default=None)
+_request_profile: ContextVar = ContextVar('request_profile', default=None)
+
+# (Metric, Label Value) -> {'count': int, 'seconds': float, 'rows': int, 'bytes': int, 'buckets': list}
+_metrics: dict = {}
+_metrics_lock = Lock()
+
+
+class Span:
+    """
+    Rows and bytes handled by a timed stage (see span), set by the stage as it runs.
+    """
+
+    def __init__(self):
+        self.rows: int = None
+        self.bytes: int = None
+
+
+@contextmanager
+def span(stage: str, rows: int = None, total_bytes: int = None):
+    """
+    Times the code in a with block as a stage. The rows and bytes handled
+    can be passed in, or set on the yielded Span once they are known.
+
+    Args:
+        stage (str): name of the stage
+        rows (int): number of rows handled, if known
+        total_bytes (int): number of bytes handled, if known
+
+    Yields:
+        Span: the span being timed
+    """
+
+    current = Span()
+    current.rows = rows
+    current.bytes = total_bytes
+    start: float = perf_counter()
+    try:
+        yield current
+    finally:
+        record_span(stage, perf_counter() - start, current.rows, current.bytes)
+
+
+def timed_chunks(stage: str, chunks: Iterable) -> Iterator:
+    """
+    Times producing the chunks of an iterable (not what the consumer does
+    with them) as a stage, recorded once the chunks run out. Rows are
+    counted for DataFrame chunks and bytes for bytes chunks.
+
+    Args:
+        stage (str): name of the stage
+        chunks (Iterable): chunks to time
+
+    Yields:
+        the next chunk
+    """
+
+    seconds: float = 0.0
+    rows: int = None
+    total_bytes: int = None
+    chunks = iter(chunks)
+
+    try:
+        while True:
+            start: float = perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                seconds += perf_counter() - start
+                break
+            seconds += perf_counter() - start
+
+            if isinstance(chunk, DataFrame):
+                rows = (rows or 0) + len(chunk)
+            elif isinstance(chunk, bytes):
+                total_bytes = (total_bytes or 0) + len(chunk)
+            yield chunk
+    finally:
+        record_span(stage, seconds, rows, total_bytes)
+
+
+def record_span(stage: str, seconds: float, rows: int = None, total_bytes: int = None):
+    """
+    Records the timing of a stage in the stage metrics and, if it ran
+    in a request, in the request's timings.
+
+    Args:
+        stage (str): name of the stage
+        seconds (float): time spent in the stage
+        rows (int): number of rows handled, if known
+        total_bytes (int): number of bytes handled, if known
+    """
+
+    observe('stage', stage, seconds, rows, total_bytes)
+
+    spans: list = _request_spans.get()
+    if spans is not None:
+        spans.append((stage, seconds, rows, total_bytes))
+
+
+def observe(metric: str, label: str, seconds: float, rows: int = None, total_bytes: int = None):
+    """
+    Adds an observation to a duration histogram.
+
+    Args:
+        metric (str): 'stage' or 'request'
+        label (str): stage name or endpoint
+        seconds (float): observed duration
+        rows (int): number of rows handled, if known
+        total_bytes (int): number of bytes handled, if known
+    """
+
+    with _metrics_lock:
+        entry: dict = _metrics.get((metric, label))
+        if entry is None:
+            entry = {'count': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0, 'buckets': [0] * len(HISTOGRAM_BUCKETS)}
+            _metrics[(metric, label)] = entry
+
+        entry['count'] += 1
+        entry['seconds'] += seconds
+        entry['rows'] += rows or 0
+        entry['bytes'] += total_bytes or 0
+        for bucket_idx, upper_bound in enumerate(HISTOGRAM_BUCKETS):
+            if seconds <= upper_bound:
+                entry['buckets'][bucket_idx] += 1
+
+
+def start_request(profile_requested: bool):
+    """
+    Starts collecting the stage timings of a request, and profiling it if
+    asked to (and PROFILE_DIR is set). Called before every request.
+
+    Args:
+        profile_requested (bool): whether the request has the PROFILE_HEADER header
+    """
+
+    _request_spans.set([])
+
+    if PROFILE_DIR and profile_requested:
+        profile = Profile()
+        _request_profile.set(profile)
+        profile.enable()
+
+
+def take_spans() -> list:
+    """
+    Returns the stage timings collected since start_request and stops
+    collecting them, without recording a request. Used for work done for
+    a request in another process, whose stages are then recorded in the
+    request with record_span.
+
+    Returns:
+        list: (stage, seconds, rows, bytes) of each timed stage
+    """
+
+    spans: list = _request_spans.get() or []
+    _request_spans.set(None)
+    return spans
+
+
+def finish_request(endpoint: str, seconds: float) -> str:
+    """
+    Records a request's duration and stops profiling it. Called after
+    every request, once its response has been created.
+
+    Args:
+        endpoint (str): name of the request's endpoint
+        seconds (float): time spent handling the request
+
+    Returns:
+        str: value of the Server-Timing header for the request's stages
+    """
+
+    profile: Profile = _request_profile.get()
+    if profile is not None:
+        profile.disable()
+        _request_profile.set(None)
+        try:
+            profile.dump_stats(join(PROFILE_DIR, f'{endpoint}_{time_ns()}.prof'))
+        except OSError as os_err:
+            print(f'Error in finish_request: {os_err}')
+
+    observe('request', endpoint, seconds)
+
+    spans: list = _request_spans.get() or []
+    _request_spans.set(None)
+    return server_timing(spans + [('total', seconds, None, None)])
+
+
+def server_timing(spans: list) -> str:
+    """
+    Formats stage timings as a Server-Timing header value. Stages that ran
+    more than once are summed, and the rows and bytes go in the description.
+
+    Args:
+        spans (list): (stage, seconds, rows, bytes) of each timed stage
+
+    Returns:
+        str: Server-Timing header value
+    """
+
+    totals: dict = {}
+    for stage, seconds, rows, total_bytes in spans:
+        total: list = totals.setdefault(stage, [0.0, None, None])
+        total[0] += seconds
+        if rows is not None:
+            total[1] = (total[1] or 0) + rows
+        if total_bytes is not None:
+            total[2] = (total[2] or 0) + total_bytes
+
+    metrics: list = []
+    for stage, (seconds, rows, total_bytes) in totals.items():
+        description: list = []
+        if rows is not None:
+            description.append(f'rows={rows}')
+        if total_bytes is not None:
+            description.append(f'bytes={total_bytes}')
+        metrics.append(f'{stage};dur={seconds * 1000:.1f}' + (f';desc="{" ".join(description)}"' if description else ''))
+
+    return ', '.join(metrics)
+
+
+def get_prometheus_metrics(gauges: dict) -> str:
+    """
+    Formats the stage and request metrics in the Prometheus text format,
+    along with other metrics of the server.
+
+    Args:
+        gauges (dict): Metric Name -> (help text, value) of other metrics to include
+
+    Returns:
+        str: the metrics
+    """
+
+    with _metrics_lock:
+        metrics: dict = {key: {**entry, 'buckets': list(entry['buckets'])} for key, entry in _metrics.items()}
+
+    lines: list = []
+    for metric, label_name in (('stage', 'stage'), ('request', 'endpoint')):
+        entries: list = sorted((label, entry) for (kind, label), entry in metrics.items() if kind == metric)
+        name: str = f'csvt_{metric}_seconds'
+        lines += [f'# HELP {name} Time spent per {metric}', f'# TYPE {name} histogram']
+        for label, entry in entries:
+            for upper_bound, count in zip(HISTOGRAM_BUCKETS, entry['buckets']):
+                lines.append(f'{name}_bucket{{{label_name}="{label}",le="{upper_bound}"}} {count}')
+            lines.append(f'{name}_bucket{{{label_name}="{label}",le="+Inf"}} {entry["count"]}')
+            lines.append(f'{name}_sum{{{label_name}="{label}"}} {entry["seconds"]}')
+            lines.append(f'{name}_count{{{label_name}="{label}"}} {entry["count"]}')
+
+    for unit in ('rows', 'bytes'):
+        name = f'csvt_stage_{unit}_total'
+        lines += [f'# HELP {name} Number of {unit} handled per stage', f'# TYPE {name} counter']
+        for (kind, label), entry in sorted(metrics.items()):
+            if kind == 'stage':
+                lines.append(f'{name}{{stage="{label}"}} {entry[unit]}')
+
+    for name, (help_text, value) in gauges.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {value}']
+
+    return '\n'.join(lines) + '\n'
@@ -1,9 +1,32 @@
 """
 response_data.py: 
 Contains the ResponseData class, an object used to store and manage 
-data for an HTTP response to the CSV Transformer UI.
+data for an HTTP response to the CSV Transformer UI, and the
+functions that serialize responses to JSON.
 """
 
+from json import dumps
+from os import environ
+from typing import Iterator
+
+# JSON serialization of response dictionaries. orjson is used when it is
+# installed (it is several times faster than the json module); set
+# CSVT_JSON_BACKEND to 'json' to use the json module anyway. orjson writes
+# NaN and infinite floats as null, while the json module writes NaN and Infinity.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_BACKEND: str = environ.get('CSVT_JSON_BACKEND', 'orjson' if orjson is not None else 'json')
+
+# Tables with more rows than this are serialized in batches (see iter_json)
+STREAM_MIN_ROWS: int = 5000
+
+# Number of rows (or column values) serialized per batch when streaming
+STREAM_BATCH_ROWS: int = 2000
+
+
 class ResponseData:
     def __init__(self):
         # Default response
@@ -30,3 +53,82 @@ class ResponseData:
             'error': self.error,
             'data': self.data
         }
+
+
+
+def dumps_json(obj) -> bytes:
+    """
+    Serializes an object to compact UTF-8 JSON with the JSON_BACKEND.
+    Values that aren't JSON types (e.g. Decimal) are written as strings.
+
+    Args:
+        obj: object to serialize
+
+    Returns:
+        bytes: JSON
+    """
+
+    if JSON_BACKEND == 'orjson':
+        return orjson.dumps(obj, default=str, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return dumps(obj, default=str, separators=(',', ':')).encode('utf-8')
+
+
+def iter_json(res: dict) -> Iterator[bytes]:
+    """
+    Serializes a response dictionary to JSON. Small responses are serialized
+    in one go; the table data ('rowData' or 'columnData') of responses with
+    more than STREAM_MIN_ROWS rows is serialized STREAM_BATCH_ROWS rows at a
+    time, so the response can be sent while the rest is still being encoded.
+
+    Args:
+        res (dict): response dictionary (see ResponseData.get_response_dict)
+
+    Yields:
+        bytes: the next chunk of JSON
+    """
+
+    data: dict = res.get('data') or {}
+    if 'rowData' in data:
+        table_key, row_count = 'rowData', len(data['rowData'])
+    elif 'columnData' in data:
+        table_key, row_count = 'columnData', len(next(iter(data['columnData'].values()), []))
+    else:
+        table_key, row_count = None, 0
+
+    if row_count <= STREAM_MIN_ROWS:
+        yield dumps_json(res)
+        return
+
+    # Everything but the table, then the table a batch at a time
+    head: dict = {key: value for key, value in res.items() if key != 'data'}
+    rest: dict = {key: value for key, value in data.items() if key != table_key}
+    yield (dumps_json(head)[:-1] + b',"data":' + dumps_json(rest)[:-1]
+           + (b',' if rest else b'') + dumps_json(table_key) + b':')
+
+    if table_key == 'rowData':
+        yield from iter_json_array(data['rowData'])
+    else:
+        for col_idx, (col_name, values) in enumerate(data['columnData'].items()):
+            yield (b',' if col_idx else b'{') + dumps_json(col_name) + b':'
+            yield from iter_json_array(values)
+        yield b'}'
+
+    yield b'}}'
+
+
+def iter_json_array(values: list) -> Iterator[bytes]:
+    """
+    Serializes a list to a JSON array, STREAM_BATCH_ROWS values at a time.
+
+    Args:
+        values (list): values to serialize
+
+    Yields:
+        bytes: the next chunk of the JSON array
+    """
+
+    yield b'['
+    for start in range(0, len(values), STREAM_BATCH_ROWS):
+        batch: bytes = dumps_json(values[start:start + STREAM_BATCH_ROWS])[1:-1]
+        yield (b',' if start else b'') + batch
+    yield b']'
@@ -0,0 +1,65 @@
+"""
+results.py:
+Keeps track of executed queries so the UI can page through their
+results. Each query whose first page is sent to the UI is registered
+here under a result handle (ID), which the UI sends back to fetch
+other pages of the same result.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from uuid import uuid4
+
+# Maximum number of result handles kept; the least recently used is dropped first
+MAX_RESULT_HANDLES: int = 256
+
+# Result ID -> {'query': str, 'schema': str, 'totalRows': int}
+_results: OrderedDict = OrderedDict()
+_results_lock = Lock()
+
+
+def register_result(query: str, schema: str, total_rows: int) -> str:
+    """
+    Registers a query result and returns a handle for it.
+
+    Args:
+        query (str): query that produced the result
+        schema (str): session schema the query was executed in
+        total_rows (int): number of rows in the full result
+
+    Returns:
+        str: result ID to send to the UI
+    """
+
+    result_id: str = uuid4().hex
+
+    with _results_lock:
+        _results[result_id] = {'query': query, 'schema': schema, 'totalRows': total_rows}
+
+        # Drop the least recently used handles once there are too many
+        while len(_results) > MAX_RESULT_HANDLES:
+            _results.popitem(last=False)
+
+    return result_id
+
+
+def lookup_result(result_id: str, schema: str) -> dict:
+    """
+    Looks up a registered query result of a session.
+
+    Args:
+        result_id (str): result ID returned by register_result
+        schema (str): session schema the result must belong to
+
+    Returns:
+        dict: the registered result, or None if the ID is unknown, has expired
+              or belongs to another session
+    """
+
+    with _results_lock:
+        result = _results.get(result_id)
+        if result is not None and result['schema'] != schema:
+            return None
+        if result is not None:
+            _results.move_to_end(result_id)
+        return result
@@ -1,27 +1,85 @@
 """server.py: Endpoints for CSV Transformer"""
 
-from os.path import join, exists
-from os import getcwd
-from flask import Flask, request, jsonify
-from flask.helpers import make_response, send_file
+from os.path import join
+from os import makedirs
+from time import perf_counter
+from typing import Iterable, Iterator
+from itertools import chain
+from flask import Flask, g, request
 from flask.wrappers import Response
 from flask_cors import CORS
 from pandas.core.frame import DataFrame
 from werkzeug.datastructures import FileStorage
-from validate import validate_csv
-from response_data import ResponseData
+from compression import COMPRESSION_MIN_BYTES, compress_chunks, negotiate_encoding
+from formats import ARROW_STREAM, COLUMNS_JSON, NDJSON, negotiate_format, to_arrow_stream, to_rows_json
+from response_data import ResponseData, iter_json
+from uploads import (
+    cache_parse_result,
+    get_parse_result,
+    get_upload_cache_metrics,
+    lookup_upload,
+    new_upload_id,
+    register_upload,
+    save_upload,
+    upload_directory
+)
+from results import lookup_result
+from jobs import Job, cancel_job, lookup_job, submit_job
+from sessions import get_session_schema, new_session_id, session_schema, start_session_gc
+from postgres import cancel_query, get_pool_metrics
+from cache import get_cache_metrics
+from indexes import record_query_columns, submit_index_job, suggest_indexes
+from serving import SERVER_HOST, SERVER_MODE, SERVER_PORT, format_upload_for_ui, serve
+from profiling import PROFILE_HEADER, finish_request, get_prometheus_metrics, span, start_request, timed_chunks
 from data import (
+    PAGE_SIZE,
+    check_query_limits,
     validate_query,
     reconstruct_dataframe,
-    format_csv_data_for_ui,
     get_query_data,
+    stream_query_data,
+    get_query_page,
     create_download_csv,
-    initialize_table
+    write_download_csv,
+    iter_file_chunks,
+    initialize_table,
+    initialize_table_from_upload
 )
 
 app = Flask(__name__)
 CORS(app)
 
+# Drop the schemas of idle sessions in the background
+start_session_gc()
+
+
+@app.before_request
+def start_request_timing():
+    """
+    Starts timing the stages of every request (see the profiling module).
+    """
+
+    g.request_start = perf_counter()
+    start_request(request.headers.get(PROFILE_HEADER, '').lower() in ('1', 'true'))
+
+
+@app.after_request
+def add_server_timing(response: Response) -> Response:
+    """
+    Records how long a request took and sends the timings of its stages
+    in the Server-Timing header.
+
+    Args:
+        response (Response): response to the request
+
+    Returns:
+        Response: the response, with the Server-Timing header added
+    """
+
+    response.headers['Server-Timing'] = finish_request(
+        request.endpoint or 'unknown', perf_counter() - g.request_start)
+    return response
+
 
 @app.route('/loadcsv', methods=['POST'])
 def loadcsv() -> Response:
@@ -29,10 +87,15 @@ def loadcsv() -> Response:
     Endpoint for initial CSV load 
     (called after clicking first CONTINUE button in UI).
 
-    Gets file from request, tests that it is valid by calling 
-    the CSVChecker microservice, and if valid formats data for 
-    UI display and sends it to front end, otherwise sends a 
-    failed response with an error message.
+    Gets file from request, tests that it is valid, and if valid 
+    formats data for UI display and sends it to front end along 
+    with an upload ID for the saved file, otherwise sends a failed 
+    response with an error message.
+
+    A new session is started unless the request contains the
+    'SessionId' of an existing one. The session ID must be sent
+    with every later request; each session gets its own schema
+    in the database.
 
     Returns:
         Response: HTTP response containing data or error
@@ -44,21 +107,37 @@ def loadcsv() -> Response:
     # Get request data
     has_header: bool = request.values['HasHeader'].lower() == 'true' # Whether CSV has header row
     file: FileStorage = request.files['File']                        # Uploaded file
-
-    # Save the uploaded file locally
-    filepath: str = join(getcwd(), "data", file.filename)
-    file.save(filepath)
-
-    # Validate the CSV with the CSV Checker microservice
-    if validate_csv(filepath):
-        # The CSV is valid; put it in a UI digestible format and add it to the response
-        format_csv_data_for_ui(filepath, has_header, res_data)
-    else:
-        # The CSV is not valid; add an error code and message to the response
-        res_data.fail(422, 'Invalid CSV. Please upload a valid CSV file.')
-
-    res: dict = res_data.get_response_dict()            # Convert ResponseData object to dictionary 
-    return make_response(jsonify(res), res['status'])   # Create and return the response
+    session_id: str = request.values.get('SessionId')                # Existing session, if any
+
+    # Start a new session unless the request is from a valid existing one; recording its
+    # first use lets the session GC drop it (and delete its uploads) once it is idle
+    schema: str = session_schema(session_id)
+    if schema is None:
+        session_id = new_session_id()
+        schema = session_schema(session_id)
+
+    # Stream the uploaded file to the session's directory; files are saved under their content hash
+    filepath, content_hash = save_upload(file, schema, res_data)
+
+    # The same file may have been uploaded (and parsed) in the session before
+    ui_data: dict = get_parse_result(schema, content_hash, has_header) if res_data.success else None
+    if ui_data is not None:
+        res_data.set_data(ui_data)
+    elif res_data.success:
+        # Validate the CSV and put it in a UI digestible format (in a worker process)
+        format_upload_for_ui(filepath, has_header, res_data)
+        if res_data.success:
+            res_data.data['columnMemory'] = cache_parse_result(schema, content_hash, has_header, res_data.data)
+
+    # Remember the saved file so /initializeTable can load it by upload ID
+    if res_data.success:
+        upload_id: str = new_upload_id()
+        register_upload(upload_id, filepath, has_header, res_data.data['totalRows'], schema, content_hash)
+        res_data.data['uploadId'] = upload_id
+        res_data.data['sessionId'] = session_id
+
+    # Convert ResponseData object to dictionary, then create and return the response
+    return send_data_response(res_data.get_response_dict())
 
 
 @app.route('/initializeTable', methods=['POST'])
@@ -67,8 +146,22 @@ def initializeTable() -> Response:
     Endpoint for inserting data into SQL DB 
     (after clicking second CONTINUE button in UI).
 
-    Convert UI formatted data back into a DataFrame 
-    and create a new database table containing the data.
+    If the request contains an 'uploadId', the data is read from
+    the file saved by /loadcsv. Otherwise, UI formatted data sent
+    in 'data' is converted back into a DataFrame. Either way, a new
+    database table containing the data is created.
+
+    With an 'uploadId', 'loadMode' may be 'append' or 'upsert' (with
+    a 'keyColumn') to add the file to an existing table of the same
+    name instead of replacing it (see initialize_table_from_upload).
+
+    If the request contains an 'uploadId' and 'async' is true, the
+    table is loaded by a background job, and the job's status is sent
+    back right away (see /jobStatus and /jobResult).
+
+    The columns listed in 'indexColumns' are indexed by another background
+    job once the table is loaded; its status is sent with the table as
+    'indexJob' (see start_index_job).
 
     Returns:
         Response: HTTP response containing data or error
@@ -78,21 +171,59 @@ def initializeTable() -> Response:
 
     # Get request data
     req: dict = request.get_json()
-
-    # Create a DataFrame from the UI formatted data
-    data: DataFrame = reconstruct_dataframe(
-        req['data'], req['columnsToDelete'], req['columnDataTypes'], res_data)
-    
-    # If the DataFrame is empty, an error occurred
-    if not data.empty:
-        # If no error, create a new DB table with the data in the DataFrame,
-        # selects all data from that table, formats it for the UI, and puts
-        # it in the response
-        initialize_table(data, req['tableName'], res_data)
+    schema: str = get_session_schema(req.get('sessionId'), res_data)
+
+    if res_data.success and req.get('uploadId') and req.get('async'):
+        # Load the table in a background job and send back the job's status
+        def load(job: Job, job_res_data: ResponseData):
+            initialize_table_from_upload(req['uploadId'], req['tableName'], req['columnsToDelete'],
+                                         req['columnDataTypes'], schema, job_res_data, job.update_progress,
+                                         req.get('loadMode', 'replace'), req.get('keyColumn'))
+            start_index_job(req, schema, job_res_data)
+
+        upload: dict = lookup_upload(req['uploadId'], schema)
+        job: Job = submit_job('load', schema, load, upload['totalRows'] if upload else None)
+        res_data.set_data(job.get_status_dict())
+    elif res_data.success and req.get('uploadId'):
+        # Create a new DB table straight from the uploaded file, select all data
+        # from that table, format it for the UI, and put it in the response
+        initialize_table_from_upload(req['uploadId'], req['tableName'], req['columnsToDelete'],
+                                     req['columnDataTypes'], schema, res_data,
+                                     load_mode=req.get('loadMode', 'replace'), key_column=req.get('keyColumn'))
+        start_index_job(req, schema, res_data)
+    elif res_data.success:
+        # Create a DataFrame from the UI formatted data
+        data: DataFrame = reconstruct_dataframe(
+            req['data'], req['columnsToDelete'], req['columnDataTypes'], res_data)
+        
+        # If the DataFrame is empty, an error occurred
+        if not data.empty:
+            # If no error, create a new DB table with the data in the DataFrame,
+            # selects all data from that table, formats it for the UI, and puts
+            # it in the response
+            initialize_table([data], req['tableName'], req['columnDataTypes'], schema, res_data)
+            start_index_job(req, schema, res_data)
 
     # Send the response
-    res: dict = res_data.get_response_dict()
-    return make_response(jsonify(res), res['status'])
+    return send_data_response(res_data.get_response_dict())
+
+
+def start_index_job(req: dict, schema: str, res_data: ResponseData):
+    """
+    Starts indexing the columns of a newly loaded table that were chosen
+    in the UI ('indexColumns' of an /initializeTable request), if the load
+    succeeded. Columns that aren't in the loaded table are skipped.
+
+    Args:
+        req (dict): /initializeTable request data
+        schema (str): session schema the table was loaded into
+        res_data (ResponseData): response of the load, holding the table's data
+    """
+
+    if res_data.success:
+        loaded_columns: list = res_data.data.get('columns', [])
+        submit_index_job(req['tableName'], [col for col in req.get('indexColumns') or [] if col in loaded_columns],
+                         schema, res_data)
 
 
 @app.route('/executeQuery', methods=['POST'])
@@ -101,7 +232,14 @@ def executeQuery() -> Response:
     Endpoint for executing a query (available in the last UI view).
 
     Executes the query specified in the request on the database and
-    returns the results.
+    returns the results. The request may lower the statement timeout
+    ('timeoutSeconds') and the number of result rows kept ('maxRows'),
+    and give a 'queryId' that /cancelQuery can cancel the query by while
+    it runs.
+
+    If 'stream' is true, the results are streamed as newline-delimited
+    JSON from a server-side cursor, starting with the first 'firstRows'
+    rows as soon as they arrive (see data.stream_query_data).
 
     Returns:
         Response: HTTP response containing query results
@@ -110,22 +248,93 @@ def executeQuery() -> Response:
 
     res_data = ResponseData()
 
-    # Get the query from the request and make it all lower case
-    query: str = f"{request.get_json().get('query')}".lower()
+    # Get the query from the request (unquoted names are case-insensitive in PostgreSQL anyway)
+    req: dict = request.get_json()
+    query: str = f"{req.get('query')}"
+    schema: str = get_session_schema(req.get('sessionId'), res_data)
 
     # Run some validation on the query to make sure it won't break anything
-    err: str = validate_query(query)
-    if len(err) > 0:
+    err: str = validate_query(query, schema)
+    if not res_data.success:
+        # Invalid session; the error is already in the response
+        pass
+    elif len(err) > 0:
         # Error occurred; send back the error
         print(f'Error executing query: {err}')
         res_data.fail(500, f'Failed to execute query: {err}')
     else:
-        # Query is OK; execute it and put the data in the response
+        # Query is OK; execute it within the requested limits and put the data in the response
         print(f'Executing: {query}')
-        get_query_data(query, res_data)
+        timeout_seconds, max_rows = check_query_limits(req.get('timeoutSeconds'), req.get('maxRows'), res_data)
+        query_id: str = str(req['queryId']) if req.get('queryId') else None
+        if res_data.success and req.get('stream'):
+            lines: Iterator[bytes] = stream_query_data(query, schema, res_data, req.get('firstRows', PAGE_SIZE),
+                                                       timeout_seconds, max_rows, query_id)
+        elif res_data.success:
+            get_query_data(query, schema, res_data, timeout_seconds, max_rows, query_id)
+
+        # Count the columns it filters and sorts by, to suggest indexes
+        if res_data.success:
+            record_query_columns(query, schema)
+
+        if res_data.success and req.get('stream'):
+            # Send every line of results as soon as it is produced
+            return send_body(lines, 200, NDJSON, flush=True)
+
+    return send_data_response(res_data.get_response_dict())
+
+
+@app.route('/cancelQuery', methods=['POST'])
+def cancelQuery() -> Response:
+    """
+    Endpoint for cancelling a query started by /executeQuery with a
+    'queryId', while it runs. The cancelled request fails with status 408.
+
+    Returns:
+        Response: HTTP response containing whether a running query was cancelled
+    """
+
+    res_data = ResponseData()
+
+    # Request data should contain 'sessionId' and 'queryId'
+    req: dict = request.get_json()
+    schema: str = get_session_schema(req.get('sessionId'), res_data)
+    if res_data.success and not req.get('queryId'):
+        res_data.fail(422, 'A queryId is required')
+
+    if res_data.success:
+        cancelled: bool = cancel_query(schema, str(req['queryId']), res_data)
+        if res_data.success:
+            res_data.set_data({'cancelled': cancelled})
 
     res: dict = res_data.get_response_dict()
-    return make_response(jsonify(res), res['status'])
+    return send_json(res)
+
+
+@app.route('/queryPage', methods=['POST'])
+def queryPage() -> Response:
+    """
+    Endpoint for fetching another page of query results
+    (after paging through a table in the last UI view).
+
+    Fetches the rows starting at 'offset' of the result identified
+    by 'resultId', which is returned with the first page of results
+    by /initializeTable and /executeQuery.
+
+    Returns:
+        Response: HTTP response containing the page of results
+                  formatted for UI or error if fetching failed.
+    """
+
+    res_data = ResponseData()
+
+    # Request data should contain 'sessionId', 'resultId', 'offset' and 'limit'
+    req: dict = request.get_json()
+    schema: str = get_session_schema(req.get('sessionId'), res_data)
+    if res_data.success:
+        get_query_page(req.get('resultId'), req.get('offset', 0), req.get('limit', PAGE_SIZE), schema, res_data)
+
+    return send_data_response(res_data.get_response_dict())
 
 
 @app.route('/downloadcsv', methods=['POST'])
@@ -135,34 +344,353 @@ def download_csv() -> Response:
     displayed in the UI.
 
     Runs the last executed query (or selects all data if no
-    query has been executed), writes the results to a file,
-    and sends the file to the front end.
+    query has been executed) and streams the results to the
+    front end as a CSV file. The CSV is compressed if the
+    client accepts gzip or deflate encoding.
+
+    If 'async' is true in the request, the CSV is written to a file
+    by a background job instead, and the job's status is sent back
+    right away; the file is downloaded from /jobResult once the job
+    is done. The optional 'resultId' of the displayed result is used
+    to estimate how long the job will take.
 
     Returns:
-        Response: HTTP response containing the download file or an error
+        Response: HTTP response streaming the download file or an error
     """
 
     res_data = ResponseData()
 
-    # Request data should contain 'query' and 'tableName'
+    # Request data should contain 'sessionId', 'query' and 'tableName'
     data = request.get_json()
+    schema: str = get_session_schema(data.get('sessionId'), res_data)
+
+    if res_data.success and data.get('async'):
+        # Export the CSV in a background job and send back the job's status
+        def export(job: Job, job_res_data: ResponseData):
+            # Kept with the session's uploads, so it is deleted with them if the session goes idle
+            makedirs(upload_directory(schema), exist_ok=True)
+            job.result_path = join(upload_directory(schema), f'export_{job.id}.csv')
+            write_download_csv(data.get('query'), data.get('tableName'), schema, job.result_path,
+                               job_res_data, job.update_progress)
+
+        result: dict = lookup_result(data.get('resultId'), schema)
+        job: Job = submit_job('export', schema, export, result['totalRows'] if result else None)
+        res_data.set_data(job.get_status_dict())
+        res: dict = res_data.get_response_dict()
+        return send_json(res)
+
+    # Start streaming the query results as CSV
+    if res_data.success:
+        csv_chunks: Iterator[bytes] = create_download_csv(
+            data.get('query'), data.get('tableName'), schema, res_data)
+
+    if res_data.success:
+        # Send the CSV to the front end as it is produced
+        headers: dict = {'Content-Disposition': 'attachment; filename=transformed.csv'}
+        return send_body(csv_chunks, 200, 'text/csv', headers)
+
+    res = res_data.get_response_dict()
+    return send_json(res)
+
+
+@app.route('/jobStatus', methods=['POST'])
+def jobStatus() -> Response:
+    """
+    Endpoint for polling a background job started by /initializeTable
+    or /downloadcsv.
+
+    Returns:
+        Response: HTTP response containing the job's status and progress
+                  (rows and bytes processed, elapsed time and ETA)
+    """
+
+    res_data = ResponseData()
+
+    # Request data should contain 'sessionId' and 'jobId'
+    req: dict = request.get_json()
+    job: Job = find_job(req, res_data)
+    if job is not None:
+        res_data.set_data(job.get_status_dict())
+
+    res: dict = res_data.get_response_dict()
+    return send_json(res)
+
+
+@app.route('/cancelJob', methods=['POST'])
+def cancelJob() -> Response:
+    """
+    Endpoint for cancelling a background job. A cancelled load
+    is rolled back, and a cancelled export's file is deleted.
+
+    Returns:
+        Response: HTTP response containing the job's status
+    """
+
+    res_data = ResponseData()
+
+    # Request data should contain 'sessionId' and 'jobId'
+    req: dict = request.get_json()
+    job: Job = find_job(req, res_data)
+    if job is not None:
+        cancel_job(job)
+        res_data.set_data(job.get_status_dict())
+
+    res: dict = res_data.get_response_dict()
+    return send_json(res)
+
+
+@app.route('/jobResult', methods=['POST'])
+def jobResult() -> Response:
+    """
+    Endpoint for fetching the result of a finished background job.
+    For a load job, this is the response /initializeTable would have
+    sent, and for an index job the indexed table and columns; for an
+    export job, the CSV file is streamed (compressed if the client
+    accepts gzip or deflate encoding).
+
+    Returns:
+        Response: HTTP response containing the result or an error
+    """
+
+    res_data = ResponseData()
 
-    # Get the data and write it to a CSV file
-    path_to_download_file = join(getcwd(), 'data', 'transformed.csv')
-    create_download_csv(data.get('query'), data.get(
-        'tableName'), path_to_download_file, res_data)
+    # Request data should contain 'sessionId' and 'jobId'
+    req: dict = request.get_json()
+    job: Job = find_job(req, res_data)
+
+    if job is not None and job.status in ('queued', 'running'):
+        res_data.fail(409, 'Job has not finished yet')
+    elif job is not None and job.type == 'export' and job.status == 'done':
+        # Send the exported CSV file
+        csv_chunks: Iterator[bytes] = iter_file_chunks(job.result_path)
+        headers: dict = {'Content-Disposition': 'attachment; filename=transformed.csv'}
+        return send_body(csv_chunks, 200, 'text/csv', headers)
+    elif job is not None:
+        # Send the load job's response (or the export job's error) as is
+        return send_data_response(job.result)
+
+    res: dict = res_data.get_response_dict()
+    return send_json(res)
+
+
+def send_data_response(res: dict) -> Response:
+    """
+    Creates the response for an endpoint that sends UI formatted data,
+    in the format negotiated with the request's Accept header (see the
+    formats module). Errors are always sent as JSON.
 
-    # Check that the CSV was created
-    if exists(path_to_download_file):
-        # Send the file to the front end
-        return send_file(path_to_download_file, as_attachment=True)
+    Args:
+        res (dict): response dictionary (see ResponseData.get_response_dict)
+
+    Returns:
+        Response: HTTP response
+    """
+
+    data_format: str = negotiate_format(request.accept_mimetypes) if res['success'] else None
+
+    if data_format == ARROW_STREAM:
+        with span('serialize'):
+            body: bytes = to_arrow_stream(res)
+        response: Response = send_body([body], res['status'], ARROW_STREAM)
+    elif data_format == COLUMNS_JSON:
+        response = send_json(res, COLUMNS_JSON)
     else:
-        # There was an error creating the file; send an error
-        res_data.fail(500, 'Failed to download CSV')
+        response = send_json(to_rows_json(res))
 
-    res = res_data.get_response_dict()
-    return make_response(jsonify(res), res['status'])
+    # The body depends on the Accept header, so caches must not mix formats up
+    response.vary.add('Accept')
+    return response
+
+
+def send_json(res: dict, mimetype: str = 'application/json') -> Response:
+    """
+    Creates a JSON response (see response_data.iter_json), compressed if
+    the client accepts it.
+
+    Args:
+        res (dict): response dictionary (see ResponseData.get_response_dict)
+        mimetype (str): media type of the response
+
+    Returns:
+        Response: HTTP response
+    """
+
+    return send_body(timed_chunks('serialize', iter_json(res)), res['status'], mimetype)
+
+
+def send_body(chunks: Iterable[bytes], status: int, mimetype: str, headers: dict = None,
+              flush: bool = False) -> Response:
+    """
+    Creates a response from a body made of one or more chunks, compressed
+    with gzip or deflate if the client accepts either. A body of a single
+    chunk is sent in one piece (compressed only if it is at least
+    COMPRESSION_MIN_BYTES); a longer body is streamed and compressed as
+    it is sent.
+
+    Args:
+        chunks (Iterable[bytes]): response body
+        status (int): HTTP status code
+        mimetype (str): media type of the response
+        headers (dict): additional response headers
+        flush (bool): whether every chunk of a streamed body is sent as soon as it is
+                      produced (see compression.compress_chunks)
+
+    Returns:
+        Response: HTTP response
+    """
+
+    headers = dict(headers or {})
+    encoding: str = negotiate_encoding(request.accept_encodings)
+
+    # Find out whether the body is a single chunk
+    chunks = iter(chunks)
+    first_chunk: bytes = next(chunks, b'')
+    second_chunk: bytes = next(chunks, None)
+
+    if second_chunk is None:
+        body = first_chunk
+        if encoding is not None and len(body) >= COMPRESSION_MIN_BYTES:
+            body = b''.join(compress_chunks([body], encoding))
+            headers['Content-Encoding'] = encoding
+    else:
+        body = chain([first_chunk, second_chunk], chunks)
+        if encoding is not None:
+            body = compress_chunks(body, encoding, flush)
+            headers['Content-Encoding'] = encoding
+
+    response = Response(body, status=status, mimetype=mimetype, headers=headers)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def find_job(req: dict, res_data: ResponseData) -> Job:
+    """
+    Looks up the job identified by 'jobId' in a request, failing
+    the response if the session or job can't be found.
+
+    Args:
+        req (dict): request data
+        res_data (ResponseData): object to hold data for the response
+
+    Returns:
+        Job: the job, or None if it wasn't found
+    """
+
+    schema: str = get_session_schema(req.get('sessionId'), res_data)
+    if not res_data.success:
+        return None
+
+    job: Job = lookup_job(req.get('jobId'), schema)
+    if job is None:
+        res_data.fail(404, 'Job not found. It may have expired.')
+    return job
+
+
+@app.route('/createIndexes', methods=['POST'])
+def createIndexes() -> Response:
+    """
+    Endpoint for indexing columns of a table in the session's schema
+    (e.g. the columns sent by /indexSuggestions). The indexes are built
+    by a background job whose status is sent back as 'indexJob'
+    (see /jobStatus and /jobResult).
+
+    Returns:
+        Response: HTTP response containing the job status or an error
+    """
+
+    res_data = ResponseData()
+
+    # Request data should contain 'sessionId', 'tableName' and 'columns'
+    req: dict = request.get_json()
+    schema: str = get_session_schema(req.get('sessionId'), res_data)
+    if res_data.success and not (req.get('tableName') and req.get('columns')):
+        res_data.fail(422, 'A table name and the columns to index are required')
+    if res_data.success:
+        submit_index_job(req['tableName'], list(req['columns']), schema, res_data)
+
+    res: dict = res_data.get_response_dict()
+    return send_json(res)
+
+
+@app.route('/indexSuggestions', methods=['POST'])
+def indexSuggestions() -> Response:
+    """
+    Endpoint for suggesting columns to index: unindexed columns of the
+    session's larger tables that its queries often filter or sort by
+    (see indexes.suggest_indexes).
+
+    Returns:
+        Response: HTTP response containing the suggestions or an error
+    """
+
+    res_data = ResponseData()
+
+    # Request data should contain 'sessionId'
+    req: dict = request.get_json()
+    schema: str = get_session_schema(req.get('sessionId'), res_data)
+    if res_data.success:
+        suggest_indexes(schema, res_data)
+
+    res: dict = res_data.get_response_dict()
+    return send_json(res)
+
+
+@app.route('/poolStats', methods=['GET'])
+def poolStats() -> Response:
+    """
+    Endpoint for monitoring the database connection pool.
+
+    Returns:
+        Response: HTTP response containing the pool settings and metrics
+    """
+
+    res_data = ResponseData()
+    res_data.set_data(get_pool_metrics())
+
+    res: dict = res_data.get_response_dict()
+    return send_json(res)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics() -> Response:
+    """
+    Endpoint for Prometheus: the time spent in each request stage (with
+    the rows and bytes handled) and per endpoint, and the connection pool,
+    query result cache and upload cache metrics, in the Prometheus text format.
+
+    Returns:
+        Response: HTTP response containing the metrics
+    """
+
+    gauges: dict = {}
+    for metric, value in get_pool_metrics().items():
+        gauges[f'csvt_pool_{metric}'] = (f'Connection pool {metric}', value)
+    for metric, value in get_cache_metrics().items():
+        gauges[f'csvt_cache_{metric}'] = (f'Query result cache {metric}', value)
+    for metric, value in get_upload_cache_metrics().items():
+        gauges[f'csvt_upload_cache_{metric}'] = (f'Upload cache {metric}', value)
+
+    return send_body([get_prometheus_metrics(gauges).encode('utf-8')], 200, 'text/plain; version=0.0.4')
+
+
+@app.route('/cacheStats', methods=['GET'])
+def cacheStats() -> Response:
+    """
+    Endpoint for monitoring the query result cache.
+
+    Returns:
+        Response: HTTP response containing the cache settings and hit/miss/eviction counters
+    """
+
+    res_data = ResponseData()
+    res_data.set_data(get_cache_metrics())
+
+    res: dict = res_data.get_response_dict()
+    return send_json(res)
 
 
 if __name__ == "__main__":
-    app.run(port=8080, debug=True)
+    if SERVER_MODE == 'production':
+        serve(app)
+    else:
+        app.run(host=SERVER_HOST, port=SERVER_PORT, debug=True)
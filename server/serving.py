@@ -0,0 +1,224 @@
+"""
+serving.py:
+Production serving of the app (see serve). Requests are handled by a fixed
+pool of SERVER_THREADS threads of one process: sessions, jobs, uploads and
+caches are kept in the server's memory, so every request of a session must
+reach the same process. Threads don't hold each other up while they wait
+on the database (psycopg2 releases the GIL while libpq waits for the
+server), so queries run while tables load.
+
+Parsing and validating uploaded files is the CPU heavy part of requests,
+and would hold the GIL the request threads share, so it is done in a pool
+of PARSE_WORKERS processes (see format_upload_for_ui). Large table loads
+are parsed in processes too (see the parallel module), and other loads run
+as background jobs (see the jobs module).
+"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from os import cpu_count, environ
+from os.path import getsize
+from threading import Lock
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from data import format_csv_data_for_ui
+from profiling import record_span, span, start_request, take_spans
+from response_data import ResponseData
+from validate import find_csv_error
+
+# 'development' runs Flask's debug server; 'production' serves with a thread pool (see serve)
+SERVER_MODE: str = environ.get('CSVT_SERVER_MODE', 'development')
+
+# Address and port the server listens on
+SERVER_HOST: str = environ.get('CSVT_SERVER_HOST', '127.0.0.1')
+SERVER_PORT: int = int(environ.get('CSVT_SERVER_PORT', 8080))
+
+# Number of requests handled at once in production mode; further connections wait in a queue
+SERVER_THREADS: int = int(environ.get('CSVT_SERVER_THREADS', 16))
+
+# Whether every request is logged in production mode
+SERVER_ACCESS_LOG: bool = environ.get('CSVT_SERVER_ACCESS_LOG', 'true').lower() == 'true'
+
+# Number of processes parsing uploaded files; 0 parses them in the request's thread
+PARSE_WORKERS: int = int(environ.get('CSVT_PARSE_WORKERS', min(4, cpu_count() or 1)))
+
+_upload_pool: ProcessPoolExecutor = None
+_upload_pool_lock = Lock()
+
+
+class PooledRequestHandler(WSGIRequestHandler):
+    """
+    Request handler of the PooledWSGIServer. Connections are closed after
+    every response (HTTP/1.0), so idle keep-alive connections don't tie up
+    the pool's threads.
+    """
+
+    protocol_version = 'HTTP/1.0'
+
+    def log_request(self, *args, **kwargs):
+        if SERVER_ACCESS_LOG:
+            super().log_request(*args, **kwargs)
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    WSGI server that hands every accepted connection to a fixed pool of
+    threads, unlike Werkzeug's threaded server, which starts a thread per
+    connection however many there are.
+    """
+
+    multithread = True
+
+    def __init__(self, host: str, port: int, app, threads: int = SERVER_THREADS):
+        super().__init__(host, port, app, handler=PooledRequestHandler)
+        self.threads: int = threads
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='csvt-request')
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        # Runs in a pool thread, like socketserver.ThreadingMixIn.process_request_thread
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+def serve(app, host: str = SERVER_HOST, port: int = SERVER_PORT, threads: int = SERVER_THREADS):
+    """
+    Serves the app with a PooledWSGIServer until interrupted.
+
+    Args:
+        app: WSGI app to serve
+        host (str): address to listen on
+        port (int): port to listen on
+        threads (int): number of requests handled at once
+    """
+
+    server = PooledWSGIServer(host, port, app, threads)
+    if PARSE_WORKERS > 0:
+        # Start the parse workers now rather than on the first upload
+        get_upload_pool().submit(abs, 0)
+    print(f'Serving on http://{host}:{server.port} with {threads} threads and {PARSE_WORKERS} parse workers')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        shutdown_upload_pool()
+
+
+def get_upload_pool() -> ProcessPoolExecutor:
+    """
+    Returns the pool of processes that parse uploaded files, starting it
+    if needed. The processes are spawned rather than forked, since the
+    server has threads (and DB connections) that must not be copied into them.
+
+    Returns:
+        ProcessPoolExecutor: the upload parse pool
+    """
+
+    global _upload_pool
+
+    with _upload_pool_lock:
+        if _upload_pool is None:
+            _upload_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=get_context('spawn'))
+        return _upload_pool
+
+
+def shutdown_upload_pool():
+    """
+    Stops the upload parse pool's processes. A new pool is started when needed.
+    """
+
+    global _upload_pool
+
+    with _upload_pool_lock:
+        if _upload_pool is not None:
+            _upload_pool.shutdown()
+            _upload_pool = None
+
+
+def validate_and_format_upload(filepath: str, has_header: bool, res_data: ResponseData):
+    """
+    Validates an uploaded CSV file and, if it is valid, puts its preview,
+    row count and suggested column types in the response (see
+    data.format_csv_data_for_ui).
+
+    Args:
+        filepath (str): path to the saved CSV file
+        has_header (bool): whether the CSV file has a header row
+        res_data (ResponseData): object to hold data for the response
+    """
+
+    with span('validate_csv', total_bytes=getsize(filepath)):
+        csv_err: str = find_csv_error(filepath)
+
+    if len(csv_err) == 0:
+        # The CSV is valid; put it in a UI digestible format and add it to the response
+        format_csv_data_for_ui(filepath, has_header, res_data)
+    else:
+        # The CSV is not valid; add an error code and message to the response
+        res_data.fail(422, f'Invalid CSV ({csv_err}). Please upload a valid CSV file.')
+
+
+def parse_upload(filepath: str, has_header: bool) -> tuple:
+    """
+    Runs validate_and_format_upload in a worker process.
+
+    Args:
+        filepath (str): path to the saved CSV file
+        has_header (bool): whether the CSV file has a header row
+
+    Returns:
+        tuple: the ResponseData (it only holds plain data, so it can be sent
+               back to the server) and the stage timings of the work
+    """
+
+    start_request(False)
+    res_data = ResponseData()
+    validate_and_format_upload(filepath, has_header, res_data)
+    return res_data, take_spans()
+
+
+def format_upload_for_ui(filepath: str, has_header: bool, res_data: ResponseData):
+    """
+    Validates and formats an uploaded CSV file for the UI (see
+    validate_and_format_upload), in the upload parse pool unless
+    PARSE_WORKERS is 0. The stages timed in the worker process are
+    recorded for the current request.
+
+    Args:
+        filepath (str): path to the saved CSV file
+        has_header (bool): whether the CSV file has a header row
+        res_data (ResponseData): object to hold data for the response
+    """
+
+    if PARSE_WORKERS <= 0:
+        validate_and_format_upload(filepath, has_header, res_data)
+        return
+
+    try:
+        worker_res_data, spans = get_upload_pool().submit(parse_upload, filepath, has_header).result()
+    except BrokenProcessPool as pool_err:
+        # A worker died (e.g. ran out of memory); start a new pool for the next upload
+        print(f'Error in format_upload_for_ui: {pool_err}')
+        shutdown_upload_pool()
+        res_data.fail(500, 'Failed to parse CSV')
+        return
+
+    for stage, seconds, rows, total_bytes in spans:
+        record_span(stage, seconds, rows, total_bytes)
+
+    res_data.set_data(worker_res_data.data)
+    if not worker_res_data.success:
+        res_data.fail(worker_res_data.status, worker_res_data.error)
@@ -0,0 +1,144 @@
+"""
+sessions.py:
+Per-session database schemas. Every UI session gets its own schema
+(csvt_<session ID>), so sessions can load and query tables at the same
+time without replacing or locking each other's tables. The last time each
+session was used is recorded in the csvt_meta.sessions table, and a
+background thread drops the schemas of sessions that have been idle for
+more than SESSION_IDLE_SECONDS, along with their uploaded and exported
+files, and removes expired background jobs.
+"""
+
+from multiprocessing import parent_process
+from os import environ
+from re import fullmatch
+from threading import Lock, Thread
+from time import monotonic, sleep
+from uuid import uuid4
+from response_data import ResponseData
+from postgres import drop_idle_schemas, record_schema_access
+from indexes import forget_query_columns
+from uploads import forget_uploads
+from jobs import collect_expired_jobs
+
+# Seconds a session may be idle before its schema is dropped
+SESSION_IDLE_SECONDS: int = int(environ.get('CSVT_SESSION_IDLE_SECONDS', 4 * 60 * 60))
+
+# Seconds between garbage collection runs
+SESSION_GC_INTERVAL: int = int(environ.get('CSVT_SESSION_GC_INTERVAL', 5 * 60))
+
+# Minimum seconds between recording the same session's last access in the DB
+SESSION_TOUCH_INTERVAL: int = 60
+
+# Prefix of session schema names
+SCHEMA_PREFIX: str = 'csvt_'
+
+# Schema -> monotonic time its last access was recorded in the DB
+_last_recorded: dict = {}
+_sessions_lock = Lock()
+_gc_thread: Thread = None
+
+
+def new_session_id() -> str:
+    """
+    Creates a new, unique session ID.
+
+    Returns:
+        str: session ID
+    """
+
+    return uuid4().hex
+
+
+def session_schema(session_id: str) -> str:
+    """
+    Returns the name of a session's schema, recording that the session
+    was just used. Session IDs must be 32 hex digits (see new_session_id).
+
+    Args:
+        session_id (str): session ID sent by the UI
+
+    Returns:
+        str: schema name, or None if the session ID isn't valid
+    """
+
+    if not isinstance(session_id, str) or not fullmatch(r'[0-9a-f]{32}', session_id):
+        return None
+
+    schema: str = SCHEMA_PREFIX + session_id
+    touch_schema(schema)
+    return schema
+
+
+def get_session_schema(session_id: str, res_data: ResponseData) -> str:
+    """
+    Returns the name of a session's schema, failing the response if
+    the session ID isn't valid.
+
+    Args:
+        session_id (str): session ID sent by the UI
+        res_data (ResponseData): object to hold data for the response
+
+    Returns:
+        str: schema name, or None if the session ID isn't valid
+    """
+
+    schema: str = session_schema(session_id)
+    if schema is None:
+        res_data.fail(422, 'Invalid session. Please upload the CSV file again.')
+    return schema
+
+
+def touch_schema(schema: str):
+    """
+    Records that a session schema was just used. The DB is only updated
+    once every SESSION_TOUCH_INTERVAL seconds per schema.
+
+    Args:
+        schema (str): session schema name
+    """
+
+    now: float = monotonic()
+    with _sessions_lock:
+        if now - _last_recorded.get(schema, -SESSION_TOUCH_INTERVAL) < SESSION_TOUCH_INTERVAL:
+            return
+        _last_recorded[schema] = now
+
+    record_schema_access(schema)
+
+
+def start_session_gc():
+    """
+    Starts the background thread that drops idle session schemas (once per process).
+    Worker processes (e.g. the parallel load's parse pool, which imports the
+    server module again) leave it to the server process.
+    """
+
+    global _gc_thread
+
+    if parent_process() is not None:
+        return
+
+    with _sessions_lock:
+        if _gc_thread is None:
+            _gc_thread = Thread(target=collect_idle_sessions, daemon=True)
+            _gc_thread.start()
+
+
+def collect_idle_sessions():
+    """
+    Drops the schemas (and forgets the uploads) of idle sessions and removes
+    expired jobs every SESSION_GC_INTERVAL seconds. Runs forever.
+    """
+
+    while True:
+        sleep(SESSION_GC_INTERVAL)
+
+        dropped: list = drop_idle_schemas(SESSION_IDLE_SECONDS)
+        with _sessions_lock:
+            for schema in dropped:
+                _last_recorded.pop(schema, None)
+        for schema in dropped:
+            forget_query_columns(schema)
+            forget_uploads(schema)
+        collect_expired_jobs()
@@ -0,0 +1,410 @@
+"""
+sql.py:
+Validation of user queries. A query is split into tokens the way
+PostgreSQL's lexer splits it (see tokenize), so keywords inside string
+literals, quoted identifiers and comments are never mistaken for real
+ones, and then checked to be a single read-only statement (see
+find_query_error). Queries are also run in read-only transactions (see
+postgres.schema_connection), so this is a first line of defence that
+gives the user a clear error message.
+
+Every session's tables are in its own schema, and the schema name holds
+the session ID, so queries also can't name other schemas (see
+find_schema_error), system catalogs or the types and functions that turn
+object IDs into names, which would reveal other sessions' schemas.
+
+Checked queries are kept in an LRU cache of QUERY_CACHE_ENTRIES entries
+keyed by the query text, so checking a query that was seen before (e.g.
+for every page of its results) is a dictionary lookup.
+"""
+
+from collections import OrderedDict
+from os import environ
+from re import DOTALL, VERBOSE, compile as compile_regex
+from threading import Lock
+
+# Number of checked queries kept
+QUERY_CACHE_ENTRIES: int = int(environ.get('CSVT_QUERY_CACHE_ENTRIES', 1024))
+
+# Tokens of PostgreSQL's SQL dialect, tried in this order at each position
+token_regex = compile_regex(r'''
+    (?P<space>\s+)
+  | (?P<comment>--[^\n]*)
+  | (?P<string>[eE]'(?:[^'\\]|\\.|'')*'
+              | [bBxXnN]?'(?:[^']|'')*'
+              | \$\$.*?\$\$
+              | \$(?P<tag>[^\W\d]\w*)\$.*?\$(?P=tag)\$)
+  | (?P<quoted_name>(?:[uU]&)?"(?:[^"]|"")*")
+  | (?P<param>\$\d+)
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<word>[^\W\d][\w$]*)
+  | (?P<op>(?:[+*<>=~!@\#%^&|`?:]|-(?!-)|/(?!\*))+)
+  | (?P<punct>[(),;.\[\]])
+''', VERBOSE | DOTALL)
+
+# Keywords a query may start with (all read-only statements)
+READ_ONLY_STATEMENTS: set = {'select', 'with', 'values', 'table'}
+
+# Statements that change data, which PostgreSQL allows in a WITH clause of a SELECT
+DATA_MODIFYING_STATEMENTS: set = {'insert', 'update', 'delete', 'merge'}
+
+# Functions that read or change things outside the session's tables, or run SQL of their own
+denied_functions: set = {
+    'pg_read_file', 'pg_read_binary_file', 'pg_ls_dir', 'pg_stat_file', 'pg_terminate_backend',
+    'pg_cancel_backend', 'pg_reload_conf', 'pg_rotate_logfile', 'set_config', 'query_to_xml',
+    'query_to_xmlschema', 'query_to_xml_and_xmlschema', 'cursor_to_xml', 'cursor_to_xmlschema',
+    'lo_import', 'lo_export', 'lo_unlink', 'lo_from_bytea', 'lo_put', 'lo_get', 'lo_open', 'loread',
+    'nextval', 'setval'
+}
+
+# Prefixes of the names of other denied functions
+DENIED_FUNCTION_PREFIXES: tuple = ('dblink', 'pg_advisory', 'pg_try_advisory', 'table_to_xml', 'schema_to_xml',
+                                   'database_to_xml', 'ts_stat', 'ts_rewrite')
+
+# Names of system catalogs (pg_catalog is searched even when it isn't in the search_path) and
+# object identifier types and functions, which would reveal the names of other sessions' schemas
+denied_names: set = {
+    'information_schema', 'regclass', 'regcollation', 'regconfig', 'regdictionary', 'regnamespace', 'regoper',
+    'regoperator', 'regproc', 'regprocedure', 'regrole', 'regtype'
+}
+DENIED_NAME_PREFIXES: tuple = ('pg_', 'to_reg')
+
+# Prefix of the schemas of sessions (see sessions.SCHEMA_PREFIX) and of the app's own csvt_meta schema
+APP_SCHEMA_PREFIX: str = 'csvt_'
+
+# Other schemas whose tables can't be queried
+denied_schemas: set = {'public'}
+
+# Keywords that appear among the column names of WHERE and ORDER BY clauses (see find_filter_columns)
+filter_keywords: set = {
+    'and', 'or', 'not', 'is', 'null', 'in', 'like', 'ilike', 'similar', 'to', 'escape', 'between', 'symmetric',
+    'by', 'asc', 'desc', 'nulls', 'first', 'last', 'using', 'true', 'false', 'unknown', 'case', 'when', 'then',
+    'else', 'end', 'exists', 'any', 'all', 'some', 'distinct', 'as', 'over', 'partition', 'collate', 'interval'
+}
+
+# Query text -> CheckedQuery
+_checked_queries: OrderedDict = OrderedDict()
+_checked_queries_lock = Lock()
+
+
+class QuerySyntaxError(Exception):
+    """Raised by tokenize when a query can't be split into tokens."""
+
+
+class CheckedQuery:
+    """
+    The result of checking a query: its tokens, its normalized text,
+    and the reason it can't be run (empty if it can).
+    """
+
+    def __init__(self, tokens: tuple, error: str):
+        # (kind, text) of every token, without spaces, comments and trailing semicolons
+        self.tokens: tuple = tokens
+        self.error: str = error
+
+        # Unquoted keywords and names are lower case (PostgreSQL folds them anyway) and tokens
+        # are separated by single spaces, so different spellings of a query normalize the same
+        self.normalized: str = ' '.join(text.lower() if kind == 'word' else text for kind, text in tokens)
+
+        # Names that qualify other names (schemas, tables or aliases), in lower case (see find_schema_error)
+        self.qualifiers: frozenset = frozenset(
+            unquote_name(kind, text).lower() for (kind, text), next_token in zip(tokens, tokens[1:])
+            if kind in ('word', 'quoted_name') and next_token == ('punct', '.'))
+
+
+def tokenize(query: str) -> list:
+    """
+    Splits a query into tokens: words (keywords and unquoted names), quoted
+    names (including U&"" names), string literals (including E'', B'', X'' and dollar quoted
+    strings), numbers, $n parameters, operators and punctuation. Spaces and
+    comments (including nested block comments) are skipped.
+
+    Args:
+        query (str): query to split
+
+    Returns:
+        list: (kind, text) of every token
+
+    Raises:
+        QuerySyntaxError: if a quote or comment isn't closed, or a character can't start a token
+    """
+
+    tokens: list = []
+    pos: int = 0
+
+    while pos < len(query):
+        if query.startswith('/*', pos):
+            pos = skip_block_comment(query, pos)
+            continue
+
+        match = token_regex.match(query, pos)
+        if match is None:
+            if query[pos] in '\'"$':
+                raise QuerySyntaxError(f'Unterminated quoted string at position {pos + 1}')
+            raise QuerySyntaxError(f'Unexpected character "{query[pos]}" at position {pos + 1}')
+
+        kind: str = match.lastgroup
+        if kind not in ('space', 'comment'):
+            tokens.append((kind, match.group()))
+        pos = match.end()
+
+    return tokens
+
+
+def skip_block_comment(query: str, pos: int) -> int:
+    """
+    Skips a block comment, which may contain nested block comments.
+
+    Args:
+        query (str): query text
+        pos (int): position of the comment's opening /*
+
+    Returns:
+        int: position just after the comment
+
+    Raises:
+        QuerySyntaxError: if the comment isn't closed
+    """
+
+    depth: int = 0
+    while pos < len(query):
+        if query.startswith('/*', pos):
+            depth += 1
+            pos += 2
+        elif query.startswith('*/', pos):
+            depth -= 1
+            pos += 2
+            if depth == 0:
+                return pos
+        else:
+            pos += 1
+
+    raise QuerySyntaxError('Unterminated comment')
+
+
+def find_query_error(tokens: list) -> str:
+    """
+    Checks that tokens make up a single read-only statement: a SELECT
+    (or WITH, VALUES or TABLE) statement that contains no data-modifying
+    statements (e.g. in a WITH clause), no SELECT INTO or locking clauses,
+    and calls no denied functions. The same column also can't be selected
+    twice, since the UI identifies columns by name.
+
+    Args:
+        tokens (list): tokens of the query, without trailing semicolons
+
+    Returns:
+        str: an error message if the query can't be run, else an empty str
+    """
+
+    if not tokens:
+        return 'Query is empty'
+
+    # Names could be hidden in the escapes of U&"" names, so they aren't checked
+    if any(kind == 'quoted_name' and text[0] in 'uU' for kind, text in tokens):
+        return 'Unicode escaped names (U&"...") cannot be used'
+
+    # Statements may be wrapped in parentheses
+    first_word: tuple = next((token for token in tokens if token != ('punct', '(')), ('', ''))
+    if first_word[0] != 'word' or first_word[1].lower() not in READ_ONLY_STATEMENTS:
+        return 'Only SELECT queries can be run'
+
+    depth: int = 0
+    previous: tuple = ('', '')
+    for token_idx, (kind, text) in enumerate(tokens):
+        word: str = text.lower() if kind == 'word' else ''
+
+        if (kind, text) == ('punct', '('):
+            depth += 1
+        elif (kind, text) == ('punct', ')'):
+            depth -= 1
+            if depth < 0:
+                return 'Unbalanced parentheses'
+        elif (kind, text) == ('punct', ';'):
+            return 'Only one statement can be run at a time'
+
+        if word in DATA_MODIFYING_STATEMENTS and previous == ('punct', '('):
+            return f'{word.upper()} statements cannot be run'
+        if word == 'into' and depth == 0:
+            return 'SELECT INTO cannot be used'
+        if word in ('update', 'share', 'key') and previous[1].lower() in ('for', 'no'):
+            return 'Locking clauses (FOR UPDATE/SHARE) cannot be used'
+
+        # A name followed by an opening parenthesis is a function call (the name may be qualified
+        # or quoted; quoted names are compared in lower case too, to be safe)
+        name: str = unquote_name(kind, text).lower()
+        if name in denied_names or name.startswith(DENIED_NAME_PREFIXES):
+            return f'{text} cannot be used'
+        if name and token_idx + 1 < len(tokens) and tokens[token_idx + 1] == ('punct', '('):
+            if name in denied_functions or name.startswith(DENIED_FUNCTION_PREFIXES):
+                return f'Function {name} cannot be used'
+
+        previous = (kind, text)
+
+    if depth != 0:
+        return 'Unbalanced parentheses'
+
+    return find_duplicate_columns(tokens)
+
+
+def find_schema_error(checked: CheckedQuery, schema: str) -> str:
+    """
+    Checks that a query doesn't name the schema of another session, the
+    app's csvt_meta schema or the public schema (system catalog schemas are
+    denied by find_query_error). Any name that qualifies another name is
+    checked, since tokens don't tell schemas from tables and aliases.
+
+    Args:
+        checked (CheckedQuery): the checked query
+        schema (str): session schema the query runs in
+
+    Returns:
+        str: an error message if the query names another schema, else an empty str
+    """
+
+    for qualifier in sorted(checked.qualifiers):
+        if qualifier != schema and (qualifier.startswith(APP_SCHEMA_PREFIX) or qualifier in denied_schemas):
+            return f'Tables of schema {qualifier} cannot be queried'
+    return ''
+
+
+def unquote_name(kind: str, text: str) -> str:
+    """
+    Returns the name a word or quoted name token stands for.
+
+    Args:
+        kind (str): token kind
+        text (str): token text
+
+    Returns:
+        str: the name (lower case for words, as PostgreSQL folds them), or an empty str
+             if the token isn't a name
+    """
+
+    if kind == 'word':
+        return text.lower()
+    if kind == 'quoted_name':
+        return text[1:-1].replace('""', '"')
+    return ''
+
+
+def find_duplicate_columns(tokens: list) -> str:
+    """
+    Checks that no item of the outermost SELECT list is selected twice.
+
+    Args:
+        tokens (list): tokens of the query
+
+    Returns:
+        str: an error message if an item is selected twice, else an empty str
+    """
+
+    depth: int = 0
+    select_depth: int = None
+    items: list = []
+    item: list = []
+
+    for kind, text in tokens:
+        word: str = text.lower() if kind == 'word' else ''
+
+        if select_depth is None:
+            # Find the outermost SELECT (a WITH clause's queries are in parentheses, so deeper)
+            if word == 'select' and (depth == 0 or tokens[0] == ('punct', '(')):
+                select_depth = depth
+        elif depth == select_depth and (word in ('from', 'where', 'group', 'having', 'window', 'order',
+                                                 'limit', 'offset', 'fetch', 'union', 'intersect', 'except')
+                                        or (kind, text) == ('punct', ')')):
+            break
+        elif depth == select_depth and (kind, text) == ('punct', ','):
+            items.append(' '.join(item))
+            item = []
+        else:
+            item.append(text.lower() if kind == 'word' else text)
+
+        if (kind, text) == ('punct', '('):
+            depth += 1
+        elif (kind, text) == ('punct', ')'):
+            depth -= 1
+
+    if item:
+        items.append(' '.join(item))
+
+    if len(items) != len(set(items)):
+        return 'The same column cannot be selected twice'
+    return ''
+
+
+def find_filter_columns(tokens: tuple) -> set:
+    """
+    Finds the names that a query filters (WHERE) or sorts (ORDER BY) by,
+    in the outer query and in subqueries. Qualified names (t.column) count
+    as the column name; function names and common keywords don't count.
+    The names may still include names that aren't columns (e.g. aliases),
+    so they should be matched against the columns of the session's tables.
+
+    Args:
+        tokens (tuple): tokens of the query (see CheckedQuery)
+
+    Returns:
+        set: names of the filter and sort columns (lower case unless quoted)
+    """
+
+    columns: set = set()
+
+    # Clause being read at each parenthesis depth ('where', 'order' or ''); parenthesized
+    # expressions are part of the clause around them, unless they are subqueries
+    clauses: list = ['']
+
+    for token_idx, (kind, text) in enumerate(tokens):
+        word: str = text.lower() if kind == 'word' else ''
+        next_token: tuple = tokens[token_idx + 1] if token_idx + 1 < len(tokens) else ('', '')
+
+        if (kind, text) == ('punct', '('):
+            clauses.append(clauses[-1])
+        elif (kind, text) == ('punct', ')'):
+            if len(clauses) > 1:
+                clauses.pop()
+        elif word == 'where' or (word == 'order' and next_token[1].lower() == 'by'):
+            clauses[-1] = word
+        elif word in ('select', 'from', 'group', 'having', 'window', 'limit', 'offset', 'fetch',
+                      'union', 'intersect', 'except', 'returning'):
+            clauses[-1] = ''
+        elif clauses[-1] and (kind == 'quoted_name' or (word and word not in filter_keywords)) \
+                and next_token[1] not in ('(', '.'):
+            columns.add(unquote_name(kind, text))
+
+    return columns
+
+
+def check_query(query: str) -> CheckedQuery:
+    """
+    Checks whether a query can be run (see find_query_error), using the
+    cached result if the same query text was checked before.
+
+    Args:
+        query (str): query to check
+
+    Returns:
+        CheckedQuery: the checked query
+    """
+
+    with _checked_queries_lock:
+        checked: CheckedQuery = _checked_queries.get(query)
+        if checked is not None:
+            _checked_queries.move_to_end(query)
+            return checked
+
+    try:
+        tokens: list = tokenize(query)
+        while tokens and tokens[-1] == ('punct', ';'):
+            tokens.pop()
+        checked = CheckedQuery(tuple(tokens), find_query_error(tokens))
+    except QuerySyntaxError as syntax_err:
+        checked = CheckedQuery((), str(syntax_err))
+
+    with _checked_queries_lock:
+        _checked_queries[query] = checked
+        while len(_checked_queries) > QUERY_CACHE_ENTRIES:
+            _checked_queries.popitem(last=False)
+
+    return checked
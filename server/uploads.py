@@ -0,0 +1,240 @@
+"""
+uploads.py:
+Keeps track of uploaded CSV files saved under data/, so a table can be
+created from the saved file (by upload ID) without the UI sending the
+data back to the server.
+
+Every session's uploads are saved in a directory of their own,
+data/<session schema>/, and registered for that session only; they are
+forgotten and deleted when the session's schema is dropped (see
+forget_uploads and sessions.collect_idle_sessions).
+
+Uploads are streamed to disk in chunks of UPLOAD_CHUNK_BYTES and saved
+under the SHA-256 hash of their content, so uploading the same file again
+in a session reuses the saved copy. The parse results sent to the UI for
+a file (its preview, row count and suggested column types) are kept for
+the last UPLOAD_CACHE_ENTRIES files, so a re-upload doesn't have to be
+validated and parsed again. The previews are kept in compact typed
+columns (see preview.CompactTable) rather than as lists of Python objects.
+"""
+
+from collections import OrderedDict
+from hashlib import sha256
+from os import environ, getcwd, makedirs, remove, replace
+from os.path import exists, join, splitext
+from shutil import rmtree
+from threading import Lock
+from uuid import uuid4
+from werkzeug.datastructures import FileStorage
+from werkzeug.utils import secure_filename
+from response_data import ResponseData
+from preview import CompactTable
+from profiling import span
+
+# Number of bytes of an upload read (and hashed) at a time while saving it
+UPLOAD_CHUNK_BYTES: int = 1024 * 1024
+
+# Number of files whose parse results are kept
+UPLOAD_CACHE_ENTRIES: int = int(environ.get('CSVT_UPLOAD_CACHE_ENTRIES', 16))
+
+# Directory holding the directories uploads are saved in
+UPLOAD_ROOT: str = join(getcwd(), 'data')
+
+# Upload ID -> {'path': str, 'hasHeader': bool, 'totalRows': int, 'hash': str, 'schema': str}
+_uploads: dict = {}
+_uploads_lock = Lock()
+
+# (Session Schema, Content Hash, Has Header) -> (UI data sent for the file without its
+# 'columnData' (see data.format_csv_data_for_ui), CompactTable of the 'columnData', bytes it takes)
+_parse_results: OrderedDict = OrderedDict()
+
+
+def new_upload_id() -> str:
+    """
+    Creates a new, unique upload ID.
+
+    Returns:
+        str: upload ID
+    """
+
+    return uuid4().hex
+
+
+def upload_directory(schema: str) -> str:
+    """
+    Args:
+        schema (str): session schema
+
+    Returns:
+        str: path of the directory the session's uploads are saved in
+    """
+
+    return join(UPLOAD_ROOT, schema)
+
+
+def save_upload(file: FileStorage, schema: str, res_data: ResponseData) -> tuple:
+    """
+    Streams an uploaded file to disk, hashing it on the way, and saves it
+    as <content hash><extension> in the session's upload directory. If a
+    file with the same content was saved in the session before, that copy
+    is kept and the new one discarded.
+
+    Args:
+        file (FileStorage): uploaded file
+        schema (str): session schema of the upload
+        res_data (ResponseData): object to hold data for the response
+
+    Returns:
+        tuple: path of the saved file and its content hash, or (None, None) if it couldn't be saved
+    """
+
+    directory: str = upload_directory(schema)
+    temp_path: str = join(directory, f'{uuid4().hex}.part')
+    hasher = sha256()
+
+    try:
+        makedirs(directory, exist_ok=True)
+        with span('save_upload', total_bytes=0) as stage, open(temp_path, 'wb') as saved_file:
+            while chunk := file.stream.read(UPLOAD_CHUNK_BYTES):
+                hasher.update(chunk)
+                saved_file.write(chunk)
+                stage.bytes += len(chunk)
+
+        content_hash: str = hasher.hexdigest()
+        filepath: str = join(directory, content_hash + splitext(secure_filename(file.filename))[1].lower())
+        if exists(filepath):
+            remove(temp_path)
+        else:
+            replace(temp_path, filepath)
+    except OSError as os_err:
+        print(f'Error in save_upload: {os_err}')
+        if exists(temp_path):
+            remove(temp_path)
+        res_data.fail(500, 'Failed to save uploaded file')
+        return None, None
+
+    return filepath, content_hash
+
+
+def get_parse_result(schema: str, content_hash: str, has_header: bool) -> dict:
+    """
+    Looks up the parse results of a file uploaded before in the session.
+
+    Args:
+        schema (str): session schema of the upload
+        content_hash (str): content hash of the file (see save_upload)
+        has_header (bool): whether the file is read with a header row
+
+    Returns:
+        dict: copy of the UI data sent for the file (with the 'columnMemory' of
+              its preview), or None if it isn't kept
+    """
+
+    with _uploads_lock:
+        parse_result: tuple = _parse_results.get((schema, content_hash, has_header))
+        if parse_result is None:
+            return None
+        _parse_results.move_to_end((schema, content_hash, has_header))
+
+    ui_data, preview, _ = parse_result
+    return {**ui_data, 'columnData': preview.to_columns()}
+
+
+def cache_parse_result(schema: str, content_hash: str, has_header: bool, ui_data: dict) -> dict:
+    """
+    Keeps the parse results of an uploaded file for re-uploads of the same
+    content in the session, forgetting the least recently used ones beyond
+    UPLOAD_CACHE_ENTRIES.
+
+    Args:
+        schema (str): session schema of the upload
+        content_hash (str): content hash of the file (see save_upload)
+        has_header (bool): whether the file was read with a header row
+        ui_data (dict): UI data sent for the file
+
+    Returns:
+        dict: Column Name -> bytes the column's preview values take in the cache
+    """
+
+    preview = CompactTable(ui_data['columnData'])
+    column_memory: dict = preview.column_memory()
+    cached_data: dict = {key: value for key, value in ui_data.items() if key != 'columnData'}
+    cached_data['columnMemory'] = column_memory
+
+    with _uploads_lock:
+        _parse_results[(schema, content_hash, has_header)] = (cached_data, preview, sum(column_memory.values()))
+        _parse_results.move_to_end((schema, content_hash, has_header))
+        while len(_parse_results) > UPLOAD_CACHE_ENTRIES:
+            _parse_results.popitem(last=False)
+
+    return column_memory
+
+
+def get_upload_cache_metrics() -> dict:
+    """
+    Returns the number of parse results kept and the bytes their previews take.
+
+    Returns:
+        dict: upload cache metrics
+    """
+
+    with _uploads_lock:
+        return {
+            'entries': len(_parse_results),
+            'previewBytes': sum(preview_bytes for _, _, preview_bytes in _parse_results.values())
+        }
+
+
+def register_upload(upload_id: str, filepath: str, has_header: bool, total_rows: int, schema: str,
+                    content_hash: str = None):
+    """
+    Registers a validated upload so it can be loaded into a table later.
+
+    Args:
+        upload_id (str): upload ID created by new_upload_id
+        filepath (str): path to the saved CSV file
+        has_header (bool): whether the CSV file has a header row
+        total_rows (int): number of data rows in the file
+        schema (str): session schema of the upload; only that session can look it up
+        content_hash (str): content hash of the file (see save_upload)
+    """
+
+    with _uploads_lock:
+        _uploads[upload_id] = {'path': filepath, 'hasHeader': has_header, 'totalRows': total_rows,
+                               'hash': content_hash, 'schema': schema}
+
+
+def lookup_upload(upload_id: str, schema: str) -> dict:
+    """
+    Looks up an upload registered by a session.
+
+    Args:
+        upload_id (str): upload ID returned by /loadcsv
+        schema (str): session schema looking the upload up
+
+    Returns:
+        dict: the registered upload, or None if the ID is unknown or belongs to another session
+    """
+
+    with _uploads_lock:
+        upload: dict = _uploads.get(upload_id)
+    return upload if upload is not None and upload['schema'] == schema else None
+
+
+def forget_uploads(schema: str):
+    """
+    Forgets a session's uploads and parse results and deletes its saved
+    files (e.g. once its schema is dropped). The files are deleted even if
+    they were uploaded before the server started.
+
+    Args:
+        schema (str): session schema
+    """
+
+    with _uploads_lock:
+        for upload_id in [upload_id for upload_id, upload in _uploads.items() if upload['schema'] == schema]:
+            del _uploads[upload_id]
+        for key in [key for key in _parse_results if key[0] == schema]:
+            del _parse_results[key]
+
+    rmtree(upload_directory(schema), ignore_errors=True)
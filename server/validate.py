@@ -1,15 +1,16 @@
+"""validate.py: Validation of uploaded CSV files"""
 
-from subprocess import run
-from time import sleep, time
-from os.path import join, exists
-from os import getcwd, remove
-from pandas import read_csv
+from csv import Error as CSVError, field_size_limit, reader
+from os.path import splitext
+
+# Largest field (in characters) the validator accepts; pandas has no limit of its own
+MAX_FIELD_SIZE: int = 2 ** 31 - 1
 
 
 def validate_csv(csv_path: str) -> bool:
     """
-    Interacts with the CSV Checker microservice to
-    determine whether a CSV file is valid or not.
+    Determines whether a CSV file is valid or not.
+    See find_csv_error for what is checked.
 
     Args:
         csv_path (str): path to CSV file to validate
@@ -18,37 +19,54 @@ def validate_csv(csv_path: str) -> bool:
         bool: True if the CSV file is valid, else false
     """
 
-    # Determine path to the CSV Checker microservice
-    svc_path = '/Users/codyray/github.com/chungd87/CS361-Microservice---CSV-Checker/CSVChecker.py'
-    
-    # Microservice writes output to a csv file with the form "./{csv_filename}OutputResults.csv"
-    svc_output_path = join(getcwd(), f'{csv_path[:-4]}OutputResult.csv')
+    return len(find_csv_error(csv_path)) == 0
+
+
+def find_csv_error(csv_path: str) -> str:
+    """
+    Checks a CSV file in a single streaming pass, one row at a time.
+    The file must have a .csv extension, be UTF-8 encoded, have at least
+    one row, quote fields correctly, and have the same number of fields
+    in every row (blank lines are ignored).
+
+    Args:
+        csv_path (str): path to CSV file to validate
+
+    Returns:
+        str: a description of the first error found (with its line number), or an empty str if the file is valid
+    """
 
-    # Call the microservice and pass the CSV path as an argument
-    run(['python3', f'{svc_path}', f'{csv_path}'])
+    if splitext(csv_path)[1].lower() != '.csv':
+        return 'File is not a .csv file'
 
-    # Wait until the output file exists
-    wait_until_exists(svc_output_path)
+    field_size_limit(MAX_FIELD_SIZE)
+    row_width: int = 0
+    line_num: int = 0
 
-    # Read the results and remove the output file
-    result = read_csv(svc_output_path)
-    remove(svc_output_path)
+    try:
+        with open(csv_path, 'r', encoding='utf-8-sig', newline='') as csv_file:
+            csv_reader = reader(csv_file, strict=True)
+            for row in csv_reader:
+                line_num = csv_reader.line_num
 
-    # The result is in the first row of column "boolean"
-    return bool(result['boolean'].loc[0])
+                # Blank lines are skipped when the CSV is read, so they don't count
+                if not row:
+                    continue
 
+                # Every row must have as many fields as the first one
+                if row_width == 0:
+                    row_width = len(row)
+                elif len(row) != row_width:
+                    return f'Line {line_num} has {len(row)} fields, expected {row_width}'
+    except CSVError as csv_err:
+        return f'Line {line_num + 1}: {csv_err}'
+    except UnicodeDecodeError:
+        return f'File is not valid UTF-8 (near line {line_num + 1})'
+    except OSError as os_err:
+        print(f'Error in find_csv_error: {os_err}')
+        return 'File could not be read'
 
-def wait_until_exists(filepath: str):
-    """
-    Sleeps unil the specified file exists. Checks for 
-    file existence every 0.001 seconds and returns as
-    soon as the file is detected.
+    if row_width == 0:
+        return 'File is empty'
 
-    Args:
-        filepath (str): file to wait for
-    """    
-    start = time()
-    elapsed = 0
-    while not exists(filepath) and elapsed < 2:
-        sleep(0.001)
-        elapsed = time() - start
+    return ''